@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Compressed archives on a synthetic SOAP corpus: for no compression and every codec, the archive size relative to
+the .http capture, the write throughput and the read throughput (all exchanges with their bodies, segments
+decompressed by 4 threads) are reported, in MiB of the .http capture per second.
+
+Usage: python -m benchmark.compression_benchmark [capture size in MiB]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from proxy.parser.http_parser import parse_head
+from proxy.pipe.archive import ArchiveReader, ArchiveWriter, CODECS
+from proxy.pipe.communication import RequestResponse, new_guid
+from proxy.pipe.persistence import serialize_message_pairs
+
+MIB = 1024 * 1024
+READ_WORKERS = 4
+
+REQUEST_HEAD = (b"POST /services/CustomerService HTTP/1.1\r\nHost: soap.example.com\r\n"
+                b"Content-Type: text/xml; charset=utf-8\r\nSOAPAction: \"urn:%s\"\r\nContent-Length: %d\r\n\r\n")
+RESPONSE_HEAD = b"HTTP/1.1 200 OK\r\nContent-Type: text/xml; charset=utf-8\r\nContent-Length: %d\r\n\r\n"
+ENVELOPE = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+            b'xmlns:cus="http://example.com/customer/v1">\n<soapenv:Header/>\n<soapenv:Body>\n'
+            b'<cus:%s>\n%s</cus:%s>\n</soapenv:Body>\n</soapenv:Envelope>\n')
+OPERATIONS = (b"getCustomer", b"updateCustomer", b"findOrders", b"getInvoice")
+
+
+def envelope(rng, operation, fields):
+    items = b"".join(b"  <cus:%s>%d</cus:%s>\n" % (name, rng.randrange(10 ** 9), name) for name in fields)
+    return ENVELOPE % (operation, items, operation)
+
+
+def build_exchange(rng):
+    operation = rng.choice(OPERATIONS)
+    request_body = envelope(rng, operation, (b"customerId", b"requestId"))
+    response_body = envelope(rng, operation + b"Response",
+                             [b"item%d" % i for i in range(rng.randrange(5, 60))])
+    rr = RequestResponse()
+    rr.guid = new_guid()
+    rr.request = parse_head(REQUEST_HEAD % (operation, len(request_body)))
+    rr.request.body = request_body
+    rr.response = parse_head(RESPONSE_HEAD % len(response_body))
+    rr.response.body = response_body
+    return rr
+
+
+def build_corpus(file_name, size):
+    rng = random.Random(1)
+    pairs = []
+    with open(file_name, "wb") as f:
+        while f.tell() < size:
+            rr = build_exchange(rng)
+            serialize_message_pairs([rr], f)
+            pairs.append(rr)
+    return pairs
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    with tempfile.TemporaryDirectory() as directory:
+        capture = os.path.join(directory, "capture.http")
+        pairs = build_corpus(capture, size * MIB)
+        capture_size = os.path.getsize(capture) / MIB
+        print("{:.0f} MiB, {} exchanges".format(capture_size, len(pairs)))
+        print("{:>8} {:>10} {:>14} {:>14}".format("codec", "ratio", "write MiB/s", "read MiB/s"))
+        for codec in [None] + sorted(CODECS):
+            archive = os.path.join(directory, "capture.pyarc")
+            start = time.perf_counter()
+            with open(archive, "wb") as f, ArchiveWriter(f, codec) as writer:
+                for rr in pairs:
+                    writer.add(rr)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            loaded = sum(1 for _ in ArchiveReader(archive).load_request_responses(READ_WORKERS))
+            read_time = time.perf_counter() - start
+            assert loaded == len(pairs)
+
+            ratio = capture_size / (os.path.getsize(archive) / MIB)
+            print("{:>8} {:>10.1f} {:>14.1f} {:>14.1f}".format(codec or "none", ratio, capture_size / write_time,
+                                                                 capture_size / read_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+A/B comparison of the event loops available to the proxy.
+
+For every event loop, the proxy runs in its own process in front of a minimal keep-alive upstream stand-in
+(another process). Concurrent keep-alive clients then send requests through the proxy. The requests per second
+and the latency percentiles are reported, with and without metrics.
+
+Usage: python -m benchmark.loop_benchmark [connections] [requests per connection]
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import socket
+import sys
+import time
+
+from proxy.pipe.apipe import ProxyParameters, prepare_server
+from proxy.pipe.channel import ChannelRegistry
+from proxy.pipe.communication import MessageListener
+from proxy.pipe.metrics import MetricsListener, ProxyMetrics
+from proxy.pipe.event_loop import available_event_loops, create_event_loop, LOOP_AUTO
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 13\r\n\r\nHello, world!"
+REQUEST = b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"
+
+
+class QuietListener(MessageListener):
+    def on_request_response(self, request_response):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def handle_upstream(reader, writer):
+    try:
+        while True:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(RESPONSE)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+
+
+def run_upstream(port):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(asyncio.start_server(handle_upstream, host="127.0.0.1", port=port))
+    loop.run_forever()
+
+
+def run_proxy(event_loop, port, upstream_port, with_metrics):
+    loop = create_event_loop(event_loop)
+    asyncio.set_event_loop(loop)
+    # Connection logging would dominate the measurement
+    logging.getLogger('proxy').setLevel(logging.WARNING)
+    parameters = ProxyParameters("127.0.0.1", port, "127.0.0.1", upstream_port, rewrite_headers=False)
+    listener = QuietListener()
+    channels = ChannelRegistry()
+    metrics = None
+    if with_metrics:
+        metrics = ProxyMetrics(channels)
+        listener = MetricsListener(listener, metrics)
+    loop.run_until_complete(prepare_server(parameters, listener, channels=channels, metrics=metrics))
+    loop.run_forever()
+
+
+async def client(port, requests, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for _ in range(requests):
+        start = time.perf_counter()
+        writer.write(REQUEST)
+        await reader.readexactly(len(RESPONSE))
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def wait_for_port(port):
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except ConnectionRefusedError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("proxy did not start")
+
+
+async def load(port, connections, requests):
+    await wait_for_port(port)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, requests, latencies) for _ in range(connections)))
+    return time.perf_counter() - start, sorted(latencies)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    context = multiprocessing.get_context("spawn")
+    upstream_port = free_port()
+    upstream = context.Process(target=run_upstream, args=(upstream_port,), daemon=True)
+    upstream.start()
+
+    print("{:>16} {:>12} {:>12} {:>12}".format("loop", "req/s", "p50 ms", "p99 ms"))
+    for event_loop in available_event_loops():
+        if event_loop == LOOP_AUTO:
+            continue
+        for with_metrics in (False, True):
+            port = free_port()
+            proxy = context.Process(target=run_proxy, args=(event_loop, port, upstream_port, with_metrics),
+                                    daemon=True)
+            proxy.start()
+            try:
+                elapsed, latencies = asyncio.run(load(port, connections, requests))
+            finally:
+                proxy.terminate()
+                proxy.join()
+            name = event_loop + ("+metrics" if with_metrics else "")
+            print("{:>16} {:>12.0f} {:>12.3f} {:>12.3f}".format(name, len(latencies) / elapsed,
+                                                               percentile(latencies, 0.5) * 1000,
+                                                               percentile(latencies, 0.99) * 1000))
+
+    upstream.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Parse a single HTTP response with bodies of growing size, fed to the parser in 64 KiB pieces.
+
+The time per MiB should stay roughly the same for all sizes, i.e. the parse time grows linearly with the body size.
+
+Usage: python -m benchmark.parser_benchmark [max size in MiB]
+"""
+
+import sys
+import time
+
+from proxy.parser.http_parser import get_http_request
+from proxy.parser.parser_utils import intialize_parser, parse
+
+READ_SIZE = 65536
+MIB = 1024 * 1024
+
+
+def build_response(body_size):
+    head = b"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nContent-Length: %d\r\n\r\n" % body_size
+    return head + b"x" * body_size
+
+
+def parse_in_pieces(data):
+    parser = intialize_parser(get_http_request)
+    view = memoryview(data)
+    messages = []
+    for i in range(0, len(data), READ_SIZE):
+        messages += parse(parser, bytes(view[i:i + READ_SIZE]))
+    assert len(messages) == 1
+    return messages[0]
+
+
+def main():
+    max_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    size = 1
+    print("{:>10} {:>12} {:>12}".format("size MiB", "time s", "s per MiB"))
+    while size <= max_size:
+        data = build_response(size * MIB)
+        start = time.perf_counter()
+        parse_in_pieces(data)
+        elapsed = time.perf_counter() - start
+        print("{:>10} {:>12.4f} {:>12.5f}".format(size, elapsed, elapsed / size))
+        size *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,31 @@
+import os
 import sys
 
-from PyQt5.QtCore import QSettings
+from PyQt5.QtCore import QSettings, QTimer
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QMenu
 from PyQt5.QtWidgets import QWidget, QHBoxLayout, QPushButton, QVBoxLayout, QMessageBox, \
-    QFileDialog, QAction, QMenuBar
+    QFileDialog, QAction, QMenuBar, QActionGroup, QLabel
 from proxy.gui.plugins import PLUGINS
 from proxy.gui.plugins.plugin_registry import PluginRegistry
+from proxy.gui.widgets.capture_limits import CaptureLimits, CaptureLimitsDialog
 from proxy.gui.widgets.connection_config import ConnectionConfig
 from proxy.gui.widgets.http_messages_tabs import HttpMessagesTabs
 from proxy.gui.widgets.http_messages_tree_view import HttpMessagesTreeView
 from proxy.gui.worker import Worker
 from proxy.pipe.apipe import ProxyParameters
 from proxy.pipe.communication import RequestResponse
-from proxy.pipe.persistence import parse_message_pairs, serialize_message_pairs
+from proxy.pipe.event_loop import available_event_loops, LOOP_AUTO
+from proxy.pipe.archive import ArchiveReader, ArchiveWriter, EXTENSION, is_archive
+from proxy.pipe.persistence import map_message_pairs, serialize_message_pairs
+from proxy.pipe.sqlite_store import CaptureDatabase
 
 from proxy.parser.http_parser import HttpMessage
 
 DEFAULT_PARAMETERS = ProxyParameters("0.0.0.0", 8888, "www.httpwatch.com", 80)
+DATABASE_PAGE_SIZE = 1000
+# How often the rate of the captured exchanges is updated, in ms
+RATE_INTERVAL = 1000
 
 
 class MainWindow(QWidget):
@@ -29,8 +37,6 @@ class MainWindow(QWidget):
         self.setGeometry(300, 300, 750, 750)
         self.setWindowTitle('PyProxy')
 
-        self.worker = Worker()
-
         self.settings = QSettings("settings.ini", QSettings.IniFormat)
 
         self.settings.beginGroup("window")
@@ -38,9 +44,29 @@ class MainWindow(QWidget):
             self.restoreGeometry(self.settings.value("geometry"))
         self.settings.endGroup()
 
+        self.settings.beginGroup("proxy")
+        self.event_loop = self.settings.value("event_loop", LOOP_AUTO)
+        self.settings.endGroup()
+
+        self.settings.beginGroup("search")
+        self.search_bodies = self.settings.value("bodies", False, type=bool)
+        self.settings.endGroup()
+
+        self.worker = Worker(event_loop=self.event_loop)
+
+        # Capture database being browsed, the ids after which the previous pages start and the shown page
+        self.database = None
+        self.database_pages = []
+        self.database_page = (0, 0)
+
         self.plugin_registry.restore_settings(self.settings)
 
+        self.capture_limits = CaptureLimits()
+        self.capture_limits.restoreSettings(self.settings)
+
         self.initUI()
+        self.capture_limits.apply(self.treeView)
+        self.treeView.setSearchBodies(self.search_bodies)
 
     def initUI(self):
         self.connection_config = ConnectionConfig(self)
@@ -51,11 +77,15 @@ class MainWindow(QWidget):
         self.startButton = QPushButton(QIcon.fromTheme("media-playback-start"), "Start")
         self.stopButton = QPushButton(QIcon.fromTheme("media-playback-stop"), "Stop")
         self.restartButton = QPushButton(QIcon.fromTheme("media-skip-backward"), "Restart")
+        self.pauseButton = QPushButton(QIcon.fromTheme("media-playback-pause"), "Pause")
+        self.pauseButton.setCheckable(True)
+        self.rateLabel = QLabel()
 
         self.startButton.clicked.connect(self.onStartClicked)
         self.stopButton.clicked.connect(self.onStopClicked)
         self.restartButton.clicked.connect(self.onRestartClicked)
-        self.worker.received.connect(self.onReceived)
+        self.pauseButton.toggled.connect(self.onPauseToggled)
+        self.worker.received_batch.connect(self.onReceivedBatch)
         self.worker.error.connect(self.onError)
         self.worker.running_changed.connect(self.update_status)
 
@@ -64,6 +94,8 @@ class MainWindow(QWidget):
         hbox.addWidget(self.startButton)
         hbox.addWidget(self.stopButton)
         hbox.addWidget(self.restartButton)
+        hbox.addWidget(self.pauseButton)
+        hbox.addWidget(self.rateLabel)
 
         self.treeView = HttpMessagesTreeView(self.plugin_registry, self)
         self.treeView.selected.connect(self.onMessageSelected)
@@ -82,6 +114,12 @@ class MainWindow(QWidget):
         self.update_status(self.worker.status())
         self.onMessageSelected(None)
 
+        self.rateTimer = QTimer(self)
+        self.rateTimer.setInterval(RATE_INTERVAL)
+        self.rateTimer.timeout.connect(self.updateRate)
+        self.rateTimer.start()
+        self.updateRate()
+
     def createMenu(self, mainMenu):
         #mainMenu = QMenuBar()
         #mainMenu.setNativeMenuBar(False)
@@ -97,6 +135,22 @@ class MainWindow(QWidget):
 
         fileMenu.addSeparator()
 
+        openDatabaseAction = QAction('Open &database', self)
+        openDatabaseAction.triggered.connect(self.onOpenDatabaseClicked)
+        fileMenu.addAction(openDatabaseAction)
+
+        previousPageAction = QAction('&Previous page', self)
+        previousPageAction.setEnabled(self.database is not None)
+        previousPageAction.triggered.connect(self.onPreviousPageClicked)
+        fileMenu.addAction(previousPageAction)
+
+        nextPageAction = QAction('&Next page', self)
+        nextPageAction.setEnabled(self.database is not None)
+        nextPageAction.triggered.connect(self.onNextPageClicked)
+        fileMenu.addAction(nextPageAction)
+
+        fileMenu.addSeparator()
+
         exitAction = QAction('&Exit', self)
         exitAction.triggered.connect(self.onExit)
         fileMenu.addAction(exitAction)
@@ -107,6 +161,25 @@ class MainWindow(QWidget):
             action.triggered.connect(self.getSettingsCallback(callback))
             settignsMenu.addAction(action)
 
+        limitsAction = QAction('Capture limits...', self)
+        limitsAction.triggered.connect(self.onCaptureLimitsClicked)
+        settignsMenu.addAction(limitsAction)
+
+        searchBodiesAction = QAction('Search bodies', self)
+        searchBodiesAction.setCheckable(True)
+        searchBodiesAction.setChecked(self.search_bodies)
+        searchBodiesAction.toggled.connect(self.onSearchBodiesToggled)
+        settignsMenu.addAction(searchBodiesAction)
+
+        loopMenu = settignsMenu.addMenu('Event loop')
+        loopGroup = QActionGroup(loopMenu)
+        for event_loop in available_event_loops():
+            action = QAction(event_loop, loopGroup)
+            action.setCheckable(True)
+            action.setChecked(event_loop == self.event_loop)
+            action.triggered.connect(self.getEventLoopCallback(event_loop))
+            loopMenu.addAction(action)
+
         return mainMenu
 
     def contextMenuEvent(self, event):
@@ -121,6 +194,23 @@ class MainWindow(QWidget):
 
         return func
 
+    def onCaptureLimitsClicked(self):
+        dialog = CaptureLimitsDialog(self.capture_limits)
+        if dialog.exec_():
+            self.capture_limits = dialog.limits()
+            self.capture_limits.apply(self.treeView)
+
+    def onSearchBodiesToggled(self, enabled):
+        self.search_bodies = enabled
+        self.treeView.setSearchBodies(enabled)
+
+    def getEventLoopCallback(self, event_loop):
+        def func():
+            self.event_loop = event_loop
+            self.worker.setEventLoop(event_loop)
+
+        return func
+
     def onStartClicked(self, event):
         self.worker.start()
 
@@ -132,47 +222,132 @@ class MainWindow(QWidget):
         self.treeView.clear()
         self.worker.start()
 
+    def onPauseToggled(self, paused):
+        """The proxy keeps capturing while the list is paused, the exchanges are shown on resume"""
+        if paused:
+            self.treeView.pause()
+            self.pauseButton.setIcon(QIcon.fromTheme("media-playback-start"))
+            self.pauseButton.setText("Resume")
+        else:
+            self.treeView.resume()
+            self.pauseButton.setIcon(QIcon.fromTheme("media-playback-pause"))
+            self.pauseButton.setText("Pause")
+        self.updateRate()
+
+    def updateRate(self):
+        text = "{:.0f} exchanges/s".format(self.worker.rate())
+        if self.treeView.paused:
+            text += ", {} waiting".format(len(self.treeView.held))
+        self.rateLabel.setText(text)
+
     def onSaveClicked(self, event):
-        file_name = QFileDialog.getSaveFileName(self, 'Save HTTP messages', '.', filter='*.http')[0]
+        file_name = QFileDialog.getSaveFileName(self, 'Save HTTP messages', '.', filter='*.http;;*' + EXTENSION)[0]
         if not file_name:
             return
 
-        if not file_name.endswith(".http"):
+        if not file_name.endswith((".http", EXTENSION)):
             file_name += ".http"
 
         self.save(file_name)
 
     def onLoadClicked(self, event):
-        file_name = QFileDialog.getOpenFileName(self, 'Save HTTP messages', '.', filter='*.http')[0]
+        file_name = QFileDialog.getOpenFileName(self, 'Save HTTP messages', '.', filter='*.http *' + EXTENSION)[0]
         if file_name:
             self.load(file_name)
 
+    def onOpenDatabaseClicked(self, event):
+        file_name = QFileDialog.getOpenFileName(self, 'Open capture database', '.', filter='*.db;;*')[0]
+        if file_name:
+            try:
+                self.openDatabase(file_name)
+            except ValueError as e:
+                self.onError(e)
+
+    def onPreviousPageClicked(self, event):
+        if self.database and self.database_pages:
+            self.showDatabasePage(self.database_pages.pop())
+
+    def onNextPageClicked(self, event):
+        after, last = self.database_page
+        if self.database and self.database.page(last, 1):
+            self.database_pages.append(after)
+            self.showDatabasePage(last)
+
+    def openDatabase(self, file_name):
+        """Browse a capture database page by page, only the shown page is held in memory"""
+        database = CaptureDatabase(file_name, read_only=True)
+        if self.database:
+            self.database.close()
+        # Completes the archive of offloaded exchanges
+        self.treeView.closeRing()
+        self.database = database
+        self.database_pages = []
+        self.showDatabasePage(0)
+        self.layout().setMenuBar(self.createMenu(QMenuBar()))
+
+    def showDatabasePage(self, after):
+        page = self.database.page(after, DATABASE_PAGE_SIZE)
+        self.treeView.clear()
+        for _, pair in page:
+            self.onReceived(pair)
+        self.database_page = (after, page[-1][0] if page else after)
+
     def load(self, file_name):
-        f = open(file_name, "rb")
-        for pair in parse_message_pairs(f):
+        if is_archive(file_name):
+            # Only the index is read, the bodies are read when they are displayed
+            for pair in ArchiveReader(file_name).request_responses():
+                self.onReceived(pair)
+            return
+
+        # The file is mapped to memory, the bodies are copied out of it when they are displayed. This is faster than
+        # parsing the bodies with bulk_load even on many cores, which would also keep all of them in memory.
+        for pair in map_message_pairs(file_name):
             self.onReceived(pair)
-        f.close()
 
     def save(self, file_name):
-        f = open(file_name, "wb")
-        serialize_message_pairs(self.treeView.getAllMessagePairs(), f)
+        # Loaded bodies may still point into a map of the file being replaced, so it must not be truncated
+        temp_name = file_name + ".tmp"
+        f = open(temp_name, "wb")
+        if file_name.endswith(EXTENSION):
+            with ArchiveWriter(f) as writer:
+                for pair in self.treeView.getAllMessagePairs():
+                    writer.add(pair)
+        else:
+            serialize_message_pairs(self.treeView.getAllMessagePairs(), f)
         f.close()
+        os.replace(temp_name, file_name)
 
     def closeEvent(self, QCloseEvent):
         if self.worker.status():
             self.worker.stop()
+        if self.database:
+            self.database.close()
+        # Completes the archive of offloaded exchanges
+        self.treeView.closeRing()
 
         self.settings.beginGroup("window")
         self.settings.setValue("geometry", self.saveGeometry())
         self.settings.endGroup()
 
+        self.settings.beginGroup("proxy")
+        self.settings.setValue("event_loop", self.event_loop)
+        self.settings.endGroup()
+
+        self.settings.beginGroup("search")
+        self.settings.setValue("bodies", self.search_bodies)
+        self.settings.endGroup()
+
         self.connection_config.saveSettings(self.settings)
+        self.capture_limits.saveSettings(self.settings)
         self.plugin_registry.save_settings(self.settings)
         super().closeEvent(QCloseEvent)
 
     def onReceived(self, rr: RequestResponse):
         self.treeView.onRequestResponse(rr)
 
+    def onReceivedBatch(self, request_responses):
+        self.treeView.onRequestResponses(request_responses)
+
     def onError(self, e: Exception):
         msg = QMessageBox()
         msg.setIcon(QMessageBox.Critical)
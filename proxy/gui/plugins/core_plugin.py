@@ -68,7 +68,11 @@ class CorePlugin(Plugin, GridPlugin, ContentViewPlugin, TabPlugin):
         headers = QTextEdit()
         if message:
             headers_list = (name.decode() + ": " + value.decode() for name, value in message.headers.items())
-            headers.setText(message.first_line().decode() + "\n".join(headers_list))
+            text = message.first_line().decode() + "\n".join(headers_list)
+            if message.trailers:
+                trailers_list = (name.decode() + ": " + value.decode() for name, value in message.trailers.items())
+                text += "\n\nTrailers:\n" + "\n".join(trailers_list)
+            headers.setText(text)
         headers.setReadOnly(True)
         return headers
 
@@ -0,0 +1,32 @@
+from proxy.gui.plugins.abstract_plugins import Plugin, GridPlugin
+
+
+def format_duration(seconds):
+    return "{:.1f} ms".format(seconds * 1000) if seconds is not None else None
+
+
+class TimingPlugin(Plugin, GridPlugin):
+    def __init__(self):
+        super().__init__("Timing plugin")
+
+    def get_columns(self):
+        return (
+            ("total_time", "Time"),
+            ("upstream_time", "Upstream"),
+            ("response_bytes", "Size"),
+            ("connection_id", "Connection")
+        )
+
+    def get_cell_content(self, data, column_id, value):
+        timing = data.timing
+        if not timing:
+            return None
+
+        if column_id == "total_time":
+            return format_duration(timing.total_time())
+        elif column_id == "upstream_time":
+            return format_duration(timing.upstream_time())
+        elif column_id == "response_bytes":
+            return str(timing.response_bytes) if timing.response_bytes is not None else None
+        elif column_id == "connection_id":
+            return str(timing.connection_id) if timing.connection_id is not None else None
@@ -0,0 +1,73 @@
+from PyQt5.QtCore import QSettings
+from PyQt5.QtWidgets import QDialog, QFormLayout, QLabel, QLineEdit, QPushButton, QSpinBox, QVBoxLayout, QHBoxLayout
+
+MIB = 1024 * 1024
+DEFAULT_MAX_MIB = 512
+
+
+class CaptureLimits:
+    """Limits of the exchanges kept in memory by the GUI, 0 is no limit"""
+
+    def __init__(self, max_count=0, max_mib=DEFAULT_MAX_MIB, offload_path=""):
+        self.max_count = max_count
+        self.max_mib = max_mib
+        self.offload_path = offload_path
+
+    def apply(self, tree_view):
+        tree_view.setCaptureLimits(self.max_count or None, self.max_mib * MIB if self.max_mib else None,
+                                   self.offload_path or None)
+
+    def saveSettings(self, settings: QSettings):
+        settings.beginGroup("capture")
+        settings.setValue("max_count", self.max_count)
+        settings.setValue("max_mib", self.max_mib)
+        settings.setValue("offload_path", self.offload_path)
+        settings.endGroup()
+
+    def restoreSettings(self, settings: QSettings):
+        settings.beginGroup("capture")
+        if settings.value("max_count", None) is not None:
+            self.max_count = int(settings.value("max_count"))
+        if settings.value("max_mib", None) is not None:
+            self.max_mib = int(settings.value("max_mib"))
+        self.offload_path = settings.value("offload_path", "") or ""
+        settings.endGroup()
+
+
+class CaptureLimitsDialog(QDialog):
+    def __init__(self, limits: CaptureLimits):
+        super().__init__()
+        self.setWindowTitle("Capture limits")
+
+        self.countEdit = QSpinBox()
+        self.countEdit.setRange(0, 100000000)
+        self.countEdit.setValue(limits.max_count)
+        self.countEdit.setSpecialValueText("No limit")
+        self.mibEdit = QSpinBox()
+        self.mibEdit.setRange(0, 1024 * 1024)
+        self.mibEdit.setSuffix(" MiB")
+        self.mibEdit.setValue(limits.max_mib)
+        self.mibEdit.setSpecialValueText("No limit")
+        self.offloadEdit = QLineEdit(limits.offload_path)
+        self.offloadEdit.setPlaceholderText("Evicted exchanges are dropped")
+
+        form = QFormLayout()
+        form.addRow(QLabel("Keep at most exchanges"), self.countEdit)
+        form.addRow(QLabel("Keep at most body bytes"), self.mibEdit)
+        form.addRow(QLabel("Offload evicted exchanges to archive"), self.offloadEdit)
+
+        buttons = QHBoxLayout()
+        ok = QPushButton("Ok")
+        ok.clicked.connect(self.accept)
+        cancel = QPushButton("Cancel")
+        cancel.clicked.connect(self.close)
+        buttons.addWidget(ok)
+        buttons.addWidget(cancel)
+
+        layout = QVBoxLayout()
+        layout.addLayout(form)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+
+    def limits(self):
+        return CaptureLimits(self.countEdit.value(), self.mibEdit.value(), self.offloadEdit.text().strip())
@@ -1,74 +1,259 @@
 from collections import OrderedDict
 
-from PyQt5.QtCore import pyqtSignal, QItemSelection, Qt, QSortFilterProxyModel
-from PyQt5.QtGui import QStandardItem, QStandardItemModel
-from PyQt5.QtWidgets import QTreeView, QWidget, QVBoxLayout, QLabel
+from PyQt5.QtCore import pyqtSignal, QAbstractItemModel, QItemSelection, QModelIndex, Qt, QSortFilterProxyModel, \
+    QTimer
+from PyQt5.QtWidgets import QTreeView, QWidget, QVBoxLayout, QLabel, QLineEdit, QHBoxLayout
+
+from proxy.pipe.blobs import BodyInterner
+from proxy.pipe.search import SearchIndex
+from proxy.pipe.store import CaptureRing
 
 ROLE_HTTP_MESSAGE = 45454
+# How often the results of a search are updated with the exchanges indexed since, in ms
+SEARCH_REFRESH_INTERVAL = 500
+
+
+class HttpMessagesModel(QAbstractItemModel):
+    """
+    Flat list of exchanges, the text of a cell is computed by the plugins when it is first displayed and then kept.
+    Appending a batch of exchanges is one insertion, evicting the oldest ones is one removal.
+    """
+
+    def __init__(self, plugin_registry, column_definitions):
+        super().__init__()
+        self.plugin_registry = plugin_registry
+        self.column_definitions = column_definitions
+        self.request_responses = []
+        # guid -> position of the exchange counted from the first one ever added, row = position - removed
+        self.positions = {}
+        self.removed = 0
+        # row guid -> texts of the cells computed so far, None for those not computed yet
+        self.cells = {}
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or not 0 <= row < len(self.request_responses):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=QModelIndex()):
+        return QModelIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.request_responses)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.column_definitions)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and section < len(self.column_definitions):
+            return self.column_definitions[section][1]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        request_response = self.request_responses[index.row()]
+        if role == ROLE_HTTP_MESSAGE:
+            return request_response
+        if role != Qt.DisplayRole:
+            return None
+
+        cells = self.cells.get(request_response.guid)
+        if cells is None:
+            cells = self.cells[request_response.guid] = [None] * len(self.column_definitions)
+        column = index.column()
+        if cells[column] is None:
+            column_id = self.column_definitions[column][0]
+            cells[column] = self.plugin_registry.get_cell_content(request_response, column_id) or ""
+        return cells[column]
+
+    def addRequestResponses(self, request_responses):
+        """Append the new exchanges, replace those already listed"""
+        new = []
+        for request_response in request_responses:
+            position = self.positions.get(request_response.guid)
+            if position is None:
+                self.positions[request_response.guid] = self.removed + len(self.request_responses) + len(new)
+                new.append(request_response)
+            elif position < self.removed + len(self.request_responses):
+                row = position - self.removed
+                self.request_responses[row] = request_response
+                self.cells.pop(request_response.guid, None)
+                self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+            else:
+                # Added earlier in the same batch
+                new[position - self.removed - len(self.request_responses)] = request_response
+
+        if new:
+            first = len(self.request_responses)
+            self.beginInsertRows(QModelIndex(), first, first + len(new) - 1)
+            self.request_responses.extend(new)
+            self.endInsertRows()
+
+    def removeRequestResponses(self, guids):
+        """Remove the rows of the exchanges, they are expected to be the first rows"""
+        rows = sorted(self.positions[guid] - self.removed for guid in guids if guid in self.positions)
+        if not rows:
+            return
+        if rows[-1] == len(rows) - 1:
+            self.beginRemoveRows(QModelIndex(), 0, len(rows) - 1)
+            for request_response in self.request_responses[:len(rows)]:
+                del self.positions[request_response.guid]
+                self.cells.pop(request_response.guid, None)
+            del self.request_responses[:len(rows)]
+            self.removed += len(rows)
+            self.endRemoveRows()
+            return
+
+        # Rows elsewhere, the positions of the following rows change
+        for row in reversed(rows):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            request_response = self.request_responses.pop(row)
+            self.cells.pop(request_response.guid, None)
+            self.endRemoveRows()
+        self.removed = 0
+        self.positions = {rr.guid: row for row, rr in enumerate(self.request_responses)}
+
+    def invalidateCells(self):
+        """Compute the cells again, e.g. after the settings of the plugins changed"""
+        self.cells = {}
+        if self.request_responses:
+            self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount() - 1, self.columnCount() - 1))
 
 
 class FilteredModel(QSortFilterProxyModel):
     def __init__(self, plugin_registry):
         super().__init__()
         self.plugin_registry = plugin_registry
+        # Ids of the exchanges found by the search, None shows all
+        self.search_results = None
 
     def filterAcceptsRow(self, source_row, source_parent):
         index = self.sourceModel().index(source_row, 0, source_parent)
         data = self.sourceModel().data(index, ROLE_HTTP_MESSAGE)
+        if self.search_results is not None and data.guid not in self.search_results:
+            return False
         return self.plugin_registry.filter_accepts_row(data)
 
 
 class HttpMessagesTreeView(QWidget):
     selected = pyqtSignal(object)
 
-    class ModelItem:
-        def __init__(self, model, branch):
-            self.branch = branch
-            self.model = model
-
     def __init__(self, plugin_registry, parent=None):
         super().__init__(parent)
         self.plugin_registry = plugin_registry
         self.tree_view = QTreeView()
         self.label = QLabel()
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("Search")
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.textChanged.connect(self.onSearchChanged)
+        self.search_index = SearchIndex()
+        self.search_version = None
+        self.search_timer = QTimer(self)
+        self.search_timer.setInterval(SEARCH_REFRESH_INTERVAL)
+        self.search_timer.timeout.connect(self.updateSearch)
+        # Exchanges kept in memory, see setCaptureLimits
+        self.ring = CaptureRing()
+        # While paused, the exchanges keep going to the ring, ids of those added or updated since are shown on resume
+        self.paused = False
+        self.held = OrderedDict()
+        self.column_definitions = self.plugin_registry.get_columns()
         self.clear()
+        self.tree_view.setUniformRowHeights(True)
+        self.columns_sized = False
 
-        self.column_definitions = self.plugin_registry.get_columns()
+        header = QHBoxLayout()
+        header.addWidget(self.label)
+        header.addWidget(self.search_edit)
 
         layout = QVBoxLayout()
-        layout.addWidget(self.label)
+        layout.addLayout(header)
         layout.addWidget(self.tree_view)
         layout.setContentsMargins(0, 0, 0, 0)
         self.setLayout(layout)
 
     def getAllMessagePairs(self):
-        return (item.model for item in self.__index.values())
+        return self.ring.request_responses()
+
+    def setCaptureLimits(self, max_count=None, max_bytes=None, offload_path=None):
+        """Limit the exchanges kept in memory, the oldest are evicted (or offloaded to an archive) first"""
+        pairs = list(self.ring.request_responses())
+        self.ring.close()
+        self.ring = CaptureRing(max_count, max_bytes, offload_path)
+        evicted = []
+        for pair in pairs:
+            evicted += self.ring.add(pair)
+        self.__removeRows(evicted)
+        self.label.setText(self.__getLabelText())
+
+    def closeRing(self):
+        self.ring.close()
 
     def clear(self):
-        self.model = QStandardItemModel()
+        self.model = HttpMessagesModel(self.plugin_registry, self.column_definitions)
         self.filteredModel = FilteredModel(self.plugin_registry)
         self.filteredModel.setSourceModel(self.model)
 
-        self.rootNode = self.model.invisibleRootItem()
-        self.__index = OrderedDict()
+        self.ring.clear()
+        self.held = OrderedDict()
+        # Identical bodies of the captured messages share one bytes object
+        self.bodies = BodyInterner()
+        self.search_index.clear()
+        self.search_version = None
         self.tree_view.setModel(self.filteredModel)
         self.label.setText(self.__getLabelText())
 
         self.tree_view.selectionModel().selectionChanged.connect(self.onSelectionChanged)
 
+    def setSearchBodies(self, enabled):
+        """Index the start of the bodies held in memory too, the exchanges in the ring are indexed again"""
+        if enabled == self.search_index.index_bodies:
+            return
+        self.search_index.index_bodies = enabled
+        self.search_index.clear()
+        for request_response in self.ring.request_responses():
+            self.search_index.add(request_response)
+        self.search_version = None
+
+    def onSearchChanged(self, text):
+        self.search_version = None
+        self.updateSearch()
+
+    def updateSearch(self):
+        """Filter the rows by the search, again whenever more exchanges have been indexed"""
+        query = self.search_edit.text()
+        if not query.strip():
+            self.search_timer.stop()
+            if self.filteredModel.search_results is not None:
+                self.filteredModel.search_results = None
+                self.refilter()
+            return
+
+        self.search_timer.start()
+        if self.search_version == self.search_index.version:
+            return
+        self.search_version = self.search_index.version
+        self.filteredModel.search_results = self.search_index.search(query)
+        self.refilter()
+
     def refresh(self):
+        """Compute the cells and filter the rows again, after the settings of the plugins changed"""
+        self.model.invalidateCells()
+        self.refilter()
+
+    def refilter(self):
         self.filteredModel.invalidateFilter()
         self.label.setText(self.__getLabelText())
 
-    def applyModel(self):
-        self.tree_view.setModel(self.filteredModel)
-        for i, column in enumerate(self.column_definitions):
-            self.model.setHeaderData(i, Qt.Horizontal, column[1]);
-        column_count = self.model.columnCount()
-        column_width = self.tree_view.width() / column_count
-        for col in range(0, column_count):
-            self.tree_view.setColumnWidth(col, column_width)
-        self.label.setText(self.__getLabelText())
+    def showEvent(self, event):
+        super().showEvent(event)
+        # The columns share the width the view has once it is shown
+        if not self.columns_sized:
+            self.columns_sized = True
+            column_width = self.tree_view.width() // len(self.column_definitions)
+            for col in range(len(self.column_definitions)):
+                self.tree_view.setColumnWidth(col, column_width)
 
     def onSelectionChanged(self, selection: QItemSelection):
         if selection.isEmpty():
@@ -79,27 +264,48 @@ class HttpMessagesTreeView(QWidget):
             self.selected.emit(data)
 
     def onRequestResponse(self, request_response):
-        new_row = request_response.guid not in self.__index
+        self.onRequestResponses([request_response])
 
-        if not new_row:
-            model_item = self.__index[request_response.guid]
-            branch = model_item.branch
-            model_item.model = request_response
+    def onRequestResponses(self, request_responses):
+        evicted = []
+        for request_response in request_responses:
+            self.bodies.intern_pair(request_response)
+            self.search_index.add(request_response)
+            evicted += self.ring.add(request_response)
+        if self.paused:
+            for request_response in request_responses:
+                self.held[request_response.guid] = None
         else:
-            branch = [QStandardItem() for x in self.column_definitions]
-            self.__index[request_response.guid] = HttpMessagesTreeView.ModelItem(request_response, branch)
+            self.model.addRequestResponses(request_responses)
+        self.__removeRows(evicted)
+        self.label.setText(self.__getLabelText())
 
-        branch[0].setData(request_response, ROLE_HTTP_MESSAGE)
+    def pause(self):
+        """Keep the rows as they are, the exchanges are still captured within the limits of the ring"""
+        self.paused = True
 
-        for i, column in enumerate(self.column_definitions):
-            text = self.plugin_registry.get_cell_content(request_response, column[0])
-            if text:
-                branch[i].setText(text)
+    def resume(self):
+        self.paused = False
+        held = [self.ring.get(guid) for guid in self.held]
+        self.held = OrderedDict()
+        self.model.addRequestResponses(held)
+        self.label.setText(self.__getLabelText())
 
-        if new_row:
-            self.rootNode.appendRow(branch)
-        self.applyModel()
+    def __removeRows(self, evicted):
+        """Remove the rows of evicted exchanges, which are the oldest ones, at once"""
+        # An exchange evicted and updated in the same batch is back in the ring
+        removed = {rr.guid: rr for rr in evicted if rr.guid not in self.ring}
+        for guid, request_response in removed.items():
+            self.search_index.remove(request_response)
+            self.bodies.release(guid)
+            self.held.pop(guid, None)
+        self.model.removeRequestResponses(set(removed))
 
     def __getLabelText(self):
-        return "Displaying <b>{}</b> out of <b>{}</b>.".format(self.filteredModel.rowCount(),
-                                                               self.model.rowCount())
+        text = "Displaying <b>{}</b> out of <b>{}</b>, bodies take {:.1f} MiB.".format(
+            self.filteredModel.rowCount(), self.model.rowCount(), self.ring.body_bytes / (1024 * 1024))
+        if self.ring.evicted:
+            text += " Evicted <b>{}</b>.".format(self.ring.evicted)
+        if self.search_index.dropped:
+            text += " Not searchable <b>{}</b>.".format(self.search_index.dropped)
+        return text
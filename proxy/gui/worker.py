@@ -1,21 +1,50 @@
-from PyQt5.QtCore import QObject, pyqtSignal
+import threading
+import time
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, pyqtSignal, QTimer
 from proxy.pipe.communication import MessageListener, RequestResponse
 
 from proxy.pipe import apipe
 from proxy.pipe.apipe import ProxyParameters
+from proxy.pipe.event_loop import LOOP_AUTO
+
+# How often the buffered exchanges are passed to the GUI, in ms
+FLUSH_INTERVAL = 100
 
 
 class Worker(QObject, MessageListener):
-    received = pyqtSignal(RequestResponse)
+    """
+    Runs the proxy and buffers the exchanges it reports. The GUI gets them in one received_batch signal
+    every FLUSH_INTERVAL, with the reports of the same exchange merged.
+    """
+
+    received_batch = pyqtSignal(list)
     error = pyqtSignal(Exception)
     running_changed = pyqtSignal(bool)
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, event_loop=LOOP_AUTO):
         super().__init__(parent)
-        self.thread = apipe.PipeThread(self)
+        self.event_loop = event_loop
+        self.thread = apipe.PipeThread(self, event_loop)
         self.parameters = None
+        # guid -> the latest report of the exchange, in the order the exchanges were first reported
+        self.__pending = OrderedDict()
+        self.__lock = threading.Lock()
+        # Exchanges completed so far, for the rate. An exchange is reported once more when its response arrives,
+        # so only the reports with a response are counted.
+        self.completed = 0
+        self.__rate_sample = (time.monotonic(), 0)
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setInterval(FLUSH_INTERVAL)
+        self.flush_timer.timeout.connect(self.flush)
+        self.flush_timer.start()
 
     def start(self):
+        if self.thread.event_loop != self.event_loop:
+            # A thread runs a single event loop, another loop takes another thread
+            self.thread.shutdown()
+            self.thread = apipe.PipeThread(self, self.event_loop)
         if not self.thread.is_alive():
             self.thread.start()
 
@@ -35,11 +64,42 @@ class Worker(QObject, MessageListener):
         return self.thread.is_running()
 
     def on_request_response(self, request_response: RequestResponse):
-        self.received.emit(request_response)
+        self.on_request_responses([request_response])
+
+    def on_request_responses(self, request_responses):
+        # Called on the dispatcher thread, only the timer of the GUI thread signals
+        with self.__lock:
+            for request_response in request_responses:
+                self.__pending[request_response.guid] = request_response
+                if request_response.response is not None:
+                    self.completed += 1
+
+    def pending(self):
+        return len(self.__pending)
+
+    def flush(self):
+        """Signal the buffered exchanges"""
+        if not self.__pending:
+            return
+        with self.__lock:
+            batch = list(self.__pending.values())
+            self.__pending = OrderedDict()
+        self.received_batch.emit(batch)
+
+    def rate(self):
+        """Exchanges completed per second since the previous call"""
+        now = time.monotonic()
+        since, completed = self.__rate_sample
+        self.__rate_sample = (now, self.completed)
+        return (self.completed - completed) / (now - since) if now > since else 0.0
 
     def on_error(self, error):
         self.stop()
         self.error.emit(error)
 
+    def setEventLoop(self, event_loop):
+        """The event loop used from the next start, a running proxy keeps its loop until it is restarted"""
+        self.event_loop = event_loop
+
     def setParameters(self, parameters: ProxyParameters):
         self.parameters = parameters
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Headless proxy that writes the captured exchanges to disk in the format of proxy.pipe.persistence,
+to a SQLite database (proxy.pipe.sqlite_store), or both.
+
+Usage: python -m proxy.headless 0.0.0.0:8888 www.example.com:80 --capture capture.dat
+       python -m proxy.headless 0.0.0.0:8888 www.example.com:80 --database capture.db
+
+Never import proxy.gui here, the headless proxy must run without Qt.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+
+from proxy.pipe.apipe import build_argument_parser, parse_proxy_parameters, prepare_server
+from proxy.pipe.channel import ChannelRegistry
+from proxy.pipe.communication import MessageListener
+from proxy.pipe.event_loop import create_event_loop
+from proxy.pipe.metrics import MetricsListener, ProxyMetrics, start_metrics_server
+from proxy.pipe.persistence import serialize_message_pair
+from proxy.pipe.sqlite_store import CaptureDatabase
+
+DEFAULT_BACKUP_COUNT = 5
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+logger = logging.getLogger('proxy')
+
+
+class CompleteExchangeFilter(MessageListener):
+    """
+    Passes on only the exchanges that have a response. The pairer reports every exchange once with its response,
+    so each of them is passed on exactly once.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def on_request_response(self, request_response):
+        if request_response.response is not None:
+            self.listener.on_request_response(request_response)
+
+    def on_error(self, error):
+        self.listener.on_error(error)
+
+
+class ListenerGroup(MessageListener):
+    """Passes the exchanges on to several listeners"""
+
+    def __init__(self, listeners):
+        self.listeners = listeners
+
+    def on_request_response(self, request_response):
+        self.on_request_responses([request_response])
+
+    def on_request_responses(self, request_responses):
+        for listener in self.listeners:
+            listener.on_request_responses(request_responses)
+
+    def on_error(self, error):
+        for listener in self.listeners:
+            listener.on_error(error)
+
+
+class CaptureWriter(MessageListener):
+    """
+    Appends the exchanges to a capture file through a large write buffer, which is flushed after every batch.
+
+    Once the file reaches max_bytes, it is renamed to path.1 (path.1 to path.2 and so on, keeping backup_count
+    old files) and a new file is started. Without max_bytes the file grows without limit.
+    """
+
+    def __init__(self, path, max_bytes=None, backup_count=DEFAULT_BACKUP_COUNT, buffer_size=WRITE_BUFFER_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.written = 0
+        self.stream = self.__open()
+
+    def __open(self):
+        return open(self.path, "ab", buffering=self.buffer_size)
+
+    def on_request_response(self, request_response):
+        self.on_request_responses([request_response])
+
+    def on_request_responses(self, request_responses):
+        for request_response in request_responses:
+            serialize_message_pair(request_response, self.stream)
+            self.written += 1
+        self.stream.flush()
+        if self.max_bytes and self.stream.tell() >= self.max_bytes:
+            self.rotate()
+
+    def on_error(self, error):
+        logger.error('capture error {}'.format(error))
+
+    def rotate(self):
+        self.stream.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = "{}.{}".format(self.path, i)
+                if os.path.exists(source):
+                    os.replace(source, "{}.{}".format(self.path, i + 1))
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.stream = self.__open()
+
+    def close(self):
+        self.stream.close()
+
+
+def build_headless_argument_parser():
+    parser = build_argument_parser()
+    parser.description = "HTTP proxy that writes the exchanged messages to a capture file"
+    parser.add_argument("--capture", default=None, metavar="PATH",
+                        help="file to append the captured exchanges to")
+    parser.add_argument("--database", default=None, metavar="PATH",
+                        help="SQLite database to store the captured exchanges in")
+    parser.add_argument("--body-dir", default=None, metavar="DIR",
+                        help="store large bodies of the database in files in this directory")
+    parser.add_argument("--max-file-size", type=int, default=None, metavar="BYTES",
+                        help="start a new capture file once the current one reaches this size")
+    parser.add_argument("--max-files", type=int, default=DEFAULT_BACKUP_COUNT, metavar="COUNT",
+                        help="number of full capture files kept besides the current one")
+    return parser
+
+
+def main():
+    parser = build_headless_argument_parser()
+    args = parser.parse_args()
+    if args.workers > 1:
+        parser.error("--workers is not supported by the headless proxy")
+    if not args.capture and not args.database:
+        parser.error("--capture or --database is required")
+    proxy_parameters = parse_proxy_parameters(args)
+
+    outputs = []
+    if args.capture:
+        outputs.append(CaptureWriter(args.capture, args.max_file_size, args.max_files))
+    if args.database:
+        outputs.append(CaptureDatabase(args.database, args.body_dir))
+    # The capture is written on the dispatcher thread
+    dispatcher = proxy_parameters.create_dispatcher(outputs[0] if len(outputs) == 1 else ListenerGroup(outputs))
+    listener = CompleteExchangeFilter(dispatcher)
+
+    loop = create_event_loop(args.loop)
+    asyncio.set_event_loop(loop)
+    channels = ChannelRegistry()
+    metrics = None
+    if proxy_parameters.metrics_address:
+        metrics = ProxyMetrics(channels, dispatcher=dispatcher)
+        listener = MetricsListener(listener, metrics)
+        loop.run_until_complete(start_metrics_server(metrics, *proxy_parameters.metrics_address))
+    server = loop.run_until_complete(prepare_server(proxy_parameters, listener, channels=channels, metrics=metrics))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        dispatcher.stop()
+        for output in outputs:
+            output.close()
+        logger.info('captured {} exchanges'.format(dispatcher.delivered))
+
+
+if __name__ == '__main__':
+    main()
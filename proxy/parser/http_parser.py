@@ -1,16 +1,153 @@
 import gzip
-from collections import OrderedDict
+from array import array
+from collections.abc import MutableMapping
 
-from proxy.parser.parser_utils import get_bytes, get_word, get_rest, get_until
+from proxy.parser.parser_utils import get_bytes, get_rest, get_line, get_more, get_until
 
 CRLF = "\r\n"
+WHITESPACE = (ord(" "), ord("\t"))
+
+# How the end of a message body is determined, see RFC 7230, section 3.3.3
+BODY_NONE = "none"
+BODY_LENGTH = "length"
+BODY_CHUNKED = "chunked"
+BODY_UNTIL_CLOSE = "until-close"
+
+
+class HttpHeaders(MutableMapping):
+    """
+    Header section backed by the bytes it was parsed from.
+
+    Lookups are case-insensitive. The (name, value) offsets into the raw bytes are indexed when the headers
+    are first read, and the headers are copied out of the raw bytes only once they are modified.
+    Repeated headers are kept, lookups return the first one.
+    """
+    __slots__ = ("__raw", "__start", "__index", "__items")
+
+    def __init__(self, raw=b"", start=0):
+        self.__raw = raw
+        self.__start = start
+        self.__index = None
+        self.__items = None
+
+    @property
+    def modified(self):
+        return self.__items is not None
+
+    def __get_index(self):
+        if self.__index is None:
+            raw = self.__raw
+            index = array("I")
+            pos = self.__start
+            end = len(raw)
+            while pos < end:
+                line_end = raw.find(b"\r\n", pos)
+                if line_end < 0:
+                    line_end = end
+                if line_end == pos:
+                    break
+                if raw[pos] in WHITESPACE and index:
+                    # Obsolete line folding, the value continues on this line
+                    index[-1] = line_end
+                else:
+                    colon = raw.find(b":", pos, line_end)
+                    if colon >= 0:
+                        value_start = colon + 1
+                        while value_start < line_end and raw[value_start] in WHITESPACE:
+                            value_start += 1
+                        index.extend((pos, colon, value_start, line_end))
+                    else:
+                        print(b"Strange header: " + raw[pos:line_end])
+                pos = line_end + 2
+            self.__index = index
+        return self.__index
+
+    def __find(self, name):
+        name = name.lower()
+        length = len(name)
+        if self.__items is not None:
+            for i, (key, value) in enumerate(self.__items):
+                if len(key) == length and key.lower() == name:
+                    return i, value
+        else:
+            raw = self.__raw
+            index = self.__get_index()
+            for i in range(0, len(index), 4):
+                if index[i + 1] - index[i] == length and raw[index[i]:index[i + 1]].lower() == name:
+                    return i // 4, raw[index[i + 2]:index[i + 3]]
+        return -1, None
+
+    def __materialize(self):
+        if self.__items is None:
+            self.__items = list(self.items())
+            self.__raw = b""
+            self.__index = None
+        return self.__items
+
+    def items(self):
+        if self.__items is not None:
+            yield from self.__items
+        else:
+            raw = self.__raw
+            index = self.__get_index()
+            for i in range(0, len(index), 4):
+                yield raw[index[i]:index[i + 1]], raw[index[i + 2]:index[i + 3]]
+
+    def get(self, name, default=None):
+        _, value = self.__find(name)
+        return default if value is None else value
+
+    def __getitem__(self, name):
+        _, value = self.__find(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.__find(name)[1] is not None
+
+    def __setitem__(self, name, value):
+        position, old_value = self.__find(name)
+        if old_value == value:
+            return
+        items = self.__materialize()
+        if position >= 0:
+            items[position] = (items[position][0], value)
+        else:
+            items.append((name, value))
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        name = name.lower()
+        self.__items = [(key, value) for key, value in self.__materialize() if key.lower() != name]
+
+    def __iter__(self):
+        return (name for name, _ in self.items())
+
+    def __len__(self):
+        if self.__items is not None:
+            return len(self.__items)
+        return len(self.__get_index()) // 4
+
+    def __repr__(self):
+        return "HttpHeaders(%r)" % list(self.items())
 
 
 class HttpMessage:
+    """
+    HTTP message as it was parsed.
+    The raw head is kept and forwarded as is, unless the headers get modified. The first line attributes
+    (method, path, status, ...) are the result of parsing, changing them does not affect the raw head.
+    """
+    __slots__ = ("version", "headers", "trailers", "body", "head", "__body_as_text")
+
     def __init__(self):
         self.version = None
-        self.headers = OrderedDict()
+        self.headers = HttpHeaders()
+        self.trailers = None
         self.body = None
+        self.head = None
         self.__body_as_text = None
 
     def is_text(self):
@@ -20,6 +157,10 @@ class HttpMessage:
     def get_content_type(self):
         return self.headers.get(b"Content-Type", b"")
 
+    def is_chunked(self):
+        codings = self.headers.get(b"Transfer-Encoding", b"")
+        return codings.rsplit(b",", 1)[-1].strip().lower() == b"chunked"
+
     def get_charset(self):
         """
         Get charset from Content-Encoding header.
@@ -46,14 +187,45 @@ class HttpMessage:
 
         return data
 
-    def to_bytes(self):
-        data = self.first_line()
-        yield data
+    def raw_head_valid(self):
+        return self.head is not None and not self.headers.modified
+
+    def head_to_bytes(self):
+        if self.raw_head_valid():
+            yield self.head
+            return
+        yield self.first_line()
         for name, value in self.headers.items():
             yield b"%s: %s\r\n" % (name, value)
         yield b"\r\n"
+
+    def to_bytes(self):
+        yield from self.head_to_bytes()
         if self.has_body():
-            yield self.body
+            if self.is_chunked():
+                if self.body:
+                    yield encode_chunk(self.body)
+                yield encode_last_chunk(self.trailers)
+            elif self.body is not None:
+                yield self.body
+
+    def body_framing(self):
+        if not self.has_body():
+            return BODY_NONE
+        if b"Transfer-Encoding" in self.headers:
+            # Transfer-Encoding overrides Content-Length. Unless chunked is the final coding,
+            # a request is invalid and a response is delimited by closing the connection.
+            return BODY_CHUNKED if self.is_chunked() else BODY_UNTIL_CLOSE
+        if b"Content-Length" in self.headers:
+            return BODY_LENGTH
+        return BODY_UNTIL_CLOSE
+
+    def content_length(self):
+        # Repeated Content-Length headers folded into one are accepted if they agree
+        values = set(value.strip() for value in self.headers[b"Content-Length"].split(b","))
+        if len(values) != 1:
+            raise ValueError("Conflicting Content-Length: %s" % values)
+        return int(values.pop())
 
     def body_as_text(self):
         if self.__body_as_text:
@@ -81,53 +253,189 @@ class HttpMessage:
 
 
 class HttpRequest(HttpMessage):
+    __slots__ = ("method", "path")
+
     def __init__(self):
         super().__init__()
         self.method = None
         self.path = None
 
     def has_body(self):
-        return self.method in (b"POST", b"PUT", b"PATCH")
+        # A request has a body only when it is announced by the framing headers
+        return b"Content-Length" in self.headers or b"Transfer-Encoding" in self.headers
 
     def first_line(self):
+        if self.head is not None:
+            return self.head[:self.head.find(b"\r\n") + 2]
         return b"%s %s %s\r\n" % (self.method, self.path, self.version)
 
 
 class HttpResponse(HttpMessage):
+    __slots__ = ("status_message", "status", "request_method")
+
     def __init__(self):
         super().__init__()
         self.status_message = None
         self.status = None
+        # Method of the request this response answers, if known
+        self.request_method = None
 
-    def has_body(self):
-        if b"Content-Length" in self.headers:
-            return True
-        if b"Transfer-Encoding" in self.headers:
-            return True
+    def is_informational(self):
+        return self.status is not None and self.status[:1] == b"1"
 
-        return self.status in (b"200", b"404")  # TODO: Add all codes that have bodies
+    def has_body(self):
+        if self.request_method == b"HEAD":
+            return False
+        if self.is_informational() or self.status in (b"204", b"304"):
+            return False
+        return True
 
     def first_line(self):
+        if self.head is not None:
+            return self.head[:self.head.find(b"\r\n") + 2]
         return b"%s %s %s\r\n" % (self.version, self.status, self.status_message)
 
 
-def get_http_request(data):
-    message, data = yield from get_firstline(data)
-    message.headers, data = yield from get_headers(data)
-    if message.has_body():
-        if b"Content-Length" in message.headers:
-            message.body, data = yield from get_bytes(data, int(message.headers[b"Content-Length"]))
-        elif message.headers.get(b"Transfer-Encoding", None) == b"chunked":
-            message.body, data = yield from get_chunked_body(data)
-            # TODO: Parse trailing headers
-        else:
-            message.body, data = yield from get_rest(data)
+class LazyBody:
+    """
+    Mixin of messages whose body is read only when it is first accessed, e.g. from a capture file.
+    body_loader returns the body and the trailers.
+    """
+    __slots__ = ()
+
+    @property
+    def body(self):
+        loader = self.body_loader
+        if loader is not None:
+            self.body_loader = None
+            body, self.trailers = loader()
+            _BODY.__set__(self, body)
+        return _BODY.__get__(self, type(self))
+
+    @body.setter
+    def body(self, value):
+        self.body_loader = None
+        _BODY.__set__(self, value)
+
+
+_BODY = HttpMessage.body
+
+
+class LazyHttpRequest(LazyBody, HttpRequest):
+    __slots__ = ("body_loader",)
+
+
+class LazyHttpResponse(LazyBody, HttpResponse):
+    __slots__ = ("body_loader",)
+
+
+def track_request_method(message, request_methods):
+    """
+    Pair responses with the methods of the requests they answer, which decide whether the response has a body.
+    Requests append their method to request_methods, final (non 1xx) responses take the oldest one.
+    """
+    if request_methods is None:
+        return
+    if isinstance(message, HttpRequest):
+        request_methods.append(message.method)
+    elif message.is_informational():
+        message.request_method = request_methods[0] if request_methods else None
+    else:
+        message.request_method = request_methods.popleft() if request_methods else None
+
+
+def get_http_request(data, request_methods=None, get_until_close=get_rest):
+    """get_until_close reads a body delimited by the end of the connection, the whole rest by default"""
+    message, data = yield from get_head(data)
+    track_request_method(message, request_methods)
+    framing = message.body_framing()
+    if framing == BODY_LENGTH:
+        message.body, data = yield from get_bytes(data, message.content_length())
+    elif framing == BODY_CHUNKED:
+        message.body, data = yield from get_chunked_body(data)
+        message.trailers, data = yield from get_headers(data)
+    elif framing == BODY_UNTIL_CLOSE:
+        message.body, data = yield from get_until_close(data)
 
     return message, data
 
 
-def get_line(data):
-    return get_until(data, b"\r\n")
+class MessageHead:
+    """Streaming event: the head of the message has been parsed, the body (if any) follows"""
+
+    def __init__(self, message):
+        self.message = message
+
+
+class MessageBody:
+    """Streaming event: a piece of the message body, as it was received (without chunked framing)"""
+
+    def __init__(self, message, data):
+        self.message = message
+        self.data = data
+
+
+class MessageEnd:
+    """Streaming event: the message is complete"""
+
+    def __init__(self, message):
+        self.message = message
+
+
+def get_http_stream(data, request_methods=None):
+    """
+    Parse a HTTP message without buffering its body.
+    MessageHead is emitted as soon as the head is parsed and MessageBody for every piece of the body
+    as it arrives. Chunked bodies are emitted piece by piece as well, the trailers are parsed into
+    the message before MessageEnd. The parsed pieces are not kept in the message, its body stays None.
+    """
+    message, data = yield from get_head(data)
+    track_request_method(message, request_methods)
+    framing = message.body_framing()
+    if framing == BODY_NONE:
+        data = yield from get_more(data, MessageHead(message))
+    elif framing == BODY_LENGTH:
+        data = yield from get_more(data, MessageHead(message))
+        data = yield from stream_bytes(data, message, message.content_length())
+    elif framing == BODY_CHUNKED:
+        data = yield from get_more(data, MessageHead(message))
+        chunk_size, data = yield from get_chunk_size(data)
+        while chunk_size > 0:
+            data = yield from stream_bytes(data, message, chunk_size)
+            _, data = yield from get_line(data)  # read the trailing CRLF
+            chunk_size, data = yield from get_chunk_size(data)
+        message.trailers, data = yield from get_headers(data)
+    else:
+        data = yield from get_more(data, MessageHead(message))
+        while True:
+            if data:
+                data = yield from get_more(data, MessageBody(message, data.take_all()))
+            moredata = yield
+            if not moredata:
+                break
+            data.extend(moredata)
+
+    return MessageEnd(message), data
+
+
+def stream_bytes(data, message, count):
+    while count > 0:
+        while not data:
+            data = yield from get_more(data)
+        piece = data.take(min(count, len(data)))
+        count -= len(piece)
+        data = yield from get_more(data, MessageBody(message, piece))
+    return data
+
+
+def encode_chunk(data):
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+def encode_last_chunk(trailers):
+    if not trailers:
+        return b"0\r\n\r\n"
+    return b"0\r\n" + b"".join(b"%s: %s\r\n" % (name, value) for name, value in trailers.items()) + b"\r\n"
 
 
 def parse_http_version(version):
@@ -137,63 +445,72 @@ def parse_http_version(version):
         return None
 
 
-def get_firstline(data):
-    method, data = yield from get_word(data)
-    method = method.upper()
-    version = parse_http_version(method)
+def parse_head(head, request_class=HttpRequest, response_class=HttpResponse):
+    """Parse the first line of a raw message head, the headers are parsed lazily by HttpHeaders"""
+    line_end = head.find(b"\r\n")
+    parts = head[:line_end].split(None, 2)
+    first = parts[0].upper() if parts else b""
+    version = parse_http_version(first)
     if version:
-        response = HttpResponse()
-        response.version = version
-        response.status, data = yield from get_word(data)
-        response.status_message, data = yield from get_line(data)
+        message = response_class()
+        message.version = version
+        message.status = parts[1] if len(parts) > 1 else b""
+        message.status_message = parts[2] if len(parts) > 2 else b""
+    else:
+        message = request_class()
+        message.method = first
+        message.path = parts[1] if len(parts) > 1 else b""
+        message.version = parse_http_version(parts[2]) if len(parts) > 2 else None
+    message.head = head
+    message.headers = HttpHeaders(head, line_end + 2)
+    return message
 
-        response.status = response.status
-        response.status_message = response.status_message
 
-        return response, data
-    else:
-        request = HttpRequest()
-        request.method = method
-        path, data = yield from get_word(data)
-        request.path = path
-        version_str, data = yield from get_word(data)
-        request.version = parse_http_version(version_str)
-        return request, data
+def skip_empty_lines(data):
+    # Empty lines preceding a message are ignored (RFC 7230, section 3.5)
+    while True:
+        while len(data) < 2:
+            data = yield from get_more(data)
+        if data[0:2] != b"\r\n":
+            return data
+        data.skip(2)
+
+
+def get_head(data):
+    data = yield from skip_empty_lines(data)
+    head, data = yield from get_until(data, b"\r\n\r\n")
+    return parse_head(head + b"\r\n\r\n"), data
 
 
 def get_headers(data):
-    headers = OrderedDict()
-    line, data = yield from get_line(data)
-    name = None
-    value = None
-    while line:
-        if line[0] in (b" ", b"\t") and name:
-            # TODO: Double check this logic here, it may leave unwanted characters
-            value = value + line
-            headers[name] = value
-        else:
-            parts = line.split(b":", 1)
-            if len(parts) == 2:
-                headers[parts[0]] = parts[1].lstrip()
-            else:
-                print(b"Strange header: " + line)
-        line, data = yield from get_line(data)
+    """Read a header section (e.g. chunked trailers) terminated by an empty line"""
+    while len(data) < 2:
+        data = yield from get_more(data)
+    if data[0:2] == b"\r\n":
+        data.skip(2)
+        return HttpHeaders(), data
 
-    return headers, data
+    block, data = yield from get_until(data, b"\r\n\r\n")
+    return HttpHeaders(block + b"\r\n\r\n"), data
+
+
+def get_chunk_size(data):
+    line, data = yield from get_line(data)
+    # Chunk extensions are ignored
+    return int(line.split(b";", 1)[0].strip(), 16), data
 
 
 def get_chunked_body(data):
-    chunk_size, data = yield from get_line(data)
-    chunk_size = int(chunk_size, 16)
+    """
+    Read chunks up to and including the last (zero-sized) one.
+    The trailer section that follows is left in data, to be read with get_headers.
+    """
+    chunk_size, data = yield from get_chunk_size(data)
     body = []
     while chunk_size > 0:
-        chunk, data = yield from get_bytes(data, int(chunk_size))
+        chunk, data = yield from get_bytes(data, chunk_size)
         body.append(chunk)
         _, data = yield from get_line(data)  # read the trailing CRLF
-        chunk_size, data = yield from get_line(data)
-        chunk_size = int(chunk_size, 16)
-
-    assert chunk_size == 0
-    _, data = yield from get_line(data)  # read the trailing CRLF
+        chunk_size, data = yield from get_chunk_size(data)
 
     return b"".join(body), data
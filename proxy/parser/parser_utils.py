@@ -1,5 +1,83 @@
 SPACES = [ord(x) for x in " \t\r\n"]
 
+# Consumed bytes are dropped from the front of the buffer only once they outweigh the unread part,
+# so that compaction stays amortized O(1) per byte.
+COMPACT_THRESHOLD = 65536
+
+
+class ReceiveBuffer:
+    """
+    Growable receive buffer shared by all parser primitives.
+
+    Incoming data is appended to a single bytearray and a read cursor marks the start of unconsumed data,
+    so neither receiving more data nor consuming a part of it copies the rest of the buffer.
+    Indexes passed to and returned from the methods are relative to the read cursor.
+    """
+    __slots__ = ("__data", "__pos")
+
+    def __init__(self, data=b""):
+        self.__data = bytearray(data)
+        self.__pos = 0
+
+    def __len__(self):
+        return len(self.__data) - self.__pos
+
+    def __bool__(self):
+        return len(self.__data) > self.__pos
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1
+            return self.peek(start, stop)
+        if index < 0:
+            index += len(self)
+        return self.__data[self.__pos + index]
+
+    def __eq__(self, other):
+        return bytes(self) == other
+
+    def __bytes__(self):
+        return self.peek(0, len(self))
+
+    def __repr__(self):
+        return "ReceiveBuffer(%r)" % bytes(self)
+
+    def extend(self, data):
+        if not data:
+            return
+        if self.__pos >= COMPACT_THRESHOLD and self.__pos * 2 >= len(self.__data):
+            del self.__data[:self.__pos]
+            self.__pos = 0
+        self.__data += data
+
+    def find(self, sub, start=0):
+        index = self.__data.find(sub, self.__pos + start)
+        return index - self.__pos if index >= 0 else -1
+
+    def peek(self, start, stop):
+        """Copy the bytes between the relative indexes start and stop without consuming them"""
+        with memoryview(self.__data) as view:
+            return bytes(view[self.__pos + start:self.__pos + stop])
+
+    def take(self, count):
+        """Consume count bytes and return them"""
+        data = self.peek(0, count)
+        self.skip(count)
+        return data
+
+    def take_all(self):
+        return self.take(len(self))
+
+    def skip(self, count):
+        self.__pos = min(self.__pos + count, len(self.__data))
+        if self.__pos == len(self.__data):
+            self.clear()
+
+    def clear(self):
+        self.__data.clear()
+        self.__pos = 0
+
 
 def parse(parser, data):
     result = parser.send(data)
@@ -9,8 +87,10 @@ def parse(parser, data):
 
 
 def get_main_loop(parser_func):
-    def main_loop():
-        data = yield None
+    def main_loop(data=None):
+        if data is None:
+            data = ReceiveBuffer()
+        data.extend((yield None))
         while True:
             result, data = yield from parser_func(data)
             data = yield from get_more(data, result)
@@ -18,15 +98,24 @@ def get_main_loop(parser_func):
     return main_loop
 
 
-def intialize_parser(parser_func):
-    parser = get_main_loop(parser_func)()
+def intialize_parser(parser_func, buffer=None):
+    """Start a parser, the caller may pass its own ReceiveBuffer to see how much data the parser holds"""
+    parser = get_main_loop(parser_func)(buffer)
     next(parser)
     return parser
 
 
-def get_word(data: str):
-    while not data:
-        data = yield from get_more(data)
+def get_word(data: ReceiveBuffer):
+    """
+    Read a word ended by a space. The spaces before it are skipped, and so are the spaces after it that have been
+    received already, so that a word at the end of the input is returned without waiting for more.
+    """
+    while True:
+        while not data:
+            data = yield from get_more(data)
+        if data[0] not in SPACES:
+            break
+        data.skip(1)
 
     lindex = 0
     while data[lindex] not in SPACES:
@@ -35,45 +124,49 @@ def get_word(data: str):
             data = yield from get_more(data)
 
     rindex = lindex
-    while data[rindex] in SPACES:
+    while rindex < len(data) and data[rindex] in SPACES:
         rindex += 1
-        while len(data) <= rindex:
-            data = yield from get_more(data)
 
-    return data[:lindex], data[rindex:]
+    word = data.take(lindex)
+    data.skip(rindex - lindex)
+    return word, data
 
 
-def get_until(data, delimiter):
-    index = -1
+def get_until(data: ReceiveBuffer, delimiter):
+    start = 0
+    index = data.find(delimiter)
     while index < 0:
-        index = data.find(delimiter)
-        if index < 0:
-            data = yield from get_more(data)
+        # Do not rescan the part that has already been searched, only allow for a delimiter split between reads
+        start = max(0, len(data) - len(delimiter) + 1)
+        data = yield from get_more(data)
+        index = data.find(delimiter, start)
 
-    return data[:index], data[index + len(delimiter):]
+    result = data.take(index)
+    data.skip(len(delimiter))
+    return result, data
 
 
-def get_bytes(data, count):
-    while (len(data) < count):
+def get_bytes(data: ReceiveBuffer, count):
+    while len(data) < count:
         data = yield from get_more(data)
 
-    return data[:count], data[count:]
+    return data.take(count), data
 
 
-def get_rest(data):
+def get_rest(data: ReceiveBuffer):
     moredata = yield
     while moredata:
-        data += moredata
+        data.extend(moredata)
         moredata = yield
 
-    return data, ""
+    return data.take_all(), data
+
 
+def get_line(data: ReceiveBuffer):
+    return get_until(data, b"\r\n")
 
-def get_more(data, result=None):
+
+def get_more(data: ReceiveBuffer, result=None):
     moredata = yield result
-    if data and moredata:
-        return data + moredata
-    elif moredata:
-        return moredata
-    else:
-        return data
+    data.extend(moredata)
+    return data
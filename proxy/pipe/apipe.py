@@ -2,27 +2,101 @@
 
 # Based on https://github.com/aaronriekenberg/asyncioproxy/blob/master/proxy.py
 
+import argparse
 import asyncio
+import collections
+import functools
+import itertools
 import logging
 import sys
 import threading
+import time
 from threading import Thread
 
-from proxy.parser.parser_utils import intialize_parser, parse
-from proxy.pipe.communication import MessageListener, MessagePairer, MessageProcessor
+from proxy.parser.parser_utils import ReceiveBuffer, intialize_parser, parse
+from proxy.pipe.capture import CaptureTap, DEFAULT_QUEUE_SIZE
+from proxy.pipe.channel import BUFFER_SIZE, Channel, ChannelRegistry, MessageClock, set_write_buffer_limits
+from proxy.pipe.communication import MessageListener, MessagePairer, MessageProcessor, Timing
+from proxy.pipe import dispatch, pool
+from proxy.pipe.passthrough import RawRewriter
+from proxy.pipe.metrics import MetricsListener, ProxyMetrics, start_metrics_server
+from proxy.pipe.event_loop import create_event_loop, EVENT_LOOPS, LOOP_AUTO
+from proxy.pipe.workers import ProxyWorkers
 
 from proxy.parser import http_parser
 
-BUFFER_SIZE = 65536
 CONNECT_TIMEOUT_SECONDS = 5
+# Requests that may be sent again when a pooled connection turns out to be closed, see RFC 7230, section 6.3.1
+IDEMPOTENT_METHODS = (b"GET", b"HEAD", b"OPTIONS", b"TRACE", b"PUT", b"DELETE")
+# In streaming mode, bytes of every body kept for the listener unless configured otherwise
+DEFAULT_MAX_CAPTURE_BODY = 10 * 1024 * 1024
+# Identifies the client connection of every exchange
+CONNECTION_IDS = itertools.count(1)
 
 
 class ProxyParameters():
-    def __init__(self, local_address, local_port, remote_address, remote_port):
+    def __init__(self, local_address, local_port, remote_address, remote_port, streaming=False,
+                 max_capture_body=DEFAULT_MAX_CAPTURE_BODY, preserve_chunked=True, rewrite_headers=True,
+                 raw_passthrough=False, capture_queue_size=DEFAULT_QUEUE_SIZE, upstream_pool=False,
+                 pool_max_size=pool.DEFAULT_MAX_SIZE,
+                 pool_max_idle=pool.DEFAULT_MAX_IDLE, pool_idle_timeout=pool.DEFAULT_IDLE_TIMEOUT,
+                 pool_max_lifetime=pool.DEFAULT_MAX_LIFETIME, read_size=BUFFER_SIZE, write_high_water=None,
+                 write_low_water=None, dispatch_queue_size=dispatch.DEFAULT_QUEUE_SIZE,
+                 dispatch_overflow=dispatch.OVERFLOW_BLOCK, dispatch_batch_size=dispatch.DEFAULT_BATCH_SIZE,
+                 dispatch_batch_interval=dispatch.DEFAULT_BATCH_INTERVAL, metrics_address=None):
         self.local_address = local_address
         self.local_port = local_port
         self.remote_address = remote_address
         self.remote_port = remote_port
+        # Forward message bodies as they arrive instead of buffering whole messages
+        self.streaming = streaming
+        # In streaming mode, keep at most this many bytes of each body for the listener (None = everything)
+        self.max_capture_body = max_capture_body
+        # Forward chunked messages as chunked instead of re-framing them with Content-Length.
+        # Streaming mode always preserves them, re-framing would need the whole body.
+        self.preserve_chunked = preserve_chunked
+        # Replace the local address with the remote one in Host and Referer headers and vice versa in Location
+        self.rewrite_headers = rewrite_headers
+        # Forward the received bytes as they are and parse a copy of them on a separate thread.
+        # Only the heads that contain an address to rewrite are parsed on the forwarding path.
+        self.raw_passthrough = raw_passthrough
+        # Number of received pieces of data waiting for the capture thread, before new ones are dropped
+        self.capture_queue_size = capture_queue_size
+        # Send requests one at a time over a pool of keep-alive upstream connections shared by all clients,
+        # instead of opening an upstream connection for every client connection
+        self.upstream_pool = upstream_pool
+        self.pool_max_size = pool_max_size
+        self.pool_max_idle = pool_max_idle
+        self.pool_idle_timeout = pool_idle_timeout
+        self.pool_max_lifetime = pool_max_lifetime
+        # Maximum number of bytes read from a socket at a time
+        self.read_size = read_size
+        # Reading from a connection pauses while more than write_high_water bytes wait to be sent to its peer,
+        # until less than write_low_water bytes are left (None = asyncio defaults)
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+        # The exchanges wait for the listener in a queue of dispatch_queue_size, handled by dispatch_overflow
+        # when full, and are delivered in batches of at most dispatch_batch_size every dispatch_batch_interval seconds
+        self.dispatch_queue_size = dispatch_queue_size
+        self.dispatch_overflow = dispatch_overflow
+        self.dispatch_batch_size = dispatch_batch_size
+        self.dispatch_batch_interval = dispatch_batch_interval
+        # (host, port) to serve metrics in the Prometheus text format on, None = no metrics
+        self.metrics_address = metrics_address
+
+    def set_write_buffer_limits(self, writer):
+        set_write_buffer_limits(writer, self.write_high_water, self.write_low_water)
+
+    def create_dispatcher(self, listener):
+        return dispatch.DispatchingListener(listener, max_queue_size=self.dispatch_queue_size,
+                                            overflow=self.dispatch_overflow, batch_size=self.dispatch_batch_size,
+                                            batch_interval=self.dispatch_batch_interval)
+
+    def create_upstream_pool(self):
+        return pool.UpstreamPool(self.remote_address, self.remote_port, max_size=self.pool_max_size,
+                                 max_idle=self.pool_max_idle, idle_timeout=self.pool_idle_timeout,
+                                 max_lifetime=self.pool_max_lifetime, connect_timeout=CONNECT_TIMEOUT_SECONDS,
+                                 write_buffer_limits=(self.write_high_water, self.write_low_water))
 
 
 def create_logger():
@@ -56,31 +130,247 @@ def remote_connection_string(writer):
         writer.get_extra_info('peername'))
 
 
-async def proxy_data(reader, writer, connection_string, pairer, processor):
+async def proxy_data(channel, pairer, processor):
     try:
-        parser = intialize_parser(http_parser.get_http_request)
+        parser = channel.create_parser(functools.partial(http_parser.get_http_request,
+                                                         request_methods=pairer.request_methods))
         while True:
-            data = await reader.read(BUFFER_SIZE)
+            data = await channel.read()
 
             for msg in parse(parser, data):
                 msg = processor.process_message(msg)
-                pairer.add_message(msg)
-                for data in msg.to_bytes():
-                    writer.write(data)
-                await writer.drain()
+                channel.writelines(msg.to_bytes())
+                pairer.add_message(msg, channel.message_timing(forwarded=time.monotonic()))
+            await channel.drain()
 
             if not data:
                 break
     except Exception as e:
+        channel.on_error(e)
         logger.info('proxy_task exception {}'.format(e))
     finally:
-        writer.close()
-        logger.info('close connection {}'.format(connection_string))
+        channel.close()
+        logger.info('close connection {}'.format(channel.connection_string))
+
+
+class BodyCapture:
+    """Bounded copy of a streamed body, handed to the listener once the message is complete"""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.pieces = []
+        self.captured = 0
+        self.total = 0
+
+    def append(self, data):
+        self.total += len(data)
+        if self.limit is None:
+            self.pieces.append(data)
+        elif self.captured < self.limit:
+            data = data[:self.limit - self.captured]
+            self.pieces.append(data)
+        else:
+            return
+        self.captured += len(data)
+
+    def apply(self, msg):
+        if not msg.has_body():
+            return
+        msg.body = b"".join(self.pieces)
+        if self.captured < self.total:
+            # The head was already forwarded, make the captured copy consistent with its truncated body
+            msg.headers.pop(b"Transfer-Encoding", None)
+            msg.headers[b"Content-Length"] = str(self.captured).encode()
+            msg.headers[b"X-Pyproxy-Truncated-From"] = str(self.total).encode()
+
+
+async def stream_data(channel, pairer, processor, max_capture_body=DEFAULT_MAX_CAPTURE_BODY):
+    try:
+        parser = channel.create_parser(functools.partial(http_parser.get_http_stream,
+                                                         request_methods=pairer.request_methods))
+        capture = None
+        head_received = head_forwarded = None
+        while True:
+            data = await channel.read()
+
+            for event in parse(parser, data):
+                if isinstance(event, http_parser.MessageHead):
+                    head_received = channel.clock.last_read
+                    msg = processor.process_message(event.message)
+                    capture = BodyCapture(max_capture_body)
+                    channel.writelines(msg.head_to_bytes())
+                    head_forwarded = time.monotonic()
+                elif isinstance(event, http_parser.MessageBody):
+                    if event.message.body_framing() == http_parser.BODY_CHUNKED:
+                        channel.write(http_parser.encode_chunk(event.data))
+                    else:
+                        channel.write(event.data)
+                    capture.append(event.data)
+                elif isinstance(event, http_parser.MessageEnd):
+                    if event.message.body_framing() == http_parser.BODY_CHUNKED:
+                        channel.write(http_parser.encode_last_chunk(event.message.trailers))
+                    capture.apply(event.message)
+                    pairer.add_message(event.message, channel.message_timing(head_received, head_forwarded))
+            await channel.drain()
 
+            if not data:
+                break
+    except Exception as e:
+        channel.on_error(e)
+        logger.info('stream_task exception {}'.format(e))
+    finally:
+        channel.close()
+        logger.info('close connection {}'.format(channel.connection_string))
+
+
+async def pipe_data(channel, capture_stream, rewriter=None):
+    try:
+        while True:
+            data = await channel.read()
+            if not data:
+                if rewriter and rewriter.buffer:
+                    # An incomplete head is forwarded as it is
+                    channel.write(rewriter.buffer)
+                    capture_stream.feed(rewriter.buffer)
+                break
+
+            if rewriter:
+                pieces = rewriter.feed(data)
+                channel.writelines(pieces)
+                # The capture gets the forwarded bytes, they are copied only when the data holds a head
+                if not (len(pieces) == 1 and isinstance(pieces[0], memoryview) and len(pieces[0]) == len(data)):
+                    data = b"".join(pieces)
+            else:
+                channel.write(data)
+            if data:
+                capture_stream.feed(data)
+            await channel.drain()
+    except Exception as e:
+        channel.on_error(e)
+        logger.info('pipe_task exception {}'.format(e))
+    finally:
+        capture_stream.close()
+        channel.close()
+        logger.info('close connection {}'.format(channel.connection_string))
+
+
+async def exchange_pooled(upstream_pool, request, channel, pairer, processor, timing=None):
+    """Send the request over a pooled connection and forward its response, return False if the client must be closed"""
+    fresh = False
+    while True:
+        connection = await upstream_pool.acquire(fresh)
+        reusable = False
+        received = False
+        try:
+            if timing:
+                # A reused connection took no time to connect
+                timing.connect_start, timing.connect_end = (None, None) if connection.reused else \
+                    (connection.connect_start, connection.created)
+            connection.writer.writelines(request.to_bytes())
+            if timing:
+                timing.request_forwarded = time.monotonic()
+            await connection.writer.drain()
+
+            buffer = ReceiveBuffer()
+            parser = intialize_parser(functools.partial(http_parser.get_http_request,
+                                                        request_methods=collections.deque([request.method])), buffer)
+            clock = MessageClock()
+            while True:
+                data = await connection.reader.read(channel.read_size)
+                clock.on_read(len(data))
+                received = received or bool(data)
+                for response in parse(parser, data if data else None):
+                    response = processor.process_message(response)
+                    channel.writelines(response.to_bytes())
+                    message_timing = clock.message_timing(len(buffer), forwarded=time.monotonic())
+                    channel.clock.messages += 1
+                    await channel.drain()
+                    if response.is_informational():
+                        continue
+                    pairer.add_message(response, message_timing)
+                    reusable = bool(data) and pool.is_keep_alive(request) and pool.is_keep_alive(response) and \
+                        response.body_framing() != http_parser.BODY_UNTIL_CLOSE
+                    return response.body_framing() != http_parser.BODY_UNTIL_CLOSE
+                if not data:
+                    break
+        except ConnectionError:
+            # Reset or broken pipe while writing the request or reading the first response byte
+            if not may_retry(connection, received, request):
+                raise
+        finally:
+            upstream_pool.release(connection, reusable)
+
+        if may_retry(connection, received, request):
+            # The upstream closed the idle connection meanwhile, retry once with a new one
+            logger.info('pooled connection closed by remote, retrying on a new connection')
+            fresh = True
+            continue
+        raise ConnectionError('remote closed the connection before the response was complete')
+
+
+def may_retry(connection, received, request):
+    """A request that failed on a reused connection before any response byte can be sent again, if idempotent"""
+    return connection.reused and not received and request.method in IDEMPOTENT_METHODS
+
+
+async def proxy_pooled(channel, upstream_pool, pairer, processor):
+    """The channel reads requests from the client and writes the responses back to it"""
+    try:
+        parser = channel.create_parser(http_parser.get_http_request)
+        keep_open = True
+        while keep_open:
+            data = await channel.read()
+
+            for request in parse(parser, data):
+                request = processor.process_message(request)
+                request_response = pairer.add_message(request, channel.message_timing())
+                keep_open = await exchange_pooled(upstream_pool, request, channel, pairer, processor,
+                                                  request_response.timing)
+                if not keep_open:
+                    break
 
-async def accept_client(client_reader, client_writer, proxy_parameters, listener):
+            if not data:
+                break
+    except Exception as e:
+        channel.on_error(e)
+        logger.info('pooled_task exception {}'.format(e))
+    finally:
+        channel.close()
+        logger.info('close connection {}'.format(channel.connection_string))
+
+
+def start_channel(channels, channel, coroutine, closes_client=False):
+    """
+    Run the coroutine forwarding the data of the channel, listing the channel in channels while it runs.
+    The client connection is counted as closed once the channel writing to the client ends.
+    """
+    def on_done(_):
+        channels.remove(channel)
+        if closes_client:
+            channels.connection_closed()
+
+    channels.add(channel)
+    asyncio.ensure_future(coroutine).add_done_callback(on_done)
+
+
+async def accept_client(client_reader, client_writer, proxy_parameters, listener, capture_tap=None,
+                        upstream_pool=None, channels=None, metrics=None):
+    timing = Timing(next(CONNECTION_IDS), time.monotonic())
+    if channels is None:
+        channels = ChannelRegistry()
+    channels.connection_opened()
     client_string = client_connection_string(client_writer)
     logger.info('accept connection {}'.format(client_string))
+    proxy_parameters.set_write_buffer_limits(client_writer)
+    read_size = proxy_parameters.read_size
+    if upstream_pool:
+        pairer = MessagePairer(listener, timing)
+        processor = MessageProcessor(proxy_parameters)
+        channel = Channel(client_reader, client_writer, client_string, read_size)
+        start_channel(channels, channel, proxy_pooled(channel, upstream_pool, pairer, processor), closes_client=True)
+        return
+
+    timing.connect_start = time.monotonic()
     try:
         (remote_reader, remote_writer) = await asyncio.wait_for(
             asyncio.open_connection(host=proxy_parameters.remote_address, port=proxy_parameters.remote_port),
@@ -89,19 +379,46 @@ async def accept_client(client_reader, client_writer, proxy_parameters, listener
         logger.info('connect timeout')
         logger.info('close connection {}'.format(client_string))
         client_writer.close()
+        channels.connection_closed()
     except Exception as e:
         logger.info('error connecting to remote server: {}'.format(e))
         logger.info('close connection {}'.format(client_string))
         client_writer.close()
+        channels.connection_closed()
     else:
+        timing.connect_end = time.monotonic()
+        if metrics:
+            metrics.upstream_connect.observe(timing.connect_end - timing.connect_start)
         remote_string = remote_connection_string(remote_writer)
         logger.info('connected to remote {}'.format(remote_string))
+        proxy_parameters.set_write_buffer_limits(remote_writer)
 
-        pairer = MessagePairer(listener)
+        pairer = MessagePairer(listener, timing)
         processor = MessageProcessor(proxy_parameters)
-
-        asyncio.ensure_future(proxy_data(client_reader, remote_writer, remote_string, pairer, processor))
-        asyncio.ensure_future(proxy_data(remote_reader, client_writer, client_string, pairer, processor))
+        to_remote = Channel(client_reader, remote_writer, remote_string, read_size)
+        to_client = Channel(remote_reader, client_writer, client_string, read_size)
+
+        if capture_tap:
+            client_capture, remote_capture = capture_tap.open_connection(timing)
+            client_rewriter = remote_rewriter = None
+            if processor.has_rewrites():
+                # Only the heads that contain an address are rewritten, the rest is forwarded as it is
+                request_methods = collections.deque()
+                client_rewriter = RawRewriter(processor, request_methods)
+                remote_rewriter = RawRewriter(processor, request_methods)
+                client_rewriter.peer, remote_rewriter.peer = remote_rewriter, client_rewriter
+            start_channel(channels, to_remote, pipe_data(to_remote, client_capture, client_rewriter))
+            start_channel(channels, to_client, pipe_data(to_client, remote_capture, remote_rewriter),
+                          closes_client=True)
+        elif proxy_parameters.streaming:
+            processor.preserve_chunked = True
+            max_capture_body = proxy_parameters.max_capture_body
+            start_channel(channels, to_remote, stream_data(to_remote, pairer, processor, max_capture_body))
+            start_channel(channels, to_client, stream_data(to_client, pairer, processor, max_capture_body),
+                          closes_client=True)
+        else:
+            start_channel(channels, to_remote, proxy_data(to_remote, pairer, processor))
+            start_channel(channels, to_client, proxy_data(to_client, pairer, processor), closes_client=True)
 
 
 def parse_addr_port_string(addr_port_string):
@@ -109,24 +426,105 @@ def parse_addr_port_string(addr_port_string):
     return (addr_port_list[0], int(addr_port_list[1]))
 
 
-def print_usage_and_exit():
-    logger.error(
-        'Usage: {} <listen addr> <remote addr>'.format(
-            sys.argv[0]))
-    sys.exit(1)
+def build_argument_parser():
+    parser = argparse.ArgumentParser(description="HTTP proxy that reports the exchanged messages")
+    parser.add_argument("listen", type=parse_addr_port_string, help="listen address, e.g. 0.0.0.0:8888")
+    parser.add_argument("remote", type=parse_addr_port_string, help="remote address, e.g. www.example.com:80")
+    parser.add_argument("--stream", action="store_true",
+                        help="forward message bodies as they arrive instead of buffering whole messages")
+    parser.add_argument("--rechunk", action="store_true",
+                        help="re-frame chunked messages with Content-Length (not available in streaming mode)")
+    parser.add_argument("--no-rewrite", action="store_true",
+                        help="do not replace the local address with the remote one in headers and vice versa")
+    parser.add_argument("--raw", action="store_true",
+                        help="forward the received bytes as they are and capture a copy of them on a separate "
+                             "thread, only heads that contain an address to rewrite are parsed")
+    parser.add_argument("--capture-queue", type=int, default=DEFAULT_QUEUE_SIZE, metavar="COUNT",
+                        help="in raw mode, drop captured data when this many reads wait for the capture thread")
+    parser.add_argument("--pool", action="store_true",
+                        help="send requests over a pool of keep-alive upstream connections shared by all clients")
+    parser.add_argument("--pool-max-size", type=int, default=pool.DEFAULT_MAX_SIZE, metavar="COUNT",
+                        help="maximum number of open upstream connections")
+    parser.add_argument("--pool-max-idle", type=int, default=pool.DEFAULT_MAX_IDLE, metavar="COUNT",
+                        help="maximum number of idle upstream connections kept open")
+    parser.add_argument("--pool-idle-timeout", type=float, default=pool.DEFAULT_IDLE_TIMEOUT, metavar="SECONDS",
+                        help="close upstream connections idle for longer than this")
+    parser.add_argument("--pool-max-lifetime", type=float, default=pool.DEFAULT_MAX_LIFETIME, metavar="SECONDS",
+                        help="do not reuse upstream connections open for longer than this")
+    parser.add_argument("--workers", type=int, default=1, metavar="COUNT",
+                        help="run the proxy in this many processes sharing the listen port")
+    parser.add_argument("--loop", choices=EVENT_LOOPS, default=LOOP_AUTO,
+                        help="event loop implementation, auto uses uvloop when it is installed")
+    parser.add_argument("--read-size", type=int, default=BUFFER_SIZE, metavar="BYTES",
+                        help="maximum number of bytes read from a connection at a time")
+    parser.add_argument("--write-high-water", type=int, default=None, metavar="BYTES",
+                        help="stop reading from a connection while more than this many bytes wait to be sent "
+                             "to its peer")
+    parser.add_argument("--write-low-water", type=int, default=None, metavar="BYTES",
+                        help="resume reading once less than this many bytes wait to be sent")
+    parser.add_argument("--dispatch-queue", type=int, default=dispatch.DEFAULT_QUEUE_SIZE, metavar="COUNT",
+                        help="maximum number of captured exchanges waiting for the listener")
+    parser.add_argument("--dispatch-overflow", choices=dispatch.OVERFLOW_POLICIES, default=dispatch.OVERFLOW_BLOCK,
+                        help="what to do with a new exchange when the listener queue is full")
+    parser.add_argument("--batch-size", type=int, default=dispatch.DEFAULT_BATCH_SIZE, metavar="COUNT",
+                        help="maximum number of exchanges passed to the listener at once")
+    parser.add_argument("--batch-interval", type=float, default=dispatch.DEFAULT_BATCH_INTERVAL * 1000, metavar="MS",
+                        help="maximum time an exchange waits for its batch to fill up")
+    parser.add_argument("--metrics", type=parse_addr_port_string, default=None, metavar="HOST:PORT",
+                        help="serve metrics in the Prometheus text format on this address, e.g. 127.0.0.1:9100")
+    parser.add_argument("--max-capture-body", type=int, default=DEFAULT_MAX_CAPTURE_BODY, metavar="BYTES",
+                        help="in streaming mode, capture at most this many bytes of every body (default %(default)s)")
+    parser.add_argument("--capture-whole-bodies", action="store_true",
+                        help="in streaming mode, capture every body completely, however large")
+    return parser
+
+
+def parse_proxy_parameters(args):
+    (local_address, local_port) = args.listen
+    (remote_address, remote_port) = args.remote
+    return ProxyParameters(local_address, local_port, remote_address, remote_port,
+                           streaming=args.stream,
+                           max_capture_body=None if args.capture_whole_bodies else args.max_capture_body,
+                           preserve_chunked=not args.rechunk, rewrite_headers=not args.no_rewrite,
+                           raw_passthrough=args.raw, capture_queue_size=args.capture_queue,
+                           upstream_pool=args.pool, pool_max_size=args.pool_max_size,
+                           pool_max_idle=args.pool_max_idle, pool_idle_timeout=args.pool_idle_timeout,
+                           pool_max_lifetime=args.pool_max_lifetime, read_size=args.read_size,
+                           write_high_water=args.write_high_water, write_low_water=args.write_low_water,
+                           dispatch_queue_size=args.dispatch_queue, dispatch_overflow=args.dispatch_overflow,
+                           dispatch_batch_size=args.batch_size, dispatch_batch_interval=args.batch_interval / 1000,
+                           metrics_address=args.metrics)
+
+
+async def prepare_server(proxy_parameters, listener=None, capture_tap=None, upstream_pool=None, reuse_port=False,
+                         channels=None, metrics=None):
+    """With metrics, the listener is expected to be a MetricsListener of them and channels their registry"""
+    if proxy_parameters.raw_passthrough and capture_tap is None:
+        capture_tap = CaptureTap(listener, proxy_parameters.capture_queue_size)
+    if proxy_parameters.upstream_pool and upstream_pool is None and capture_tap is None:
+        upstream_pool = proxy_parameters.create_upstream_pool()
+    if channels is None:
+        channels = ChannelRegistry()
+    if metrics:
+        metrics.capture_tap = capture_tap
+        if upstream_pool:
+            upstream_pool.on_connect = metrics.upstream_connect.observe
 
-
-async def prepare_server(proxy_parameters, listener=None):
     def handle_client(client_reader, client_writer):
         asyncio.ensure_future(accept_client(
             client_reader=client_reader, client_writer=client_writer,
             proxy_parameters=proxy_parameters,
-            listener=listener
+            listener=listener,
+            capture_tap=capture_tap,
+            upstream_pool=upstream_pool,
+            channels=channels,
+            metrics=metrics
         ))
 
     try:
         server = await asyncio.start_server(
-            handle_client, host=proxy_parameters.local_address, port=proxy_parameters.local_port)
+            handle_client, host=proxy_parameters.local_address, port=proxy_parameters.local_port,
+            reuse_port=reuse_port or None)
     except Exception as e:
         logger.error('Bind error: {}'.format(e))
         raise
@@ -138,12 +536,20 @@ async def prepare_server(proxy_parameters, listener=None):
 
 
 class PipeThread(Thread):
-    def __init__(self, listener):
+    def __init__(self, listener, event_loop=LOOP_AUTO):
         Thread.__init__(self, daemon=True)
         self.listener = listener
         self.server = None
+        self.capture_tap = None
+        self.upstream_pool = None
+        self.dispatcher = None
+        self.metrics = None
+        self.metrics_server = None
+        # Open connections of the running proxy
+        self.channels = ChannelRegistry()
         self.__is_running = False
-        self.loop = asyncio.new_event_loop()
+        self.event_loop = event_loop
+        self.loop = create_event_loop(event_loop)
 
     def run(self):
         asyncio.set_event_loop(self.loop)
@@ -165,7 +571,23 @@ class PipeThread(Thread):
 
     async def __start_proxy(self, proxy_parameters):
         assert threading.current_thread() is self
-        self.server = await prepare_server(proxy_parameters, self.listener)
+        self.dispatcher = proxy_parameters.create_dispatcher(self.listener)
+        listener = self.dispatcher
+        if proxy_parameters.metrics_address:
+            self.metrics = ProxyMetrics(self.channels, dispatcher=self.dispatcher)
+            listener = MetricsListener(listener, self.metrics)
+        if proxy_parameters.raw_passthrough:
+            self.capture_tap = CaptureTap(listener, proxy_parameters.capture_queue_size)
+        if proxy_parameters.upstream_pool:
+            self.upstream_pool = proxy_parameters.create_upstream_pool()
+        try:
+            self.server = await prepare_server(proxy_parameters, listener, self.capture_tap,
+                                               self.upstream_pool, channels=self.channels, metrics=self.metrics)
+            if self.metrics:
+                self.metrics_server = await start_metrics_server(self.metrics, *proxy_parameters.metrics_address)
+        except Exception:
+            await self.__stop_proxy()
+            raise
         assert self.server is not None
 
     def stop_proxy(self):
@@ -178,25 +600,64 @@ class PipeThread(Thread):
             self.server.close()
             await self.server.wait_closed()
         self.server = None
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        self.metrics_server = None
+        self.metrics = None
+        if self.capture_tap:
+            self.capture_tap.stop()
+            self.capture_tap = None
+        if self.upstream_pool:
+            self.upstream_pool.close()
+            self.upstream_pool = None
+        if self.dispatcher:
+            # Connections that are still open report to the stopped dispatcher, their exchanges are not delivered
+            self.dispatcher.stop()
+            self.dispatcher = None
 
     def is_running(self):
         return self.__is_running
 
+    def shutdown(self):
+        """Stop the proxy and the event loop, the thread cannot be started again"""
+        if self.is_alive():
+            asyncio.run_coroutine_threadsafe(self.__stop_proxy(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.join()
+        self.__is_running = False
+        self.loop.close()
+
 
 if __name__ == '__main__':
-    try:
-        if (len(sys.argv) != 3):
-            raise Exception("arguments")
-        (local_address, local_port) = parse_addr_port_string(sys.argv[1])
-        (remote_address, remote_port) = parse_addr_port_string(sys.argv[2])
-        proxy_parameters = ProxyParameters(local_address, local_port, remote_address, remote_port)
-    except:
-        print_usage_and_exit()
-    else:
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            prepare_server(proxy_parameters, MessageListener()))
+    args = build_argument_parser().parse_args()
+    proxy_parameters = parse_proxy_parameters(args)
+    if args.workers > 1:
+        if proxy_parameters.metrics_address:
+            logger.warning('metrics are not available with several workers')
+        workers = ProxyWorkers(proxy_parameters, MessageListener(), args.workers, args.loop)
+        workers.start()
         try:
-            loop.run_forever()
+            workers.join()
         except KeyboardInterrupt:
-            pass
+            workers.stop()
+        sys.exit(0)
+
+    loop = create_event_loop(args.loop)
+    asyncio.set_event_loop(loop)
+    dispatcher = proxy_parameters.create_dispatcher(MessageListener())
+    listener = dispatcher
+    channels = ChannelRegistry()
+    metrics = None
+    if proxy_parameters.metrics_address:
+        metrics = ProxyMetrics(channels, dispatcher=dispatcher)
+        listener = MetricsListener(dispatcher, metrics)
+        loop.run_until_complete(start_metrics_server(metrics, *proxy_parameters.metrics_address))
+    loop.run_until_complete(
+        prepare_server(proxy_parameters, listener, channels=channels, metrics=metrics))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+Indexed capture archive.
+
+Layout: MAGIC, then one record per exchange (8 byte length + the exchange in the persistence format),
+then the index and a fixed size trailer pointing at it. An index entry holds the id, the position of the record,
+the time of the request, its method, path and status, the heads of both messages and the timing.
+Opening an archive reads only the index, message bodies are read from their record when they are first accessed.
+
+Each exchange record is followed by a copy of its index entry, flagged in the length of the record. An archive
+whose writer did not get to write the index (a crash, or one still being written) is read by scanning
+the records for these entries instead.
+
+Large bodies are stored once, as a blob record written before the first exchange that has them. A message with
+such a body is left out of the record of its exchange, the index entry holds the digest of its body instead.
+The blob table (digest, position, length) follows the index entries.
+
+A compressed archive starts with COMPRESSED_MAGIC and the name of the codec. The records are grouped into segments
+of about segment_size bytes, each compressed on its own, and the positions in the index are positions in
+the uncompressed records. The segment table follows the index entries, both are compressed together.
+A record is never split between segments, so reading one exchange decompresses one segment, and the segments
+can be decompressed in parallel.
+
+Convert .http captures: python -m proxy.pipe.archive [--jobs 4] [--codec zlib] capture.http [capture2.http ...]
+"""
+
+import argparse
+import bisect
+import bz2
+import collections
+import io
+import lzma
+import math
+import mmap
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from proxy.parser.http_parser import LazyHttpRequest, LazyHttpResponse, parse_head
+from proxy.pipe.blobs import body_digest, is_blob
+from proxy.pipe.bulk_load import load_message_pairs
+from proxy.pipe.communication import RequestResponse
+from proxy.pipe.persistence import format_timing, map_message_pairs, parse_message_pairs, parse_timing, \
+    serialize_message_pair
+
+MAGIC = b"PYPXARC2"
+COMPRESSED_MAGIC = b"PYPXARZ2"
+INDEX_MAGIC = b"PYPXIDX1"
+EXTENSION = ".pyarc"
+
+CODECS = {"zlib": zlib, "lzma": lzma, "bz2": bz2}
+DEFAULT_SEGMENT_SIZE = 1024 * 1024
+
+RECORD_LENGTH = struct.Struct("<Q")
+# Flags in the record length of the records that are not exchanges
+BLOB_RECORD = 1 << 63
+ENTRY_RECORD = 1 << 62
+RECORD_FLAGS = BLOB_RECORD | ENTRY_RECORD
+# guid, record offset, record length, time of the request (time.time(), NaN if unknown), then the lengths of
+# method, path, status, request head, response head, timing, request blob digest and response blob digest
+ENTRY = struct.Struct("<16sQQdHIHIIIBB")
+# index offset, entry count, INDEX_MAGIC
+TRAILER = struct.Struct("<QQ8s")
+# name of the codec, after COMPRESSED_MAGIC
+CODEC = struct.Struct("8s")
+BLOB_COUNT = struct.Struct("<Q")
+# digest, record offset, record length
+BLOB = struct.Struct("<32sQQ")
+# file offset, compressed length, position of the segment in the uncompressed records, uncompressed length
+SEGMENT = struct.Struct("<QQQQ")
+# Compressed data read at once when the segments are looked for without their table
+RECOVERY_READ_SIZE = 64 * 1024
+
+
+class ArchiveEntry:
+    __slots__ = ("guid", "offset", "length", "timestamp", "method", "path", "status", "request_head",
+                 "response_head", "timing", "request_blob", "response_blob")
+
+    def __init__(self, guid, offset, length, timestamp, method, path, status, request_head, response_head, timing,
+                 request_blob=b"", response_blob=b""):
+        self.guid = guid
+        self.offset = offset
+        self.length = length
+        # Wall clock time.time() of the request (Timing.request_time), NaN if unknown. Not comparable with the
+        # time.monotonic() values of the timing
+        self.timestamp = timestamp
+        self.method = method
+        self.path = path
+        self.status = status
+        self.request_head = request_head
+        self.response_head = response_head
+        self.timing = timing
+        # Digests of the bodies stored as blobs, empty if the message is in the record
+        self.request_blob = request_blob
+        self.response_blob = response_blob
+
+    def to_bytes(self):
+        fields = (self.method, self.path, self.status, self.request_head, self.response_head, self.timing,
+                  self.request_blob, self.response_blob)
+        return ENTRY.pack(self.guid.to_bytes(16, "big"), self.offset, self.length, self.timestamp,
+                          *(len(field) for field in fields)) + b"".join(fields)
+
+    @staticmethod
+    def from_bytes(data, position):
+        guid, offset, length, timestamp, *lengths = ENTRY.unpack_from(data, position)
+        position += ENTRY.size
+        fields = []
+        for field_length in lengths:
+            fields.append(bytes(data[position:position + field_length]))
+            position += field_length
+        return ArchiveEntry(int.from_bytes(guid, "big"), offset, length, timestamp, *fields), position
+
+
+def head_bytes(message):
+    return b"".join(message.head_to_bytes()) if message else b""
+
+
+def has_blob_body(message):
+    # The trailers of a chunked body would have no place outside the record
+    return message is not None and not message.is_chunked() and is_blob(message.body)
+
+
+class ArchiveWriter:
+    """
+    Writes exchanges to a new archive, the index is written by close.
+    With a codec (one of CODECS), the records are compressed in segments of about segment_size bytes.
+    """
+
+    def __init__(self, stream, codec=None, segment_size=DEFAULT_SEGMENT_SIZE):
+        if codec is not None and codec not in CODECS:
+            raise ValueError("Unknown codec {}, expected one of {}".format(codec, ", ".join(CODECS)))
+        self.stream = stream
+        self.entries = []
+        self.codec = codec
+        self.segment_size = segment_size
+        self.segments = []
+        # digest -> (position, length) of the blob record
+        self.blobs = {}
+        self.__segment = []
+        self.__segment_start = 0
+        if codec:
+            self.stream.write(COMPRESSED_MAGIC)
+            self.stream.write(CODEC.pack(codec.encode()))
+            self.file_position = len(COMPRESSED_MAGIC) + CODEC.size
+            # Position in the uncompressed records
+            self.position = 0
+        else:
+            self.stream.write(MAGIC)
+            self.position = self.file_position = len(MAGIC)
+
+    def add(self, rr: RequestResponse):
+        request, response = rr.request, rr.response
+        request_blob = self.__add_blob(request)
+        response_blob = self.__add_blob(response)
+        if request_blob or response_blob:
+            record_rr = RequestResponse(None if request_blob else request, None if response_blob else response)
+            record_rr.guid = rr.guid
+            record_rr.timing = rr.timing
+        else:
+            record_rr = rr
+        buffer = io.BytesIO()
+        serialize_message_pair(record_rr, buffer)
+        record = buffer.getvalue()
+
+        timing = rr.timing
+        timestamp = timing.request_time if timing and timing.request_time is not None else math.nan
+        entry = ArchiveEntry(
+            rr.guid, self.position, len(record), timestamp,
+            request.method if request else b"", request.path if request else b"",
+            response.status if response else b"", head_bytes(request), head_bytes(response),
+            format_timing(timing) if timing else b"", request_blob, response_blob)
+        self.entries.append(entry)
+        self.__write_record(record)
+        self.__write_record(entry.to_bytes(), ENTRY_RECORD)
+
+    def __add_blob(self, message):
+        """Digest of the body of the message, which is written as a blob the first time, b"" if it is not a blob"""
+        if not has_blob_body(message):
+            return b""
+        body = message.body
+        digest = body_digest(body)
+        if digest not in self.blobs:
+            self.blobs[digest] = (self.position, len(body))
+            self.__write_record(body, BLOB_RECORD)
+        return digest
+
+    def __write_record(self, record, flags=0):
+        self.__write(RECORD_LENGTH.pack(len(record) | flags))
+        self.__write(record)
+        self.position += RECORD_LENGTH.size + len(record)
+        if self.codec and self.position - self.__segment_start >= self.segment_size:
+            self.__flush_segment()
+
+    def __write(self, data):
+        if self.codec:
+            self.__segment.append(data)
+        else:
+            self.stream.write(data)
+            self.file_position += len(data)
+
+    def __flush_segment(self):
+        data = b"".join(self.__segment)
+        compressed = CODECS[self.codec].compress(data)
+        self.stream.write(compressed)
+        self.segments.append((self.file_position, len(compressed), self.__segment_start, len(data)))
+        self.file_position += len(compressed)
+        self.__segment_start = self.position
+        self.__segment = []
+
+    def flush(self):
+        """Write out the records added so far, but the ones of an incomplete segment"""
+        self.stream.flush()
+
+    def close(self):
+        if self.__segment:
+            self.__flush_segment()
+        index = b"".join(entry.to_bytes() for entry in self.entries)
+        index += BLOB_COUNT.pack(len(self.blobs))
+        index += b"".join(BLOB.pack(digest, *blob) for digest, blob in self.blobs.items())
+        index += b"".join(SEGMENT.pack(*segment) for segment in self.segments)
+        if self.codec:
+            index = CODECS[self.codec].compress(index)
+        index_offset = self.file_position
+        self.stream.write(index)
+        self.stream.write(TRAILER.pack(index_offset, len(self.entries), INDEX_MAGIC))
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_compressed_segment(f, codec):
+    """
+    Decompress the segment at the position of the file and leave the file after it. None at the end of the file,
+    or if the segment was cut short.
+    """
+    decompressor = {"zlib": zlib.decompressobj, "lzma": lzma.LZMADecompressor, "bz2": bz2.BZ2Decompressor}[codec]()
+    pieces = []
+    try:
+        while not decompressor.eof:
+            data = f.read(RECOVERY_READ_SIZE)
+            if not data:
+                return None
+            pieces.append(decompressor.decompress(data))
+    except (OSError, EOFError, zlib.error, lzma.LZMAError):
+        return None
+    f.seek(-len(decompressor.unused_data), os.SEEK_CUR)
+    return b"".join(pieces)
+
+
+def is_archive(file_name):
+    with open(file_name, "rb") as f:
+        return f.read(len(MAGIC)) in (MAGIC, COMPRESSED_MAGIC)
+
+
+class ArchiveReader:
+    """
+    Reads the index of an archive, the records are read on demand. The index of an archive that was not closed
+    is rebuilt from its records, recovered is then True.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.codec = None
+        self.recovered = False
+        with open(file_name, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic == COMPRESSED_MAGIC:
+                self.codec = CODEC.unpack(f.read(CODEC.size))[0].rstrip(b"\0").decode()
+                if self.codec not in CODECS:
+                    raise ValueError("{} is compressed with an unknown codec {}".format(file_name, self.codec))
+            elif magic != MAGIC:
+                raise ValueError("{} is not a capture archive".format(file_name))
+            start = f.tell()
+            end = f.seek(0, os.SEEK_END)
+            index_magic = None
+            if end - start >= TRAILER.size:
+                f.seek(-TRAILER.size, os.SEEK_END)
+                index_offset, count, index_magic = TRAILER.unpack(f.read(TRAILER.size))
+            if index_magic == INDEX_MAGIC:
+                self.__read_entries(self.__read_index(f, index_offset), count)
+            else:
+                self.recovered = True
+                f.seek(start)
+                self.__recover(f)
+        # Bodies of the blobs read so far, the messages that have the same body share it
+        self.__blob_bodies = {}
+        self.__segment_starts = [segment[2] for segment in self.segments]
+        # The last decompressed segment, the bodies of neighbouring exchanges are usually read one after another
+        self.__cached_segment = (None, None)
+
+    def __read_entries(self, index, count):
+        if self.codec:
+            index = CODECS[self.codec].decompress(index)
+        self.entries = []
+        position = 0
+        for _ in range(count):
+            entry, position = ArchiveEntry.from_bytes(index, position)
+            self.entries.append(entry)
+        blob_count, = BLOB_COUNT.unpack_from(index, position)
+        position += BLOB_COUNT.size
+        self.blobs = {}
+        for _ in range(blob_count):
+            digest, *blob = BLOB.unpack_from(index, position)
+            self.blobs[digest] = blob
+            position += BLOB.size
+        self.segments = [SEGMENT.unpack_from(index, offset) for offset in range(position, len(index), SEGMENT.size)]
+
+    def __recover(self, f):
+        """Rebuild the index from the entry and blob records, a record cut short by the end of the file is lost"""
+        self.entries = []
+        self.blobs = {}
+        self.segments = []
+        if self.codec is None:
+            if f.seek(0, os.SEEK_END) > len(MAGIC):
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    self.__scan_records(data, 0)
+            return
+
+        position = 0
+        while True:
+            file_position = f.tell()
+            segment = read_compressed_segment(f, self.codec)
+            if segment is None:
+                return
+            self.segments.append((file_position, f.tell() - file_position, position, len(segment)))
+            self.__scan_records(segment, position)
+            position += len(segment)
+
+    def __scan_records(self, records, position):
+        """Collect the entries and the blobs of records, which start at position in the uncompressed records"""
+        offset = len(MAGIC) if self.codec is None else 0
+        while offset + RECORD_LENGTH.size <= len(records):
+            value, = RECORD_LENGTH.unpack_from(records, offset)
+            length = value & ~RECORD_FLAGS
+            start = offset + RECORD_LENGTH.size
+            if start + length > len(records):
+                break
+            if value & ENTRY_RECORD:
+                self.entries.append(ArchiveEntry.from_bytes(records[start:start + length], 0)[0])
+            elif value & BLOB_RECORD:
+                self.blobs[body_digest(records[start:start + length])] = (position + offset, length)
+            offset = start + length
+
+    @staticmethod
+    def __read_index(f, index_offset):
+        end = f.seek(-TRAILER.size, os.SEEK_END)
+        f.seek(index_offset)
+        return f.read(end - index_offset)
+
+    def read_segment(self, index):
+        """The uncompressed records of a segment"""
+        offset, length, _, _ = self.segments[index]
+        with open(self.file_name, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return CODECS[self.codec].decompress(data)
+
+    def __record(self, offset, length):
+        if self.codec is None:
+            with open(self.file_name, "rb") as f:
+                f.seek(offset + RECORD_LENGTH.size)
+                return f.read(length)
+
+        index = bisect.bisect_right(self.__segment_starts, offset) - 1
+        cached_index, data = self.__cached_segment
+        if cached_index != index:
+            data = self.read_segment(index)
+            self.__cached_segment = (index, data)
+        start = offset - self.segments[index][2] + RECORD_LENGTH.size
+        return data[start:start + length]
+
+    def read_blob(self, digest):
+        body = self.__blob_bodies.get(digest)
+        if body is None:
+            body = self.__blob_bodies[digest] = self.__record(*self.blobs[digest])
+        return body
+
+    def __blob_message(self, head, digest):
+        message = parse_head(head)
+        message.body = self.read_blob(digest)
+        return message
+
+    def __request_response(self, entry, record):
+        rr = next(parse_message_pairs(io.BytesIO(record)))
+        if entry.request_blob:
+            rr.request = self.__blob_message(entry.request_head, entry.request_blob)
+        if entry.response_blob:
+            rr.response = self.__blob_message(entry.response_head, entry.response_blob)
+            rr.response.request_method = entry.method or None
+        return rr
+
+    def read(self, entry):
+        """The whole exchange of the entry"""
+        return self.__request_response(entry, self.__record(entry.offset, entry.length))
+
+    def load_request_responses(self, workers=1):
+        """
+        All exchanges with their bodies. The segments of a compressed archive are decompressed by a pool
+        of threads, the codecs release the GIL while they work.
+        """
+        if self.codec is None:
+            for entry in self.entries:
+                yield self.read(entry)
+            return
+
+        offsets = [entry.offset for entry in self.entries]
+        with ThreadPoolExecutor(workers) as executor:
+            pending = collections.deque()
+            for index in range(len(self.segments)):
+                pending.append((index, executor.submit(self.read_segment, index)))
+                # Only a few segments ahead are kept in memory
+                if len(pending) > workers * 2:
+                    yield from self.__segment_request_responses(offsets, *pending.popleft())
+            while pending:
+                yield from self.__segment_request_responses(offsets, *pending.popleft())
+
+    def __segment_request_responses(self, offsets, index, future):
+        data = future.result()
+        _, _, start, size = self.segments[index]
+        for entry in self.entries[bisect.bisect_left(offsets, start):bisect.bisect_left(offsets, start + size)]:
+            position = entry.offset - start + RECORD_LENGTH.size
+            yield self.__request_response(entry, data[position:position + entry.length])
+
+    def request_responses(self):
+        """Exchanges of the index, their bodies are read from the archive when first accessed"""
+        for entry in self.entries:
+            yield self.__lazy_request_response(entry)
+
+    def __lazy_request_response(self, entry):
+        loaded = []
+
+        def load():
+            if not loaded:
+                loaded.append(self.read(entry))
+            return loaded[0]
+
+        def message_loader(attribute, digest):
+            def load_body():
+                if digest:
+                    return self.read_blob(digest), None
+                message = getattr(load(), attribute)
+                return message.body, message.trailers
+            return load_body
+
+        rr = RequestResponse()
+        rr.guid = entry.guid
+        if entry.request_head:
+            rr.request = parse_head(entry.request_head, LazyHttpRequest, LazyHttpResponse)
+            rr.request.body_loader = message_loader("request", entry.request_blob)
+        if entry.response_head:
+            rr.response = parse_head(entry.response_head, LazyHttpRequest, LazyHttpResponse)
+            rr.response.request_method = entry.method or None
+            rr.response.body_loader = message_loader("response", entry.response_blob)
+        if entry.timing:
+            rr.timing = parse_timing(entry.timing)
+        return rr
+
+
+def convert(source, destination, workers=1, codec=None, segment_size=DEFAULT_SEGMENT_SIZE):
+    """
+    Convert a capture in the persistence format to an archive, return the number of exchanges.
+    With more than one worker, the capture is parsed by a pool of processes.
+    """
+    pairs = load_message_pairs(source, workers) if workers > 1 else map_message_pairs(source)
+    with open(destination, "wb") as output, ArchiveWriter(output, codec, segment_size) as writer:
+        for rr in pairs:
+            writer.add(rr)
+        return len(writer.entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert .http captures to indexed archives")
+    parser.add_argument("captures", nargs="+", help="captures to convert, each is written next to itself as "
+                                                    "<name>" + EXTENSION)
+    parser.add_argument("--jobs", type=int, default=1, metavar="COUNT",
+                        help="parse each capture with this many processes")
+    parser.add_argument("--codec", choices=sorted(CODECS), default=None,
+                        help="compress the archive in segments with this codec")
+    parser.add_argument("--segment-size", type=int, default=DEFAULT_SEGMENT_SIZE, metavar="BYTES",
+                        help="uncompressed size of a compressed segment")
+    args = parser.parse_args()
+    for source in args.captures:
+        destination = os.path.splitext(source)[0] + EXTENSION
+        count = convert(source, destination, args.jobs, args.codec, args.segment_size)
+        print("{}: {} exchanges -> {}".format(source, count, destination))
+
+
+if __name__ == '__main__':
+    main()
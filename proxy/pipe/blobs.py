@@ -0,0 +1,65 @@
+"""
+Content addressing of message bodies. Captures often repeat the same large body (a WSDL, a static file,
+a SOAP fault), identical bodies are recognized by their digest and kept once.
+"""
+
+import hashlib
+
+# Smaller bodies are not worth their digest
+MIN_BLOB_SIZE = 1024
+
+
+def body_digest(body):
+    return hashlib.sha256(body).digest()
+
+
+def is_blob(body):
+    return body is not None and len(body) >= MIN_BLOB_SIZE
+
+
+class BodyInterner:
+    """
+    Makes the identical bodies of the exchanges kept in memory share one bytes object. A body is held while any
+    exchange interned with it is, release() drops the bodies of an exchange that is no longer kept.
+    """
+
+    def __init__(self):
+        # digest -> [body, number of exchanges holding it]
+        self.bodies = {}
+        # exchange id -> digests of its interned bodies
+        self.held = {}
+        self.shared_bytes = 0
+
+    def intern(self, message):
+        """Digest of the body of the message, None if it is not interned"""
+        # A body that was not loaded yet is left where it is
+        if message is None or getattr(message, "body_loader", None) is not None:
+            return None
+        body = message.body
+        if not is_blob(body):
+            return None
+        digest = body_digest(body)
+        entry = self.bodies.get(digest)
+        if entry is None:
+            self.bodies[digest] = [body, 0]
+        elif entry[0] is not body:
+            message.body = entry[0]
+            self.shared_bytes += len(body)
+        return digest
+
+    def intern_pair(self, request_response):
+        digests = [digest for digest in (self.intern(request_response.request), self.intern(request_response.response))
+                   if digest is not None]
+        for digest in digests:
+            self.bodies[digest][1] += 1
+        # The exchange is interned again when its response arrives
+        self.release(request_response.guid)
+        if digests:
+            self.held[request_response.guid] = digests
+
+    def release(self, guid):
+        for digest in self.held.pop(guid, ()):
+            entry = self.bodies[digest]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.bodies[digest]
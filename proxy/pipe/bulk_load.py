@@ -0,0 +1,118 @@
+"""
+Loading of large .http captures on several cores.
+
+The file is split into byte ranges of similar size at pair boundaries near the split points, which are parsed
+by parse_message_pairs in a pool of processes. The workers send back compact records (tuples of bytes) rather than
+pickled messages, the messages are rebuilt from them in the order of the file.
+"""
+
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from proxy.parser.http_parser import parse_head
+from proxy.pipe.communication import RequestResponse
+from proxy.pipe.persistence import PAIR_SEPARATOR, MappedCapture, compact_trailers, format_timing, map_capture, \
+    parse_message_pairs, parse_timing, restore_trailers
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# More ranges than workers, so that a worker with a slow range does not hold up the others
+RANGES_PER_WORKER = 4
+# Smaller captures are parsed in this process, starting the workers would take longer
+MIN_PARALLEL_SIZE = 4 * 1024 * 1024
+
+
+def split_capture(file_name, count):
+    """Split a capture into at most count byte ranges (start, end) of similar size, each starting with a pair"""
+    data = map_capture(file_name)
+    if data is None:
+        return []
+    size = len(data)
+    starts = [0]
+    for i in range(1, count):
+        start = find_pair_start(data, max(i * size // count, starts[-1] + 1))
+        if start is None:
+            break
+        if start > starts[-1]:
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def find_pair_start(data, position):
+    """
+    The first position from position on at which a pair starts, None if there is none. Only the pair found there
+    is parsed, a body that merely contains the text of a pair is recognized by what follows that pair.
+    """
+    capture = MappedCapture(data)
+    while True:
+        index = data.find(PAIR_SEPARATOR, max(position - len(b"\r\n"), 0))
+        if index < 0:
+            return None
+        start = index + len(b"\r\n")
+        try:
+            capture.position = start
+            capture.get_message_pair()
+            capture.skip_spaces()
+            if capture.position >= len(data) or data[capture.position:capture.position + 6] == b"Pair: ":
+                return start
+        except Exception:
+            pass
+        position = start + 1
+
+
+def compact_message(message):
+    if message is None:
+        return None
+    return message.head, message.body, compact_trailers(message.trailers), getattr(message, "request_method", None)
+
+
+def restore_message(record):
+    if record is None:
+        return None
+    head, body, trailers, request_method = record
+    message = parse_head(head)
+    message.body = body
+    if trailers is not None:
+        message.trailers = restore_trailers(trailers)
+    if request_method is not None:
+        message.request_method = request_method
+    return message
+
+
+def compact_pair(rr):
+    timing = format_timing(rr.timing) if rr.timing else None
+    return rr.guid, timing, compact_message(rr.request), compact_message(rr.response)
+
+
+def restore_pair(record):
+    guid, timing, request, response = record
+    rr = RequestResponse()
+    rr.guid = guid
+    rr.timing = parse_timing(timing) if timing is not None else None
+    rr.request = restore_message(request)
+    rr.response = restore_message(response)
+    return rr
+
+
+def parse_range(file_name, start, end):
+    """Run in a worker, the compact records of the pairs in a byte range of the capture"""
+    with open(file_name, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return [compact_pair(rr) for rr in parse_message_pairs(io.BytesIO(data))]
+
+
+def load_message_pairs(file_name, workers=DEFAULT_WORKERS):
+    """Parse a capture completely with the given number of processes, yield the pairs in the order of the file"""
+    if workers <= 1 or os.path.getsize(file_name) < MIN_PARALLEL_SIZE:
+        with open(file_name, "rb") as f:
+            yield from parse_message_pairs(f)
+        return
+
+    ranges = split_capture(file_name, workers * RANGES_PER_WORKER)
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(parse_range, file_name, start, end) for start, end in ranges]
+        for future in futures:
+            for record in future.result():
+                yield restore_pair(record)
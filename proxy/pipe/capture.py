@@ -0,0 +1,109 @@
+import functools
+import logging
+import queue
+import time
+from threading import Thread
+
+from proxy.parser.parser_utils import ReceiveBuffer, intialize_parser, parse
+from proxy.pipe.channel import MessageClock
+from proxy.pipe.communication import MessagePairer
+
+from proxy.parser import http_parser
+
+DEFAULT_QUEUE_SIZE = 1024
+
+logger = logging.getLogger('proxy')
+
+
+class CaptureStream:
+    """One direction of a captured connection, parsed by the capture thread"""
+
+    def __init__(self, tap, pairer):
+        self.tap = tap
+        self.pairer = pairer
+        self.buffer = ReceiveBuffer()
+        self.parser = intialize_parser(functools.partial(http_parser.get_http_request,
+                                                         request_methods=pairer.request_methods), self.buffer)
+        self.clock = MessageClock()
+        # The other direction of the connection, it shares the pairer and the request methods
+        self.peer = None
+        # Once data of a stream is lost, the rest of the connection cannot be parsed reliably
+        self.abandoned = False
+
+    def feed(self, data):
+        """Called on the forwarding path right after the data was forwarded, never blocks"""
+        self.tap.put(self, data, time.monotonic())
+
+    def close(self):
+        self.tap.put(self, b"", time.monotonic())
+
+    def consume(self, data, received):
+        self.clock.on_read(len(data), received)
+        for msg in parse(self.parser, data if data else None):
+            self.tap.messages += 1
+            self.pairer.add_message(msg, self.clock.message_timing(len(self.buffer), forwarded=received))
+
+
+class CaptureTap:
+    """
+    Parses and pairs copies of the forwarded data on a separate thread.
+
+    The forwarding path only puts the received bytes into a bounded queue. When the queue is full the data
+    is dropped and counted instead, and the connection it belongs to is not captured any further: both
+    directions are abandoned, since the responses are paired with the requests and framed by their methods.
+    """
+
+    def __init__(self, listener, max_queue_size=DEFAULT_QUEUE_SIZE):
+        self.listener = listener
+        self.queue = queue.Queue(max_queue_size)
+        self.messages = 0
+        self.dropped_chunks = 0
+        self.dropped_bytes = 0
+        self.abandoned_streams = 0
+        self.parse_errors = 0
+        self.thread = Thread(target=self.__run, name="CaptureTap", daemon=True)
+        self.thread.start()
+
+    def open_connection(self, connection_timing=None):
+        """Return capture streams for the client -> remote and the remote -> client direction"""
+        pairer = MessagePairer(self.listener, connection_timing)
+        client, remote = CaptureStream(self, pairer), CaptureStream(self, pairer)
+        client.peer, remote.peer = remote, client
+        return client, remote
+
+    def put(self, stream, data, received=None):
+        if stream.abandoned:
+            return
+        try:
+            self.queue.put_nowait((stream, data, received))
+        except queue.Full:
+            self.dropped_chunks += 1
+            self.dropped_bytes += len(data)
+            self.__abandon(stream)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        self.queue.put((None, None, None))
+
+    def __abandon(self, stream):
+        """Stop capturing both directions of the connection of the stream"""
+        for abandoned in (stream, stream.peer):
+            if abandoned is not None and not abandoned.abandoned:
+                abandoned.abandoned = True
+                self.abandoned_streams += 1
+
+    def __run(self):
+        while True:
+            stream, data, received = self.queue.get()
+            if stream is None:
+                break
+            if stream.abandoned:
+                continue
+            try:
+                stream.consume(data, received)
+            except Exception as e:
+                self.parse_errors += 1
+                self.__abandon(stream)
+                logger.info('capture parse error {}'.format(e))
@@ -0,0 +1,169 @@
+import asyncio
+import time
+
+from proxy.parser.parser_utils import ReceiveBuffer, intialize_parser
+from proxy.pipe.communication import MessageTiming
+
+BUFFER_SIZE = 65536
+
+
+def set_write_buffer_limits(writer, high=None, low=None):
+    """Set the watermarks of the writer's transport, None keeps the asyncio defaults"""
+    if high is not None or low is not None:
+        writer.transport.set_write_buffer_limits(high=high, low=low)
+
+
+class MessageClock:
+    """Times the messages parsed from a sequence of reads, a message starts with the read of its first byte"""
+    __slots__ = ("bytes_read", "messages", "last_read", "message_start", "message_offset")
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.messages = 0
+        self.last_read = None
+        self.message_start = None
+        self.message_offset = 0
+
+    def on_read(self, size, now=None):
+        self.last_read = time.monotonic() if now is None else now
+        self.bytes_read += size
+        if size and self.message_start is None:
+            self.message_start = self.last_read
+
+    def message_timing(self, buffered, head=None, forwarded=None):
+        """Timing of the message that was just parsed, buffered is the number of bytes read but not parsed yet"""
+        self.messages += 1
+        offset = self.bytes_read - buffered
+        timing = MessageTiming(self.message_start, head, self.last_read, forwarded, offset - self.message_offset)
+        self.message_offset = offset
+        # The rest of the buffer belongs to the next message
+        self.message_start = self.last_read if buffered else None
+        return timing
+
+
+class Channel:
+    """
+    One direction of a proxied connection: data read from the reader is forwarded to the writer.
+
+    Reading pauses in drain() while the writer's transport buffers more than its high-water mark,
+    until the buffer falls below the low-water mark. The counters tell how many bytes the channel holds.
+    """
+
+    def __init__(self, reader, writer, connection_string, read_size=BUFFER_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.connection_string = connection_string
+        self.read_size = read_size
+        self.receive_buffer = None
+        self.clock = MessageClock()
+        self.bytes_written = 0
+        self.read_pauses = 0
+        self.parse_errors = 0
+
+    def create_parser(self, parser_func):
+        self.receive_buffer = ReceiveBuffer()
+        return intialize_parser(parser_func, self.receive_buffer)
+
+    async def read(self):
+        data = await self.reader.read(self.read_size)
+        self.clock.on_read(len(data))
+        return data
+
+    @property
+    def bytes_read(self):
+        return self.clock.bytes_read
+
+    @property
+    def messages(self):
+        return self.clock.messages
+
+    def on_error(self, error):
+        """Count the errors ending the channel that are not caused by the connection"""
+        if not isinstance(error, (OSError, asyncio.IncompleteReadError)):
+            self.parse_errors += 1
+
+    def message_timing(self, head=None, forwarded=None):
+        return self.clock.message_timing(self.parser_buffered(), head, forwarded)
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.writer.write(data)
+
+    def writelines(self, pieces):
+        for data in pieces:
+            self.write(data)
+
+    async def drain(self):
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+            self.read_pauses += 1
+        await self.writer.drain()
+
+    def write_buffered(self):
+        """Bytes written to the peer, but not sent yet"""
+        return self.writer.transport.get_write_buffer_size()
+
+    def parser_buffered(self):
+        """Bytes received, but not forwarded yet"""
+        return len(self.receive_buffer) if self.receive_buffer is not None else 0
+
+    def buffered(self):
+        return self.write_buffered() + self.parser_buffered()
+
+    def close(self):
+        self.writer.close()
+
+
+class ChannelRegistry:
+    """
+    Channels of all open connections of a proxy, with the totals of the connections and the closed channels.
+    Only the event loop of the proxy updates the registry.
+    """
+
+    def __init__(self):
+        self.__channels = set()
+        self.connections_total = 0
+        self.connections_active = 0
+        self.closed_bytes_read = 0
+        self.closed_bytes_written = 0
+        self.closed_messages = 0
+        self.closed_parse_errors = 0
+
+    def connection_opened(self):
+        self.connections_total += 1
+        self.connections_active += 1
+
+    def connection_closed(self):
+        self.connections_active -= 1
+
+    def add(self, channel):
+        self.__channels.add(channel)
+
+    def remove(self, channel):
+        if channel in self.__channels:
+            self.__channels.remove(channel)
+            self.closed_bytes_read += channel.bytes_read
+            self.closed_bytes_written += channel.bytes_written
+            self.closed_messages += channel.messages
+            self.closed_parse_errors += channel.parse_errors
+
+    def bytes_read(self):
+        return self.closed_bytes_read + sum(channel.bytes_read for channel in self)
+
+    def bytes_written(self):
+        return self.closed_bytes_written + sum(channel.bytes_written for channel in self)
+
+    def messages(self):
+        return self.closed_messages + sum(channel.messages for channel in self)
+
+    def parse_errors(self):
+        return self.closed_parse_errors + sum(channel.parse_errors for channel in self)
+
+    def __iter__(self):
+        return iter(list(self.__channels))
+
+    def __len__(self):
+        return len(self.__channels)
+
+    def buffered(self):
+        return sum(channel.buffered() for channel in self)
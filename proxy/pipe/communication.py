@@ -1,18 +1,111 @@
 import collections
-import uuid
+import itertools
+import os
+import random
+import time
 
 from proxy.parser.http_parser import HttpRequest, HttpResponse, HttpMessage
 
 
+class Timing:
+    """
+    Where the time of an exchange went. Times are time.monotonic() values, None when unknown, except request_time,
+    which is the wall-clock time (time.time()) of request_head.
+
+    request_head is the time the request head was parsed in streaming mode, otherwise the time its first byte
+    was received. request_forwarded is the time the request was written to the upstream connection.
+    The byte counts are the sizes of the forwarded messages.
+    """
+    __slots__ = ("connection_id", "accepted", "connect_start", "connect_end", "request_head", "request_end",
+                 "request_forwarded", "response_first_byte", "response_end", "request_bytes", "response_bytes",
+                 "request_time")
+
+    def __init__(self, connection_id=None, accepted=None, connect_start=None, connect_end=None):
+        self.connection_id = connection_id
+        self.accepted = accepted
+        self.connect_start = connect_start
+        self.connect_end = connect_end
+        self.request_head = None
+        self.request_end = None
+        self.request_forwarded = None
+        self.response_first_byte = None
+        self.response_end = None
+        self.request_bytes = None
+        self.response_bytes = None
+        self.request_time = None
+
+    def copy(self):
+        timing = Timing()
+        for name in self.__slots__:
+            setattr(timing, name, getattr(self, name))
+        return timing
+
+    def connect_time(self):
+        return self.__duration(self.connect_start, self.connect_end)
+
+    def upstream_time(self):
+        """From forwarding the request to the first byte of the response"""
+        return self.__duration(self.request_forwarded, self.response_first_byte)
+
+    def total_time(self):
+        """From receiving the request to forwarding the whole response"""
+        return self.__duration(self.request_head, self.response_end)
+
+    @staticmethod
+    def __duration(start, end):
+        return end - start if start is not None and end is not None else None
+
+
+class MessageTiming:
+    """Times and size of one message, recorded by the forwarding coroutine and passed to MessagePairer"""
+    __slots__ = ("first_byte", "head", "end", "forwarded", "size")
+
+    def __init__(self, first_byte=None, head=None, end=None, forwarded=None, size=None):
+        self.first_byte = first_byte
+        self.head = head
+        self.end = end
+        self.forwarded = forwarded
+        self.size = size
+
+
+def _reset_guids():
+    global _guid_prefix, _guid_counter
+    # A random prefix per process keeps the ids unique across processes and runs
+    _guid_prefix = random.SystemRandom().getrandbits(64) << 64
+    _guid_counter = itertools.count(1)
+
+
+_reset_guids()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_guids)
+
+
+def new_guid():
+    """128 bit int id, written as 32 hex digits like the uuid4 ids of older captures"""
+    return _guid_prefix | next(_guid_counter)
+
+
+def format_guid(guid):
+    return "%032x" % guid
+
+
+def parse_guid(text):
+    """Accepts both the ids of new_guid and UUIDs"""
+    return int(text.replace("-", ""), 16)
+
+
 class RequestResponse:
+    __slots__ = ("guid", "response", "request", "timing")
+
     def __init__(self, request=None, response=None):
-        self.guid = uuid.uuid4()
+        self.guid = new_guid()
         self.response = response
         self.request = request
+        self.timing = None
 
     def __str__(self):
         s = "====================================================\n"
-        s += "Communication " + str(self.guid) + "\n"
+        s += "Communication " + format_guid(self.guid) + "\n"
         s += "REQUEST:\n"
         s += str(self.request) + "\n"
         s += "RESPONSE:\n"
@@ -35,6 +128,8 @@ class MessageProcessor:
         self.remote_address = proxy_parameters.remote_address
         self.local_port = proxy_parameters.local_port
         self.local_address = proxy_parameters.local_address
+        self.preserve_chunked = proxy_parameters.preserve_chunked
+        self.rewrite_headers = proxy_parameters.rewrite_headers
 
     def __get_address(self, address, port=None):
         if port:
@@ -74,37 +169,69 @@ class MessageProcessor:
         if msg.headers.get(header):
             msg.headers[header] = self.replace_remote_with_local(msg.headers[header])
 
+    def has_rewrites(self):
+        return self.rewrite_headers and self.local_address_with_port() != self.remote_address_with_port()
+
     def process_message(self, msg):
-        self.replace_local_with_remote_in_header(msg, b"Host")
-        self.replace_local_with_remote_in_header(msg, b"Referer")
-        self.replace_remote_with_local_in_header(msg, b"Location")
+        if self.rewrite_headers:
+            self.replace_local_with_remote_in_header(msg, b"Host")
+            self.replace_local_with_remote_in_header(msg, b"Referer")
+            self.replace_remote_with_local_in_header(msg, b"Location")
 
-        if msg.headers.get(b"Transfer-Encoding", "") == b"chunked":
+        if not self.preserve_chunked and msg.is_chunked() and msg.body is not None:
             del msg.headers[b"Transfer-Encoding"]
+            msg.trailers = None
             msg.headers[b"Content-Length"] = str(len(msg.body)).encode()
 
         return msg
 
 
 class MessagePairer:
-    def __init__(self, listener=None):
+    def __init__(self, listener=None, connection_timing=None):
         self.pending = collections.deque()
+        # Connection fields of the timing of every exchange, None = the exchanges are not timed
+        self.connection_timing = connection_timing
+        # Methods of the requests that are still waiting for a response, see track_request_method
+        self.request_methods = collections.deque()
         self.last_class_in_pending = None
         self.listener = listener
 
-    def add_message(self, message: HttpMessage):
+    def add_message(self, message: HttpMessage, message_timing: MessageTiming = None):
         if not isinstance(message, (HttpRequest, HttpResponse)):
             raise Exception("Message must be either request or response")
+        # An interim response (100 Continue) precedes the final one, 101 Switching Protocols is the last one
+        if isinstance(message, HttpResponse) and message.is_informational() and message.status != b"101":
+            return None
 
         if len(self.pending) == 0 or self.last_class_in_pending is message.__class__:
             self.last_class_in_pending = message.__class__
             request_response = RequestResponse()
+            if self.connection_timing:
+                request_response.timing = self.connection_timing.copy()
             self.pending.append(request_response)
         else:
             request_response = self.pending.popleft()
 
         request_response.set_request_or_response(message)
+        if message_timing and request_response.timing:
+            self.__set_timing(request_response.timing, message, message_timing)
         self.have_request_response(request_response)
+        return request_response
+
+    @staticmethod
+    def __set_timing(timing, message, message_timing):
+        if isinstance(message, HttpRequest):
+            timing.request_head = message_timing.head if message_timing.head is not None \
+                else message_timing.first_byte
+            timing.request_end = message_timing.end
+            timing.request_forwarded = message_timing.forwarded
+            timing.request_bytes = message_timing.size
+            if timing.request_head is not None:
+                timing.request_time = time.time() - (time.monotonic() - timing.request_head)
+        else:
+            timing.response_first_byte = message_timing.first_byte
+            timing.response_end = message_timing.end
+            timing.response_bytes = message_timing.size
 
     def add_request(self, request: HttpRequest):
         self.add_message(request)
@@ -121,5 +248,10 @@ class MessageListener:
     def on_request_response(self, request_response: RequestResponse):
         print(request_response)
 
+    def on_request_responses(self, request_responses):
+        """Batch of exchanges, delivered by a DispatchingListener"""
+        for request_response in request_responses:
+            self.on_request_response(request_response)
+
     def on_error(self, error):
         print(error)
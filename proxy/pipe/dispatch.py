@@ -0,0 +1,110 @@
+import collections
+import logging
+import threading
+import time
+from threading import Thread
+
+from proxy.pipe.communication import MessageListener
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_DROP_NEWEST = "drop-newest"
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_INTERVAL = 0.05
+
+logger = logging.getLogger('proxy')
+
+
+class DispatchingListener(MessageListener):
+    """
+    Passes the exchanges reported by the proxy to another listener on a separate thread, so that a slow listener
+    does not stall forwarding.
+
+    The exchanges wait in a bounded queue and are delivered by on_request_responses in batches of at most
+    batch_size, at the latest batch_interval seconds after the first of them was queued. When the queue is full,
+    the overflow policy either blocks the caller until there is room, or drops the oldest or the newest exchange.
+    """
+
+    def __init__(self, listener, max_queue_size=DEFAULT_QUEUE_SIZE, overflow=OVERFLOW_BLOCK,
+                 batch_size=DEFAULT_BATCH_SIZE, batch_interval=DEFAULT_BATCH_INTERVAL):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {}, expected one of {}".format(
+                overflow, ", ".join(OVERFLOW_POLICIES)))
+        self.listener = listener
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.delivered = 0
+        self.batches = 0
+        self.dropped = 0
+        self.__pending = collections.deque()
+        self.__condition = threading.Condition()
+        self.__stopping = False
+        self.thread = Thread(target=self.__run, name="Dispatcher", daemon=True)
+        self.thread.start()
+
+    def on_request_response(self, request_response):
+        with self.__condition:
+            if self.__stopping:
+                self.dropped += 1
+                return
+            if len(self.__pending) >= self.max_queue_size:
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    self.__pending.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.__pending) >= self.max_queue_size and not self.__stopping:
+                        self.__condition.wait()
+            self.__pending.append(request_response)
+            self.__condition.notify_all()
+
+    def on_error(self, error):
+        self.listener.on_error(error)
+
+    def qsize(self):
+        return len(self.__pending)
+
+    def stop(self, timeout=None):
+        """Deliver the exchanges that are still queued and stop the thread"""
+        with self.__condition:
+            self.__stopping = True
+            self.__condition.notify_all()
+        self.thread.join(timeout)
+
+    def __next_batch(self):
+        with self.__condition:
+            while not self.__pending and not self.__stopping:
+                self.__condition.wait()
+
+            deadline = time.monotonic() + self.batch_interval
+            while len(self.__pending) < self.batch_size and not self.__stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__condition.wait(remaining)
+
+            count = min(len(self.__pending), self.batch_size)
+            batch = [self.__pending.popleft() for _ in range(count)]
+            self.__condition.notify_all()
+            return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            if not batch:
+                break
+            # An exchange is reported once for its request and once more for its response
+            batch = list(dict.fromkeys(batch))
+            try:
+                self.listener.on_request_responses(batch)
+            except Exception as e:
+                logger.error('listener error {}'.format(e))
+            self.delivered += len(batch)
+            self.batches += 1
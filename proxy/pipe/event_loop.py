@@ -0,0 +1,37 @@
+import asyncio
+import logging
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+LOOP_AUTO = "auto"
+LOOP_ASYNCIO = "asyncio"
+LOOP_UVLOOP = "uvloop"
+EVENT_LOOPS = (LOOP_AUTO, LOOP_ASYNCIO, LOOP_UVLOOP)
+
+logger = logging.getLogger('proxy')
+
+
+def available_event_loops():
+    return [name for name in EVENT_LOOPS if name != LOOP_UVLOOP or uvloop]
+
+
+def create_event_loop(name=LOOP_AUTO):
+    """
+    Create a new event loop of the given kind.
+    "auto" uses uvloop when it is installed, "uvloop" falls back to the asyncio loop when it is not.
+    """
+    if name not in EVENT_LOOPS:
+        raise ValueError("Unknown event loop {}, expected one of {}".format(name, ", ".join(EVENT_LOOPS)))
+
+    if name in (LOOP_AUTO, LOOP_UVLOOP) and uvloop:
+        loop = uvloop.new_event_loop()
+    else:
+        if name == LOOP_UVLOOP:
+            logger.warning('uvloop is not installed, falling back to the asyncio event loop')
+        loop = asyncio.new_event_loop()
+
+    logger.info('using event loop {}.{}'.format(loop.__class__.__module__, loop.__class__.__name__))
+    return loop
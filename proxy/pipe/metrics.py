@@ -0,0 +1,167 @@
+import asyncio
+import bisect
+import logging
+
+from proxy.pipe.communication import MessageListener
+
+# Upper bounds of the histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx", "other")
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger('proxy')
+
+
+class Histogram:
+    """
+    Prometheus histogram. Observations only increment a plain counter, so they need no lock as long as
+    a single thread (the event loop) observes; scraping may see a value a moment out of date.
+    """
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One more count for the observations above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels=""):
+        """Lines of the histogram, labels e.g. 'status_class="2xx"'"""
+        bucket_labels = labels + "," if labels else ""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield '{}_bucket{{{}le="{}"}} {}'.format(name, bucket_labels, bound, total)
+        total += self.counts[-1]
+        yield '{}_bucket{{{}le="+Inf"}} {}'.format(name, bucket_labels, total)
+        labels = "{" + labels + "}" if labels else ""
+        yield '{}_sum{} {}'.format(name, labels, self.sum)
+        yield '{}_count{} {}'.format(name, labels, total)
+
+
+def status_class(response):
+    status = response.status
+    if status and len(status) == 3 and status[:1] in b"12345":
+        return status[:1].decode() + "xx"
+    return "other"
+
+
+class ProxyMetrics:
+    """
+    Metrics of a proxy in the Prometheus text format.
+
+    Most values are not counted on the forwarding path, they are summed from the counters the channels,
+    the capture tap and the dispatcher keep anyway when the metrics are scraped. Only the latencies are observed
+    as they happen.
+    """
+
+    def __init__(self, channels, capture_tap=None, dispatcher=None):
+        self.channels = channels
+        self.capture_tap = capture_tap
+        self.dispatcher = dispatcher
+        self.upstream_connect = Histogram()
+        self.request_latency = {name: Histogram() for name in STATUS_CLASSES}
+
+    def observe_exchange(self, request_response):
+        timing = request_response.timing
+        if timing and request_response.response is not None:
+            duration = timing.total_time()
+            if duration is not None:
+                self.request_latency[status_class(request_response.response)].observe(duration)
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help, value):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("{} {}".format(name, value))
+
+        channels = self.channels
+        metric("pyproxy_connections_active", "gauge", "Open client connections.", channels.connections_active)
+        metric("pyproxy_connections_total", "counter", "Accepted client connections.", channels.connections_total)
+        metric("pyproxy_received_bytes_total", "counter", "Bytes read from clients and upstreams.",
+               channels.bytes_read())
+        metric("pyproxy_sent_bytes_total", "counter", "Bytes written to clients and upstreams.",
+               channels.bytes_written())
+
+        messages = channels.messages()
+        parse_errors = channels.parse_errors()
+        if self.capture_tap:
+            messages += self.capture_tap.messages
+            parse_errors += self.capture_tap.parse_errors
+        metric("pyproxy_messages_parsed_total", "counter", "HTTP messages parsed.", messages)
+        metric("pyproxy_parse_errors_total", "counter", "Connections closed because of a parse error.",
+               parse_errors)
+
+        if self.capture_tap:
+            metric("pyproxy_capture_queue_depth", "gauge", "Reads waiting for the capture thread.",
+                   self.capture_tap.qsize())
+            metric("pyproxy_capture_dropped_bytes_total", "counter", "Bytes not captured because the queue was full.",
+                   self.capture_tap.dropped_bytes)
+        if self.dispatcher:
+            metric("pyproxy_dispatch_queue_depth", "gauge", "Exchanges waiting for the listener.",
+                   self.dispatcher.qsize())
+            metric("pyproxy_dispatch_dropped_total", "counter", "Exchanges dropped because the queue was full.",
+                   self.dispatcher.dropped)
+
+        lines.append("# HELP pyproxy_upstream_connect_seconds Time to connect to the upstream.")
+        lines.append("# TYPE pyproxy_upstream_connect_seconds histogram")
+        lines.extend(self.upstream_connect.samples("pyproxy_upstream_connect_seconds"))
+
+        lines.append("# HELP pyproxy_request_duration_seconds Time from receiving a request to receiving its response.")
+        lines.append("# TYPE pyproxy_request_duration_seconds histogram")
+        for name, histogram in self.request_latency.items():
+            lines.extend(histogram.samples("pyproxy_request_duration_seconds", 'status_class="{}"'.format(name)))
+
+        lines.append("")
+        return "\n".join(lines).encode()
+
+
+class MetricsListener(MessageListener):
+    """
+    Observes the latency of every complete exchange and passes it on to the listener.
+    Used on the event loop, where every exchange is reported once with its response.
+    """
+
+    def __init__(self, listener, metrics):
+        self.listener = listener
+        self.metrics = metrics
+
+    def on_request_response(self, request_response):
+        self.metrics.observe_exchange(request_response)
+        self.listener.on_request_response(request_response)
+
+    def on_error(self, error):
+        self.listener.on_error(error)
+
+
+async def start_metrics_server(metrics, host, port):
+    """Serve the metrics to GET requests on any path"""
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request_line.startswith(b"GET "):
+                body = metrics.render()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                             b"Connection: close\r\n\r\n" % (CONTENT_TYPE, len(body)))
+                writer.write(body)
+            else:
+                writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+        except Exception as e:
+            logger.info('metrics request error {}'.format(e))
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host=host, port=port)
+    for s in server.sockets:
+        logger.info('serving metrics on {}'.format(s.getsockname()))
+    return server
@@ -0,0 +1,121 @@
+"""
+Header rewriting in raw pass-through mode.
+
+RawRewriter follows the framing of the forwarded bytes to find the message heads. A head that contains one of
+the addresses to replace is parsed and rewritten, every other byte (bodies, chunks, heads without an address)
+is forwarded as it was received, without being copied.
+"""
+
+from proxy.parser.http_parser import BODY_CHUNKED, BODY_LENGTH, BODY_UNTIL_CLOSE, parse_head, track_request_method
+
+HEAD, BODY, CHUNK_SIZE, CHUNK, TRAILERS, RAW = range(6)
+# Heads and chunk lines are not expected to be longer, a stream that has them is forwarded raw
+MAX_LINE_BUFFER = 64 * 1024
+
+
+class RawRewriter:
+    """
+    One direction of a connection. The two directions share request_methods, the methods of the requests waiting
+    for a response, which decide whether a response has a body.
+    """
+
+    def __init__(self, processor, request_methods):
+        self.processor = processor
+        # The other direction, switched to RAW together with this one after 101 Switching Protocols
+        self.peer = None
+        self.request_methods = request_methods
+        self.addresses = (processor.local_address_without_port(), processor.remote_address_without_port())
+        self.state = HEAD
+        self.buffer = b""
+        # Bytes of the body or of the chunk (with its CRLF) still to forward
+        self.remaining = 0
+        self.rewritten = 0
+
+    def feed(self, data):
+        """The pieces to forward for the received data"""
+        pieces = []
+        data = memoryview(data)
+        while data:
+            if self.state == RAW:
+                if self.buffer:
+                    pieces.append(self.buffer)
+                    self.buffer = b""
+                pieces.append(data)
+                break
+            elif self.state in (BODY, CHUNK):
+                count = min(self.remaining, len(data))
+                pieces.append(data[:count])
+                data = data[count:]
+                self.remaining -= count
+                if not self.remaining:
+                    self.state = HEAD if self.state == BODY else CHUNK_SIZE
+            else:
+                data = self.__feed_line_state(data, pieces)
+        return pieces
+
+    def __feed_line_state(self, data, pieces):
+        """Collect a head, a chunk size line or a trailer line, return the data after it"""
+        delimiter = b"\r\n\r\n" if self.state == HEAD else b"\r\n"
+        start = max(0, len(self.buffer) - len(delimiter) + 1)
+        self.buffer += bytes(data)
+        end = self.buffer.find(delimiter, start)
+        if end < 0:
+            if len(self.buffer) > MAX_LINE_BUFFER:
+                self.__give_up(pieces)
+            return data[len(data):]
+        end += len(delimiter)
+        rest = len(self.buffer) - end
+        line, self.buffer = self.buffer[:end], b""
+        try:
+            pieces.append(self.__complete(line))
+        except Exception:
+            self.buffer = line
+            self.__give_up(pieces)
+        return data[len(data) - rest:]
+
+    def __complete(self, line):
+        if self.state == CHUNK_SIZE:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            self.state, self.remaining = (CHUNK, size + 2) if size else (TRAILERS, 0)
+            return line
+        if self.state == TRAILERS:
+            if line == b"\r\n":
+                self.state = HEAD
+            return line
+
+        # Empty lines may precede a message
+        head = line.lstrip(b"\r\n")
+        if not head:
+            return line
+        empty_lines = line[:len(line) - len(head)]
+        message = parse_head(head)
+        track_request_method(message, self.request_methods)
+        framing = message.body_framing()
+        if framing == BODY_LENGTH:
+            self.state, self.remaining = BODY, message.content_length()
+            if not self.remaining:
+                self.state = HEAD
+        elif framing == BODY_CHUNKED:
+            self.state = CHUNK_SIZE
+        elif framing == BODY_UNTIL_CLOSE:
+            self.state = RAW
+        if getattr(message, "status", None) == b"101":
+            # Another protocol follows in both directions
+            self.state = RAW
+            if self.peer:
+                self.peer.state = RAW
+
+        if not any(address in head for address in self.addresses):
+            return line
+        self.processor.process_message(message)
+        rewritten = b"".join(message.head_to_bytes())
+        if rewritten == head:
+            return line
+        self.rewritten += 1
+        return empty_lines + rewritten
+
+    def __give_up(self, pieces):
+        """Bytes that do not look like HTTP are forwarded as they are, and so is the rest of the stream"""
+        pieces.append(self.buffer)
+        self.buffer = b""
+        self.state = RAW
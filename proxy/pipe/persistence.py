@@ -1,23 +1,76 @@
+import collections
+import mmap
+import os
 from io import BufferedIOBase
-from uuid import UUID
 
 from proxy.parser.parser_utils import get_word, intialize_parser, parse
-from proxy.pipe.communication import RequestResponse
+from proxy.pipe.communication import RequestResponse, Timing, format_guid, parse_guid
 
-from proxy.parser.http_parser import HttpMessage, get_http_request, get_line
+from proxy.parser.http_parser import BODY_CHUNKED, BODY_LENGTH, BODY_UNTIL_CLOSE, HttpHeaders, HttpMessage, \
+    LazyHttpRequest, LazyHttpResponse, get_http_request, get_line, parse_head, track_request_method
+
+
+# Starts every pair but the first one
+PAIR_SEPARATOR = b"\r\nPair: "
 
 
 def serialize_message(msg: HttpMessage, stream: BufferedIOBase):
-    for b in msg.to_bytes():
-        stream.write(b)
+    if msg.body_framing() == BODY_UNTIL_CLOSE and b"Transfer-Encoding" not in msg.headers:
+        # A body delimited by the end of the connection would run into the next pair, its length is written instead
+        body = msg.body or b""
+        stream.write(b"".join(msg.head_to_bytes())[:-2])
+        stream.write(b"Content-Length: %d\r\n\r\n" % len(body))
+        stream.write(body)
+    else:
+        for b in msg.to_bytes():
+            stream.write(b)
     stream.write(b"\r\n")
 
 
+READ_SIZE = 65536
+TIMING_COUNTS = ("connection_id", "request_bytes", "response_bytes")
+
+
+def format_timing(timing: Timing):
+    values = (getattr(timing, name) for name in Timing.__slots__)
+    return b" ".join(b"-" if value is None else repr(value).encode() for value in values)
+
+
+def serialize_timing(timing: Timing, stream: BufferedIOBase):
+    stream.write(b"Timing: ")
+    stream.write(format_timing(timing))
+    stream.write(b"\r\n")
+
+
+def parse_timing(line):
+    timing = Timing()
+    for name, value in zip(Timing.__slots__, line.split(b" ")):
+        if value != b"-":
+            setattr(timing, name, int(value) if name in TIMING_COUNTS else float(value))
+    return timing
+
+
+def compact_trailers(trailers):
+    """The trailers as the bytes of a header section, None if there are none"""
+    if trailers is None:
+        return None
+    return b"".join(b"%s: %s\r\n" % item for item in trailers.items()) + b"\r\n"
+
+
+def restore_trailers(raw):
+    if raw is None:
+        return None
+    return HttpHeaders(raw) if raw != b"\r\n" else HttpHeaders()
+
+
 def serialize_message_pair(rr: RequestResponse, stream: BufferedIOBase):
     stream.write(b"Pair: ")
-    stream.write(str(rr.guid.hex).encode())
+    stream.write(format_guid(rr.guid).encode())
     stream.write(b"\r\n")
 
+    if rr.timing:
+        serialize_timing(rr.timing, stream)
+
     if rr.request:
         stream.write(b"Request: ")
         serialize_message(rr.request, stream)
@@ -39,28 +92,199 @@ def serialize_message_pairs(pairs, stream: BufferedIOBase):
 def parse_message_pair(data):
     kw, data = yield from get_word(data)
     assert kw == b"Pair:"
-    uuid_str, data = yield from get_word(data)
+    guid_str, data = yield from get_word(data)
     rr = RequestResponse()
-    rr.guid = UUID(hex=uuid_str.decode())
+    rr.guid = parse_guid(guid_str.decode())
+    request_methods = collections.deque()
 
     kw, data = yield from get_word(data)
+    if kw == b"Timing:":
+        line, data = yield from get_line(data)
+        rr.timing = parse_timing(line)
+        kw, data = yield from get_word(data)
+
     if kw == b"Request:":
-        rr.request, data = yield from get_http_request(data)
-        _, data = yield from get_line(data)  # Read the newline
+        rr.request, data = yield from get_message(data, request_methods)
 
     kw, data = yield from get_word(data)
     if kw == b"Response:":
-        rr.response, data = yield from get_http_request(data)
-        _, data = yield from get_line(data)  # Read the newline
+        rr.response, data = yield from get_message(data, request_methods)
 
     return rr, data
 
 
+def get_message(data, request_methods):
+    message, data = yield from get_http_request(data, request_methods, get_until_next_pair)
+    if message.body_framing() != BODY_UNTIL_CLOSE:
+        _, data = yield from get_line(data)  # Read the newline
+    return message, data
+
+
+def get_until_next_pair(data):
+    """
+    A body written up to the end of the connection (by older versions, without Content-Length) ends before
+    the next pair, or with the newline at the end of the capture
+    """
+    start = 0
+    index = data.find(PAIR_SEPARATOR)
+    while index < 0:
+        # Only allow for a separator split between reads
+        start = max(0, len(data) - len(PAIR_SEPARATOR) + 1)
+        more_data = yield
+        if not more_data:
+            body = data.take_all()
+            return body[:-2] if body.endswith(b"\r\n") else body, data
+        data.extend(more_data)
+        index = data.find(PAIR_SEPARATOR, start)
+
+    body = data.take(index)
+    data.skip(2)  # The newline of the message
+    return body, data
+
+
 def parse_message_pairs(stream: BufferedIOBase):
     parser = intialize_parser(parse_message_pair)
 
-    data = stream.read(1024)
+    data = stream.read(READ_SIZE)
     while data:
         for rr in parse(parser, data):
             yield rr
-        data = stream.read(1024)
+        data = stream.read(READ_SIZE)
+    # The end of the stream completes a body written up to the end of the connection
+    yield from parse(parser, None)
+
+
+SPACES = b" \t\r\n"
+
+
+class MappedCapture:
+    """
+    Scans a capture in the persistence format that is mapped to memory. Only the words, the heads and the chunk
+    sizes are read, the bodies are skipped and kept as memoryview slices of the map.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.position = 0
+
+    def skip_spaces(self):
+        data, position = self.data, self.position
+        while position < len(data) and data[position] in SPACES:
+            position += 1
+        self.position = position
+
+    def get_word(self):
+        self.skip_spaces()
+        data, start = self.data, self.position
+        end = start
+        while end < len(data) and data[end] not in SPACES:
+            end += 1
+        self.position = end
+        return data[start:end]
+
+    def get_line(self):
+        end = self.find(b"\r\n")
+        line = self.data[self.position:end]
+        self.position = end + 2
+        return line
+
+    def find(self, separator):
+        end = self.data.find(separator, self.position)
+        if end < 0:
+            raise ValueError("Truncated capture at {}".format(self.position))
+        return end
+
+    def get_slice(self, length):
+        end = self.position + length
+        if end > len(self.data):
+            raise ValueError("Truncated capture at {}".format(self.position))
+        piece = self.view[self.position:end]
+        self.position = end
+        return piece
+
+    def get_message(self, request_methods):
+        self.skip_spaces()
+        end = self.find(b"\r\n\r\n") + 4
+        message = parse_head(self.data[self.position:end], LazyHttpRequest, LazyHttpResponse)
+        self.position = end
+        track_request_method(message, request_methods)
+
+        framing = message.body_framing()
+        pieces = []
+        trailers = HttpHeaders()
+        if framing == BODY_LENGTH:
+            pieces.append(self.get_slice(message.content_length()))
+        elif framing == BODY_CHUNKED:
+            while True:
+                chunk_size = int(self.get_line().split(b";", 1)[0].strip(), 16)
+                if chunk_size == 0:
+                    break
+                pieces.append(self.get_slice(chunk_size))
+                self.get_line()  # the trailing CRLF
+            if self.data[self.position:self.position + 2] == b"\r\n":
+                self.position += 2
+            else:
+                end = self.find(b"\r\n\r\n") + 4
+                trailers = HttpHeaders(self.data[self.position:end])
+                self.position = end
+        elif framing == BODY_UNTIL_CLOSE:
+            # The body was written up to the end of the connection, it ends before the next pair
+            end = self.data.find(PAIR_SEPARATOR, self.position)
+            if end < 0:
+                end = len(self.data) - 2 if self.data[-2:] == b"\r\n" else len(self.data)
+            pieces.append(self.get_slice(end - self.position))
+        else:
+            return message
+
+        message.body_loader = lambda: (b"".join(pieces), trailers)
+        return message
+
+    def get_message_pair(self):
+        kw = self.get_word()
+        if kw != b"Pair:":
+            raise ValueError("Expected Pair: at {}, found {!r}".format(self.position, kw[:20]))
+        rr = RequestResponse()
+        rr.guid = parse_guid(self.get_word().decode())
+        request_methods = collections.deque()
+
+        kw = self.get_word()
+        if kw == b"Timing:":
+            self.skip_spaces()
+            rr.timing = parse_timing(self.get_line())
+            kw = self.get_word()
+
+        if kw == b"Request:":
+            rr.request = self.get_message(request_methods)
+
+        kw = self.get_word()
+
+        if kw == b"Response:":
+            rr.response = self.get_message(request_methods)
+
+        return rr
+
+    def message_pairs(self):
+        while True:
+            self.skip_spaces()
+            if self.position >= len(self.data):
+                return
+            yield self.get_message_pair()
+
+
+def map_capture(file_name):
+    """Map a capture file to memory, None if it is empty"""
+    with open(file_name, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def map_message_pairs(file_name):
+    """
+    Like parse_message_pairs, but the file is mapped to memory and the bodies are copied out of the map only
+    when they are first accessed. The map stays open while any of the messages is not fully loaded.
+    """
+    data = map_capture(file_name)
+    if data is not None:
+        yield from MappedCapture(data).message_pairs()
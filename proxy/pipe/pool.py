@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import logging
+import time
+
+from proxy.pipe.channel import set_write_buffer_limits
+
+DEFAULT_MAX_SIZE = 100
+DEFAULT_MAX_IDLE = 10
+DEFAULT_IDLE_TIMEOUT = 30
+DEFAULT_MAX_LIFETIME = 300
+
+logger = logging.getLogger('proxy')
+
+
+def is_keep_alive(message):
+    """Whether the connection stays open after the message, see RFC 7230, section 6.3"""
+    connection = message.headers.get(b"Connection", b"").lower()
+    if b"close" in connection:
+        return False
+    if message.version == b"HTTP/1.0":
+        return b"keep-alive" in connection
+    return True
+
+
+class PooledConnection:
+    def __init__(self, reader, writer, connect_start=None):
+        self.reader = reader
+        self.writer = writer
+        self.created = time.monotonic()
+        self.connect_start = connect_start
+        self.last_used = self.created
+        self.reused = False
+
+    def is_usable(self, now, idle_timeout, max_lifetime):
+        if now - self.created > max_lifetime or now - self.last_used > idle_timeout:
+            return False
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class UpstreamPool:
+    """
+    Keep-alive connections to one upstream, shared by all client connections.
+
+    At most max_size connections are open at a time (acquire waits for a free one) and at most max_idle of them
+    are kept when they are not used. Connections idle for longer than idle_timeout or open for longer than
+    max_lifetime are closed instead of being handed out.
+    """
+
+    def __init__(self, host, port, max_size=DEFAULT_MAX_SIZE, max_idle=DEFAULT_MAX_IDLE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, max_lifetime=DEFAULT_MAX_LIFETIME, connect_timeout=5,
+                 write_buffer_limits=(None, None)):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.connect_timeout = connect_timeout
+        self.write_buffer_limits = write_buffer_limits
+        # Called with the time it took to open every new connection
+        self.on_connect = None
+        self.__idle = collections.deque()
+        self.__semaphore = asyncio.Semaphore(max_size)
+        self.connects = 0
+        self.reuses = 0
+
+    def idle_count(self):
+        return len(self.__idle)
+
+    async def acquire(self, fresh=False):
+        """A connection to the upstream, an idle one unless fresh"""
+        await self.__semaphore.acquire()
+        now = time.monotonic()
+        while self.__idle and not fresh:
+            # The most recently used connection is the least likely to be closed by the upstream
+            connection = self.__idle.pop()
+            if connection.is_usable(now, self.idle_timeout, self.max_lifetime):
+                connection.reused = True
+                self.reuses += 1
+                return connection
+            connection.close()
+
+        connect_start = time.monotonic()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host=self.host, port=self.port), timeout=self.connect_timeout)
+        except BaseException:
+            self.__semaphore.release()
+            raise
+        self.connects += 1
+        if self.on_connect:
+            self.on_connect(time.monotonic() - connect_start)
+        set_write_buffer_limits(writer, *self.write_buffer_limits)
+        logger.info('connected to remote {} -> {}'.format(writer.get_extra_info('sockname'),
+                                                          writer.get_extra_info('peername')))
+        return PooledConnection(reader, writer, connect_start)
+
+    def release(self, connection, reusable):
+        now = time.monotonic()
+        if reusable and len(self.__idle) < self.max_idle and \
+                connection.is_usable(now, self.idle_timeout, self.max_lifetime):
+            connection.last_used = now
+            self.__idle.append(connection)
+        else:
+            connection.close()
+        self.__semaphore.release()
+
+    def close(self):
+        while self.__idle:
+            self.__idle.pop().close()
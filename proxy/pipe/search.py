@@ -0,0 +1,179 @@
+"""
+Full-text search over captured exchanges.
+
+An inverted index maps every token (a run of letters, digits or underscores, lower case) of the first lines
+and the headers to the ids of the exchanges that contain it, and optionally of the start of the decoded bodies.
+Exchanges are indexed by a background thread as they are added, a search intersects the sets of its tokens.
+"""
+
+import codecs
+import logging
+import re
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+
+TOKEN = re.compile(r"\w+")
+# Longer tokens are mostly encoded binary data, nobody searches for them
+MAX_TOKEN_LENGTH = 64
+# Only the start of the bodies is indexed, decoded
+DEFAULT_MAX_INDEXED_BODY = 64 * 1024
+# Exchanges waiting to be indexed, the ones added past it are not indexed
+DEFAULT_MAX_PENDING = 50000
+
+logger = logging.getLogger('proxy')
+
+
+def tokens(text):
+    return set(token for token in TOKEN.findall(text.lower()) if len(token) <= MAX_TOKEN_LENGTH)
+
+
+def body_text(message, max_bytes=DEFAULT_MAX_INDEXED_BODY):
+    """
+    The first max_bytes of the decoded body as text, "" if it is binary. Only a body held in memory is indexed,
+    one that was not loaded yet (mapped captures, archives, the database) stays on disk.
+    """
+    if getattr(message, "body_loader", None) is not None or not message.body:
+        return ""
+    try:
+        encoding = message.headers.get(b"Content-Encoding", b"").strip().lower()
+        if encoding in (b"gzip", b"deflate"):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == b"gzip" else zlib.MAX_WBITS)
+            body = decompressor.decompress(message.body, max_bytes)
+        else:
+            body = message.body[:max_bytes]
+        charset = message.get_charset()
+        # Not final, a character cut at the end of the indexed bytes is left out
+        decoder = codecs.getincrementaldecoder(charset.decode() if charset else "utf-8")()
+        return decoder.decode(bytes(body))
+    except (zlib.error, LookupError, UnicodeDecodeError):
+        return ""
+
+
+def message_text(message, index_bodies=False, max_body=DEFAULT_MAX_INDEXED_BODY):
+    parts = [message.first_line().decode("latin-1")]
+    for name, value in message.headers.items():
+        parts.append(name.decode("latin-1"))
+        parts.append(value.decode("latin-1"))
+    if index_bodies:
+        parts.append(body_text(message, max_body))
+    return "\n".join(parts)
+
+
+def exchange_tokens(request_response, index_bodies=False, max_body=DEFAULT_MAX_INDEXED_BODY):
+    result = set()
+    for message in (request_response.request, request_response.response):
+        if message is not None:
+            result |= tokens(message_text(message, index_bodies, max_body))
+    return result
+
+
+class SearchIndex:
+    """
+    Incremental inverted index token -> exchange ids. add() and remove() are only queued, the thread
+    of the index carries them out in order; version grows with every change.
+
+    The tokens of an exchange are not kept, remove() takes the exchange and finds them again in its text.
+    At most max_pending exchanges wait to be indexed, the ones added past it are counted in dropped and cannot
+    be found. An exchange removed before it was indexed is only forgotten.
+    """
+
+    def __init__(self, index_bodies=False, max_body=DEFAULT_MAX_INDEXED_BODY, max_pending=DEFAULT_MAX_PENDING):
+        self.index_bodies = index_bodies
+        self.max_body = max_body
+        self.max_pending = max_pending
+        self.postings = defaultdict(set)
+        # Ids of the indexed exchanges
+        self.indexed = set()
+        self.version = 0
+        self.dropped = 0
+        self.__changed = threading.Condition()
+        # guid -> (action, exchange), in the order they were queued
+        self.__pending = OrderedDict()
+        # Id of the exchange the thread is working on, outside of the lock
+        self.__current = None
+        # Exchanges taken before the last clear() are not indexed
+        self.__generation = 0
+        self.thread = threading.Thread(target=self.__run, name="SearchIndex", daemon=True)
+        self.thread.start()
+
+    def add(self, request_response):
+        guid = request_response.guid
+        with self.__changed:
+            if guid not in self.__pending and len(self.__pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self.__pending[guid] = (self.__index, request_response)
+            self.__changed.notify_all()
+
+    def remove(self, request_response):
+        """Remove an exchange with the same text as when it was added, the evicted one"""
+        guid = request_response.guid
+        with self.__changed:
+            if guid in self.indexed or guid == self.__current:
+                # Not dropped over max_pending, the postings would keep the id
+                self.__pending[guid] = (self.__unindex, request_response)
+                self.__changed.notify_all()
+            else:
+                self.__pending.pop(guid, None)
+
+    def clear(self):
+        with self.__changed:
+            self.__generation += 1
+            self.__pending.clear()
+            self.postings = defaultdict(set)
+            self.indexed = set()
+            self.version += 1
+            self.__changed.notify_all()
+
+    def pending(self):
+        return len(self.__pending)
+
+    def join(self):
+        """Wait until the queued exchanges are indexed"""
+        with self.__changed:
+            while self.__pending or self.__current is not None:
+                self.__changed.wait()
+
+    def __index(self, guid, found):
+        for token in found:
+            self.postings[token].add(guid)
+        self.indexed.add(guid)
+
+    def __unindex(self, guid, found):
+        for token in found:
+            ids = self.postings.get(token)
+            if ids is not None:
+                ids.discard(guid)
+                if not ids:
+                    del self.postings[token]
+        self.indexed.discard(guid)
+
+    def search(self, query):
+        """Ids of the exchanges containing all tokens of the query, None if the query has no tokens"""
+        wanted = tokens(query)
+        if not wanted:
+            return None
+        with self.__changed:
+            sets = sorted((self.postings.get(token, ()) for token in wanted), key=len)
+            return set(sets[0]).intersection(*sets[1:])
+
+    def __run(self):
+        while True:
+            with self.__changed:
+                while not self.__pending:
+                    self.__changed.wait()
+                guid, (action, request_response) = self.__pending.popitem(last=False)
+                self.__current = guid
+                generation = self.__generation
+            try:
+                found = exchange_tokens(request_response, self.index_bodies, self.max_body)
+            except Exception as e:
+                logger.error('search index error {}'.format(e))
+                found = set()
+            with self.__changed:
+                if generation == self.__generation:
+                    action(guid, found)
+                    self.version += 1
+                self.__current = None
+                self.__changed.notify_all()
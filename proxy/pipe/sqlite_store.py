@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Capture store in a SQLite database (WAL mode), written in one transaction per batch of exchanges.
+
+Every exchange is a row with indexed columns for the time of its request, the method, host, path, status and SOAP
+method, so that pages of matching exchanges are read with indexed queries. Bodies are kept in the row, or with
+body_dir in files named by the digest of the body, so that identical bodies are written once.
+The exchanges read from the database load their bodies when they are first accessed.
+
+List stored exchanges: python -m proxy.pipe.sqlite_store capture.db [--method POST] [--status 500] [--after ID]
+"""
+
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+from proxy.parser.http_parser import LazyHttpRequest, LazyHttpResponse, parse_head
+from proxy.pipe.blobs import body_digest
+from proxy.pipe.communication import MessageListener, RequestResponse, format_guid
+from proxy.pipe.persistence import compact_trailers, format_timing, parse_timing, restore_trailers
+from proxy.utils import soap2python
+
+DEFAULT_PAGE_SIZE = 1000
+# Bodies from this size on are written to files when there is a body_dir
+DEFAULT_EXTERNAL_BODY_SIZE = 64 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exchanges (
+    id INTEGER PRIMARY KEY,
+    guid BLOB NOT NULL UNIQUE,
+    time REAL NOT NULL,
+    method TEXT,
+    host TEXT,
+    path TEXT,
+    status INTEGER,
+    soap_method TEXT,
+    timing BLOB,
+    request_head BLOB,
+    request_body BLOB,
+    request_body_file TEXT,
+    request_trailers BLOB,
+    response_head BLOB,
+    response_body BLOB,
+    response_body_file TEXT,
+    response_trailers BLOB
+);
+CREATE INDEX IF NOT EXISTS exchanges_time ON exchanges (time);
+CREATE INDEX IF NOT EXISTS exchanges_method ON exchanges (method);
+CREATE INDEX IF NOT EXISTS exchanges_host ON exchanges (host);
+CREATE INDEX IF NOT EXISTS exchanges_path ON exchanges (path);
+CREATE INDEX IF NOT EXISTS exchanges_status ON exchanges (status);
+CREATE INDEX IF NOT EXISTS exchanges_soap_method ON exchanges (soap_method);
+CREATE TABLE IF NOT EXISTS properties (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+MESSAGE_COLUMNS = ("head", "body", "body_file", "trailers")
+COLUMNS = ("guid", "time", "method", "host", "path", "status", "soap_method", "timing") + \
+          tuple("request_" + name for name in MESSAGE_COLUMNS) + tuple("response_" + name for name in MESSAGE_COLUMNS)
+# An exchange is stored when its request arrives and updated with its response, it keeps its id and time
+UPSERT = "INSERT INTO exchanges ({}) VALUES ({}) ON CONFLICT (guid) DO UPDATE SET {}".format(
+    ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS)),
+    ", ".join("{0} = excluded.{0}".format(name) for name in COLUMNS[2:]))
+
+# Filters of page(), all of them use an index
+FILTERS = ("method", "host", "path", "status", "soap_method")
+
+
+def text(value):
+    return value.decode("latin-1") if value is not None else None
+
+
+def soap_method(request):
+    """Name of the SOAP operation a request calls, None if it is not a SOAP request"""
+    if request is None or not request.body:
+        return None
+    try:
+        content_type = request.get_content_type()
+        if b"soap" in content_type or (b"xml" in content_type and "schemas.xmlsoap.org" in request.body_as_text()):
+            tag = soap2python.parse_soap_from_string(request.body_as_text()).tag
+            return tag[tag.rfind("}") + 1:]
+    except Exception:
+        pass
+    return None
+
+
+class CaptureDatabase(MessageListener):
+    """
+    Writes the exchanges it is notified of to the database, batches delivered by a DispatchingListener are written
+    in one transaction. The same object reads the pages, the connection is shared under a lock.
+    """
+
+    def __init__(self, path, body_dir=None, external_body_size=DEFAULT_EXTERNAL_BODY_SIZE, read_only=False):
+        self.path = path
+        self.external_body_size = external_body_size
+        self.lock = threading.Lock()
+        if read_only:
+            # Another file picked by mistake is neither modified nor turned into a database
+            uri = "file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(path)))
+            try:
+                self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            except sqlite3.DatabaseError:
+                raise ValueError("{} is not a capture database".format(path))
+            try:
+                tables = set(row[0] for row in self.connection.execute("SELECT name FROM sqlite_master"))
+            except sqlite3.DatabaseError:
+                tables = set()
+            if "exchanges" not in tables:
+                self.connection.close()
+                raise ValueError("{} is not a capture database".format(path))
+            row = self.connection.execute("SELECT value FROM properties WHERE name = 'body_dir'").fetchone() \
+                if "properties" in tables else None
+            self.body_dir = row[0] if row else None
+            return
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # With WAL, a crash can lose the last transactions but does not corrupt the database
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+
+        # The directory of the body files is remembered, so that readers find it without being told
+        if body_dir:
+            body_dir = os.path.abspath(body_dir)
+            os.makedirs(body_dir, exist_ok=True)
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO properties VALUES ('body_dir', ?)", (body_dir,))
+        else:
+            row = self.connection.execute("SELECT value FROM properties WHERE name = 'body_dir'").fetchone()
+            body_dir = row[0] if row else None
+        self.body_dir = body_dir
+
+    def on_request_response(self, request_response):
+        self.on_request_responses([request_response])
+
+    def on_request_responses(self, request_responses):
+        rows = [self.__row(rr) for rr in request_responses]
+        with self.lock, self.connection:
+            self.connection.executemany(UPSERT, rows)
+
+    def on_error(self, error):
+        pass
+
+    def __row(self, rr):
+        request, response = rr.request, rr.response
+        # The wall clock time of the request, the time it is stored for exchanges captured without timing
+        timing = rr.timing
+        request_time = timing.request_time if timing and timing.request_time is not None else time.time()
+        return ((rr.guid.to_bytes(16, "big"), request_time,
+                 text(request.method) if request else None,
+                 text(request.headers.get(b"Host")) if request else None,
+                 text(request.path) if request else None,
+                 int(response.status) if response and response.status.isdigit() else None,
+                 soap_method(request),
+                 format_timing(rr.timing) if rr.timing else None)
+                + self.__message_columns(request) + self.__message_columns(response))
+
+    def __message_columns(self, message):
+        if message is None:
+            return None, None, None, None
+        head = b"".join(message.head_to_bytes())
+        body = message.body
+        trailers = compact_trailers(message.trailers)
+        if body is not None and self.body_dir and len(body) >= self.external_body_size:
+            file_name = body_digest(body).hex()
+            path = os.path.join(self.body_dir, file_name)
+            if not os.path.exists(path):
+                with open(path + ".tmp", "wb") as f:
+                    f.write(body)
+                os.replace(path + ".tmp", path)
+            return head, None, file_name, trailers
+        return head, body, None, trailers
+
+    def count(self, **filters):
+        where, parameters = self.__where(filters)
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM exchanges" + where, parameters).fetchone()[0]
+
+    def page(self, after=0, limit=DEFAULT_PAGE_SIZE, since=None, until=None, **filters):
+        """
+        Up to limit exchanges matching the filters (column=value, see FILTERS, since and until for the time.time()
+        of the request), whose ids are above after, in the order they were stored. Returns a list
+        of (id, RequestResponse), the next page starts after the last id.
+        """
+        where, parameters = self.__where(filters, since, until)
+        where += " AND id > ?" if where else " WHERE id > ?"
+        query = "SELECT id, guid, method, timing, request_head, response_head FROM exchanges{} ORDER BY id LIMIT ?"
+        with self.lock:
+            rows = self.connection.execute(query.format(where), parameters + [after, limit]).fetchall()
+        return [(row[0], self.__request_response(*row)) for row in rows]
+
+    @staticmethod
+    def __where(filters, since=None, until=None):
+        conditions = []
+        parameters = []
+        for name, value in filters.items():
+            if name not in FILTERS:
+                raise ValueError("Unknown filter {}, expected one of {}".format(name, ", ".join(FILTERS)))
+            if value is not None:
+                conditions.append("{} = ?".format(name))
+                parameters.append(value)
+        if since is not None:
+            conditions.append("time >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            parameters.append(until)
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+    def __request_response(self, id, guid, method, timing, request_head, response_head):
+        rr = RequestResponse()
+        rr.guid = int.from_bytes(guid, "big")
+        if timing is not None:
+            rr.timing = parse_timing(timing)
+        if request_head is not None:
+            rr.request = parse_head(request_head, LazyHttpRequest, LazyHttpResponse)
+            rr.request.body_loader = self.__body_loader(id, "request")
+        if response_head is not None:
+            rr.response = parse_head(response_head, LazyHttpRequest, LazyHttpResponse)
+            rr.response.request_method = method.encode("latin-1") if method else None
+            rr.response.body_loader = self.__body_loader(id, "response")
+        return rr
+
+    def __body_loader(self, id, message):
+        def load_body():
+            query = "SELECT {0}_body, {0}_body_file, {0}_trailers FROM exchanges WHERE id = ?".format(message)
+            with self.lock:
+                body, file_name, trailers = self.connection.execute(query, (id,)).fetchone()
+            if file_name is not None:
+                with open(os.path.join(self.body_dir, file_name), "rb") as f:
+                    body = f.read()
+            return body, restore_trailers(trailers)
+        return load_body
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List the exchanges stored in a capture database")
+    parser.add_argument("database", help="capture database written by the headless proxy")
+    for name in FILTERS:
+        parser.add_argument("--" + name.replace("_", "-"), type=int if name == "status" else str, default=None)
+    parser.add_argument("--after", type=int, default=0, metavar="ID", help="list the exchanges after this id")
+    parser.add_argument("--limit", type=int, default=100, metavar="COUNT")
+    args = parser.parse_args()
+
+    database = CaptureDatabase(args.database, read_only=True)
+    filters = {name: getattr(args, name) for name in FILTERS}
+    for id, rr in database.page(args.after, args.limit, **filters):
+        request, response = rr.request, rr.response
+        print("{:>8} {} {} {} {}".format(
+            id, format_guid(rr.guid),
+            request.first_line().decode("latin-1").strip() if request else "-",
+            response.status.decode() if response else "-",
+            request.headers.get(b"Host", b"").decode("latin-1") if request else ""))
+    database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import os
+from collections import OrderedDict
+
+from proxy.pipe.archive import ArchiveWriter
+
+# An offload archive holds the index of its exchanges in memory until it is closed, the next archive is started
+# once it has this many exchanges or bytes
+DEFAULT_OFFLOAD_ENTRIES = 10000
+DEFAULT_OFFLOAD_BYTES = 256 * 1024 * 1024
+
+
+def resident_body_size(message):
+    """Bytes of the body held in memory, a body that was not loaded yet does not count"""
+    if message is None or getattr(message, "body_loader", None) is not None or message.body is None:
+        return 0
+    return len(message.body)
+
+
+class CaptureRing:
+    """
+    Exchanges kept in memory, oldest first, within a limit on their count and on the bytes of their bodies.
+
+    When an exchange is added over a limit, the oldest ones are evicted, the one just added is always kept.
+    With an offload path, the evicted exchanges are written to an archive there instead of being lost.
+    An archive is closed, and the next one started, after offload_entries exchanges or offload_bytes bytes,
+    and when the ring is closed; until then it is written out after every eviction and can be read by scanning
+    its records. An existing archive is never replaced, the next free name (capture-1.pyarc, capture-2.pyarc, ...)
+    is used instead, see offload_files.
+    """
+
+    def __init__(self, max_count=None, max_bytes=None, offload_path=None, offload_entries=DEFAULT_OFFLOAD_ENTRIES,
+                 offload_bytes=DEFAULT_OFFLOAD_BYTES):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.offload_path = offload_path
+        self.offload_entries = offload_entries
+        self.offload_bytes = offload_bytes
+        # guid -> (exchange, body bytes)
+        self.pairs = OrderedDict()
+        self.body_bytes = 0
+        self.evicted = 0
+        self.offload_files = []
+        self.__offload_stream = None
+        self.__offload = None
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __contains__(self, guid):
+        return guid in self.pairs
+
+    def get(self, guid):
+        """The exchange with the id, None if it is not kept"""
+        entry = self.pairs.get(guid)
+        return entry[0] if entry else None
+
+    def request_responses(self):
+        return (rr for rr, _ in self.pairs.values())
+
+    def add(self, request_response):
+        """Add or update an exchange, return the evicted exchanges, oldest first"""
+        guid = request_response.guid
+        size = resident_body_size(request_response.request) + resident_body_size(request_response.response)
+        previous = self.pairs.get(guid)
+        if previous:
+            self.body_bytes -= previous[1]
+        # An updated exchange keeps its place
+        self.pairs[guid] = (request_response, size)
+        self.body_bytes += size
+
+        evicted = []
+        while len(self.pairs) > 1 and self.__over_limit():
+            rr, size = self.pairs.popitem(last=False)[1]
+            self.body_bytes -= size
+            evicted.append(rr)
+        if evicted:
+            self.evicted += len(evicted)
+            if self.offload_path:
+                self.__offload_pairs(evicted)
+        return evicted
+
+    def __over_limit(self):
+        return (self.max_count is not None and len(self.pairs) > self.max_count) or \
+               (self.max_bytes is not None and self.body_bytes > self.max_bytes)
+
+    def __offload_pairs(self, request_responses):
+        for rr in request_responses:
+            if self.__offload is None:
+                self.__offload_stream = self.__open_offload_file()
+                self.__offload = ArchiveWriter(self.__offload_stream)
+            self.__offload.add(rr)
+            if len(self.__offload.entries) >= self.offload_entries or \
+                    self.__offload.file_position >= self.offload_bytes:
+                self.close()
+        if self.__offload is not None:
+            self.__offload.flush()
+
+    def __open_offload_file(self):
+        base, extension = os.path.splitext(self.offload_path)
+        file_name = self.offload_path
+        number = 0
+        while True:
+            try:
+                stream = open(file_name, "xb")
+                break
+            except FileExistsError:
+                number += 1
+                file_name = "{}-{}{}".format(base, number, extension)
+        self.offload_files.append(file_name)
+        return stream
+
+    def clear(self):
+        self.pairs.clear()
+        self.body_bytes = 0
+
+    def close(self):
+        """Write the index of the current offload archive"""
+        if self.__offload is not None:
+            self.__offload.close()
+            self.__offload_stream.close()
+            self.__offload = self.__offload_stream = None
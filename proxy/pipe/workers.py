@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import multiprocessing
+import socket
+from multiprocessing.connection import wait
+from threading import Thread
+
+from proxy.pipe.communication import MessageListener
+from proxy.pipe.event_loop import create_event_loop, LOOP_AUTO
+
+logger = logging.getLogger('proxy')
+
+
+class ForwardingListener(MessageListener):
+    """Listener of a worker process, sends the captured exchanges to the collector in the parent process"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def on_request_response(self, request_response):
+        self.connection.send([request_response])
+
+    def on_request_responses(self, request_responses):
+        self.connection.send(request_responses)
+
+    def on_error(self, error):
+        logger.error('worker error {}'.format(error))
+
+
+def run_worker(proxy_parameters, connection, event_loop=LOOP_AUTO):
+    # Imported here, apipe imports this module
+    from proxy.pipe.apipe import prepare_server
+
+    loop = create_event_loop(event_loop)
+    asyncio.set_event_loop(loop)
+    # Exchanges are sent to the parent process in batches, off the event loop
+    dispatcher = proxy_parameters.create_dispatcher(ForwardingListener(connection))
+    try:
+        loop.run_until_complete(prepare_server(proxy_parameters, dispatcher, reuse_port=True))
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
+        connection.close()
+
+
+class ProxyWorkers:
+    """
+    Run the proxy in several processes listening on the same port (SO_REUSEPORT), so that the kernel spreads
+    client connections among them. The captured exchanges are collected by a thread of this process
+    and passed to the listener.
+    """
+
+    def __init__(self, proxy_parameters, listener, count, event_loop=LOOP_AUTO):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Multiple workers need SO_REUSEPORT, which this platform does not support")
+        self.proxy_parameters = proxy_parameters
+        self.listener = listener
+        self.count = count
+        self.event_loop = event_loop
+        self.processes = []
+        self.connections = []
+        self.collector = None
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        for i in range(self.count):
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_worker, args=(self.proxy_parameters, sender, self.event_loop),
+                                      name="ProxyWorker-{}".format(i), daemon=True)
+            process.start()
+            sender.close()
+            self.processes.append(process)
+            self.connections.append(receiver)
+        logger.info('started {} workers'.format(self.count))
+
+        self.collector = Thread(target=self.__collect, name="Collector", daemon=True)
+        self.collector.start()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+        self.collector.join()
+
+    def __collect(self):
+        connections = list(self.connections)
+        while connections:
+            for connection in wait(connections):
+                try:
+                    request_responses = connection.recv()
+                except EOFError:
+                    connections.remove(connection)
+                    continue
+                self.listener.on_request_responses(request_responses)
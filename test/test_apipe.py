@@ -0,0 +1,339 @@
+import asyncio
+import socket
+import struct
+
+from proxy.pipe.apipe import DEFAULT_MAX_CAPTURE_BODY, ProxyParameters, build_argument_parser, \
+    parse_proxy_parameters, prepare_server
+from proxy.pipe.channel import ChannelRegistry
+from proxy.pipe.communication import MessageListener
+
+REQUEST = b"POST /upload HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: 10\r\n\r\n0123456789"
+
+
+class CollectingListener(MessageListener):
+    def __init__(self):
+        self.pairs = []
+
+    def on_request_response(self, request_response):
+        if request_response.response is not None:
+            self.pairs.append(request_response)
+
+
+async def start_upstream(handler):
+    server = await asyncio.start_server(handler, host="127.0.0.1", port=0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def start_proxy(upstream_port, listener, **kwargs):
+    parameters = ProxyParameters("127.0.0.1", 0, "127.0.0.1", upstream_port, **kwargs)
+    server = await prepare_server(parameters, listener)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+
+def test_streaming_forwards_head_before_body_is_complete():
+    body_released = None
+
+    async def upstream(reader, writer):
+        await reader.readexactly(len(REQUEST))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 8\r\n\r\nabcd")
+        await body_released.wait()
+        writer.write(b"efgh")
+        await writer.drain()
+        writer.close()
+
+    async def scenario():
+        nonlocal body_released
+        body_released = asyncio.Event()
+        listener = CollectingListener()
+        upstream_server, upstream_port = await start_upstream(upstream)
+        proxy_server, proxy_port = await start_proxy(upstream_port, listener, streaming=True, max_capture_body=6)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        writer.write(REQUEST)
+        head = await reader.readuntil(b"\r\n\r\n")
+        first = await reader.readexactly(4)
+        body_released.set()
+        rest = await reader.readexactly(4)
+        writer.close()
+        await asyncio.sleep(0.1)
+
+        proxy_server.close()
+        upstream_server.close()
+        return head, first + rest, listener.pairs
+
+    head, body, pairs = run(scenario())
+    assert head.startswith(b"HTTP/1.1 200 OK")
+    assert body == b"abcdefgh"
+    assert len(pairs) == 1
+    assert pairs[0].request.body == b"0123456789"[:6]
+    assert pairs[0].response.body == b"abcdef"
+    assert pairs[0].response.headers[b"Content-Length"] == b"6"
+    assert pairs[0].response.headers[b"X-Pyproxy-Truncated-From"] == b"8"
+
+
+def test_streaming_passes_chunks_through():
+    chunk_released = None
+
+    async def upstream(reader, writer):
+        await reader.readexactly(len(REQUEST))
+        writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n4\r\nWiki\r\n")
+        await chunk_released.wait()
+        writer.write(b"5\r\npedia\r\n0\r\nExpires: never\r\n\r\n")
+        await writer.drain()
+
+    async def scenario():
+        nonlocal chunk_released
+        chunk_released = asyncio.Event()
+        listener = CollectingListener()
+        upstream_server, upstream_port = await start_upstream(upstream)
+        proxy_server, proxy_port = await start_proxy(upstream_port, listener, streaming=True)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        writer.write(REQUEST)
+        await reader.readuntil(b"\r\n\r\n")
+        first = await reader.readuntil(b"Wiki\r\n")
+        chunk_released.set()
+        rest = await reader.readuntil(b"\r\n\r\n")
+        await asyncio.sleep(0.1)
+        writer.close()
+
+        proxy_server.close()
+        upstream_server.close()
+        return first + rest, listener.pairs
+
+    body, pairs = run(scenario())
+    assert body == b"4\r\nWiki\r\n5\r\npedia\r\n0\r\nExpires: never\r\n\r\n"
+    assert len(pairs) == 1
+    assert pairs[0].response.body == b"Wikipedia"
+    assert pairs[0].response.trailers[b"Expires"] == b"never"
+
+
+def test_head_response_is_forwarded_without_waiting_for_close():
+    async def upstream(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n")
+        await writer.drain()
+        await reader.read()
+
+    async def scenario():
+        listener = CollectingListener()
+        upstream_server, upstream_port = await start_upstream(upstream)
+        proxy_server, proxy_port = await start_proxy(upstream_port, listener)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        writer.write(b"HEAD / HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n")
+        head = await reader.readuntil(b"\r\n\r\n")
+        writer.close()
+
+        proxy_server.close()
+        upstream_server.close()
+        return head, listener.pairs
+
+    head, pairs = run(scenario())
+    assert head == b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n"
+    assert len(pairs) == 1
+    assert pairs[0].response.body is None
+
+
+def test_raw_passthrough_captures_on_separate_thread():
+    async def upstream(reader, writer):
+        await reader.readexactly(len(REQUEST))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nabcd")
+        await writer.drain()
+
+    async def scenario():
+        listener = CollectingListener()
+        upstream_server, upstream_port = await start_upstream(upstream)
+        proxy_server, proxy_port = await start_proxy(upstream_port, listener, rewrite_headers=False,
+                                                     raw_passthrough=True)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        writer.write(REQUEST)
+        response = await reader.readexactly(42)
+        for _ in range(50):
+            if listener.pairs:
+                break
+            await asyncio.sleep(0.02)
+        writer.close()
+
+        proxy_server.close()
+        upstream_server.close()
+        return response, listener.pairs
+
+    response, pairs = run(scenario())
+    assert response == b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nabcd"
+    assert len(pairs) == 1
+    assert pairs[0].request.body == b"0123456789"
+    assert pairs[0].response.body == b"abcd"
+
+
+def test_pool_reuses_upstream_connection_across_clients():
+    upstream_connections = []
+
+    async def upstream(reader, writer):
+        upstream_connections.append(writer)
+        while True:
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            await writer.drain()
+
+    async def scenario():
+        listener = CollectingListener()
+        upstream_server, upstream_port = await start_upstream(upstream)
+        proxy_server, proxy_port = await start_proxy(upstream_port, listener, upstream_pool=True)
+
+        responses = []
+        for i in range(3):
+            reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+            writer.write(b"GET /%d HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n" % i)
+            responses.append(await reader.readexactly(40))
+            writer.close()
+
+        proxy_server.close()
+        upstream_server.close()
+        return responses, listener.pairs
+
+    responses, pairs = run(scenario())
+    assert responses == [b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"] * 3
+    assert len(pairs) == 3
+    assert len(upstream_connections) == 1
+
+
+def test_slow_client_pauses_reading_from_upstream():
+    body_size = 16 * 1024 * 1024
+
+    async def upstream(reader, writer):
+        await reader.readexactly(len(REQUEST))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % body_size)
+        for _ in range(body_size // 65536):
+            writer.write(b"x" * 65536)
+            await writer.drain()
+        writer.close()
+
+    async def scenario():
+        upstream_server, upstream_port = await start_upstream(upstream)
+        parameters = ProxyParameters("127.0.0.1", 0, "127.0.0.1", upstream_port, streaming=True, max_capture_body=0,
+                                     read_size=4096, write_high_water=16384, write_low_water=4096)
+        channels = ChannelRegistry()
+        proxy_server = await prepare_server(parameters, CollectingListener(), channels=channels)
+        proxy_port = proxy_server.sockets[0].getsockname()[1]
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port, limit=4096)
+        writer.write(REQUEST)
+        await reader.readuntil(b"\r\n\r\n")
+        # The client does not read, the proxy must stop reading from the upstream instead of buffering the body
+        await asyncio.sleep(0.5)
+        assert len(channels) == 2
+        buffered = channels.buffered()
+        paused = sum(channel.read_pauses for channel in channels)
+
+        received = 0
+        while received < body_size:
+            received += len(await reader.read(65536))
+        writer.close()
+
+        proxy_server.close()
+        upstream_server.close()
+        return buffered, paused, received
+
+    buffered, paused, received = run(scenario())
+    assert buffered <= 16384 + 4096
+    assert paused > 0
+    assert received == body_size
+
+
+def test_exchanges_are_timed():
+    async def upstream(reader, writer):
+        for _ in range(2):
+            await reader.readexactly(len(REQUEST))
+            await asyncio.sleep(0.05)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            await writer.drain()
+        writer.close()
+
+    async def scenario():
+        listener = CollectingListener()
+        upstream_server, upstream_port = await start_upstream(upstream)
+        proxy_server, proxy_port = await start_proxy(upstream_port, listener)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        for _ in range(2):
+            writer.write(REQUEST)
+            await reader.readexactly(40)
+        writer.close()
+        await asyncio.sleep(0.1)
+
+        proxy_server.close()
+        upstream_server.close()
+        return listener.pairs
+
+    pairs = run(scenario())
+    assert len(pairs) == 2
+    first, second = (rr.timing for rr in pairs)
+    assert first.connection_id == second.connection_id
+    assert first.accepted <= first.connect_start <= first.connect_end <= first.request_head
+    assert first.request_head <= first.request_end <= first.request_forwarded
+    assert first.request_forwarded <= first.response_first_byte <= first.response_end
+    assert first.upstream_time() >= 0.04
+    assert second.request_head >= first.response_end
+    assert first.request_bytes == second.request_bytes == len(REQUEST)
+    assert first.response_bytes == 40
+
+
+def test_streamed_bodies_are_captured_up_to_a_limit_by_default():
+    parser = build_argument_parser()
+    parameters = parse_proxy_parameters(parser.parse_args(["127.0.0.1:0", "127.0.0.1:80", "--stream"]))
+    assert parameters.max_capture_body == DEFAULT_MAX_CAPTURE_BODY
+    parameters = parse_proxy_parameters(parser.parse_args(["127.0.0.1:0", "127.0.0.1:80", "--capture-whole-bodies"]))
+    assert parameters.max_capture_body is None
+
+
+def test_pool_retries_on_a_new_connection_reset_by_upstream():
+    upstream_connections = []
+
+    async def upstream(reader, writer):
+        upstream_connections.append(writer)
+        served = 0
+        while True:
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            if len(upstream_connections) == 1 and served:
+                # The idle timeout of the upstream ran out as the request arrived, the connection is reset
+                sock = writer.get_extra_info("socket")
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                writer.transport.abort()
+                break
+            served += 1
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            await writer.drain()
+
+    async def scenario():
+        listener = CollectingListener()
+        upstream_server, upstream_port = await start_upstream(upstream)
+        proxy_server, proxy_port = await start_proxy(upstream_port, listener, upstream_pool=True)
+
+        responses = []
+        for i in range(2):
+            reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+            writer.write(b"GET /%d HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n" % i)
+            responses.append(await reader.readexactly(40))
+            writer.close()
+            await asyncio.sleep(0.1)
+
+        proxy_server.close()
+        upstream_server.close()
+        return responses, listener.pairs
+
+    responses, pairs = run(scenario())
+    assert responses == [b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"] * 2
+    assert len(pairs) == 2
+    assert len(upstream_connections) == 2
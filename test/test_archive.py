@@ -0,0 +1,158 @@
+import io
+import math
+import os
+import time
+
+import pytest
+
+from proxy.parser.http_parser import parse_head
+from proxy.pipe.archive import ArchiveReader, ArchiveWriter, CODECS, convert, is_archive
+from proxy.pipe.communication import MessagePairer, MessageTiming, Timing
+from proxy.pipe.persistence import parse_message_pairs, serialize_message_pairs
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+CAPTURE = DIR + "/test_persistence.data"
+
+
+def test_convert_and_read_index(tmp_path):
+    archive = str(tmp_path / "capture.pyarc")
+    assert convert(CAPTURE, archive) == 3
+    assert is_archive(archive)
+    assert not is_archive(CAPTURE)
+
+    with open(CAPTURE, "rb") as f:
+        original = list(parse_message_pairs(f))
+    reader = ArchiveReader(archive)
+    assert [entry.guid for entry in reader.entries] == [rr.guid for rr in original]
+    assert [entry.method for entry in reader.entries] == [rr.request.method for rr in original]
+    assert [entry.path for entry in reader.entries] == [rr.request.path for rr in original]
+    assert [entry.status for entry in reader.entries] == [rr.response.status for rr in original]
+
+    entry = reader.entries[1]
+    assert reader.read(entry).response.body == original[1].response.body
+
+
+def test_bodies_are_read_on_demand(tmp_path):
+    archive = str(tmp_path / "capture.pyarc")
+    convert(CAPTURE, archive)
+    pairs = list(ArchiveReader(archive).request_responses())
+    assert pairs[0].request.first_line() == b"GET / HTTP/1.1\r\n"
+    assert pairs[0].response.headers[b"Location"].startswith(b"http://www.google.cz/")
+    assert all(rr.response.body_loader is not None for rr in pairs)
+
+    with open(CAPTURE, "rb") as f:
+        data = f.read()
+    stream = io.BytesIO()
+    serialize_message_pairs(pairs, stream)
+    assert stream.getvalue() == data
+    assert all(rr.response.body_loader is None for rr in pairs)
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_compressed_segments(tmp_path, codec):
+    with open(CAPTURE, "rb") as f:
+        data = f.read()
+    capture = tmp_path / "capture.http"
+    capture.write_bytes(data * 5)
+    archive = str(tmp_path / "capture.pyarc")
+
+    # Segments of about two exchanges with their index entries
+    assert convert(str(capture), archive, codec=codec, segment_size=len(data)) == 15
+    assert is_archive(archive)
+    uncompressed = str(tmp_path / "uncompressed.pyarc")
+    convert(str(capture), uncompressed)
+    assert os.path.getsize(archive) < os.path.getsize(uncompressed)
+
+    reader = ArchiveReader(archive)
+    assert reader.codec == codec
+    assert len(reader.segments) == 8
+    assert reader.read(reader.entries[13]).response.body == reader.read(reader.entries[1]).response.body
+
+    for pairs in (list(reader.request_responses()), list(reader.load_request_responses(workers=3))):
+        stream = io.BytesIO()
+        serialize_message_pairs(pairs, stream)
+        assert stream.getvalue() == data * 5
+
+
+def test_identical_bodies_are_stored_once(tmp_path):
+    wsdl = b"<definitions>" + b"<message/>" * 500 + b"</definitions>"
+    with open(CAPTURE, "rb") as f:
+        pairs = list(parse_message_pairs(f))
+    for rr in pairs:
+        rr.response.body = wsdl
+        rr.response.headers[b"Content-Length"] = str(len(wsdl)).encode()
+    archive = str(tmp_path / "capture.pyarc")
+    with open(archive, "wb") as f, ArchiveWriter(f) as writer:
+        for rr in pairs:
+            writer.add(rr)
+
+    assert len(writer.blobs) == 1
+    assert os.path.getsize(archive) < 2 * len(wsdl)
+    reader = ArchiveReader(archive)
+    assert [bool(entry.response_blob) for entry in reader.entries] == [True] * 3
+    assert not any(entry.request_blob for entry in reader.entries)
+
+    expected = io.BytesIO()
+    serialize_message_pairs(pairs, expected)
+    for loaded in (list(reader.request_responses()), list(reader.load_request_responses()),
+                   [reader.read(entry) for entry in reader.entries]):
+        stream = io.BytesIO()
+        serialize_message_pairs(loaded, stream)
+        assert stream.getvalue() == expected.getvalue()
+        assert loaded[0].response.body is loaded[2].response.body
+
+
+def test_small_body_until_close(tmp_path):
+    capture = (b"Pair: 00000000-0000-0000-0000-000000000001\r\n"
+               b"Request: GET /a HTTP/1.1\r\n\r\n\r\n"
+               b"Response: HTTP/1.0 200 OK\r\n\r\nbody\r\n")
+    path = tmp_path / "capture.pyarc"
+    with open(path, "wb") as f, ArchiveWriter(f) as writer:
+        for rr in parse_message_pairs(io.BytesIO(capture)):
+            writer.add(rr)
+
+    reader = ArchiveReader(str(path))
+    rr = reader.read(reader.entries[0])
+    assert rr.response.status == b"200"
+    assert rr.response.body == b"body"
+
+
+def test_index_holds_the_wall_clock_time_of_the_request(tmp_path):
+    pairer = MessagePairer(connection_timing=Timing(1, time.monotonic()))
+    before = time.time()
+    rr = pairer.add_message(parse_head(b"GET / HTTP/1.1\r\n\r\n"), MessageTiming(first_byte=time.monotonic()))
+    after = time.time()
+    path = tmp_path / "capture.pyarc"
+    with open(path, "wb") as f, ArchiveWriter(f) as writer:
+        writer.add(rr)
+        with open(CAPTURE, "rb") as capture:
+            writer.add(next(parse_message_pairs(capture)))
+
+    timestamps = [entry.timestamp for entry in ArchiveReader(str(path)).entries]
+    assert before - 1 <= timestamps[0] <= after + 1
+    # Exchanges captured without timing have no time
+    assert math.isnan(timestamps[1])
+
+
+@pytest.mark.parametrize("codec", [None] + sorted(CODECS))
+def test_archive_without_index_is_recovered(tmp_path, codec):
+    wsdl = b"<definitions>" + b"<message/>" * 500 + b"</definitions>"
+    with open(CAPTURE, "rb") as f:
+        pairs = list(parse_message_pairs(f))
+    for rr in pairs:
+        rr.response.body = wsdl
+        rr.response.headers[b"Content-Length"] = str(len(wsdl)).encode()
+    path = tmp_path / "capture.pyarc"
+    with open(path, "wb") as f:
+        writer = ArchiveWriter(f, codec, segment_size=100)
+        for rr in pairs:
+            writer.add(rr)
+        # Written as by a writer that was never closed, the last record cut short
+        f.write(b"\xff" * 20 if codec else b"\x10\x00\x00\x00\x00\x00\x00\x00Pair: ")
+
+    reader = ArchiveReader(str(path))
+    assert reader.recovered
+    assert [entry.guid for entry in reader.entries] == [rr.guid for rr in pairs]
+    assert len(reader.blobs) == 1
+    for loaded in (list(reader.request_responses()), list(reader.load_request_responses())):
+        assert [(rr.request.path, rr.response.body) for rr in loaded] == [(rr.request.path, wsdl) for rr in pairs]
@@ -0,0 +1,44 @@
+from proxy.parser.http_parser import parse_head
+from proxy.pipe.blobs import BodyInterner, MIN_BLOB_SIZE
+from proxy.pipe.communication import RequestResponse
+
+
+def response(body):
+    message = parse_head(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body))
+    message.body = body
+    return message
+
+
+def test_identical_bodies_share_one_object():
+    interner = BodyInterner()
+    large = b"x" * MIN_BLOB_SIZE
+    small = b"y" * (MIN_BLOB_SIZE - 1)
+    first = RequestResponse(response=response(large))
+    second = RequestResponse(response=response(bytes(bytearray(large))))
+    third = RequestResponse(response=response(bytes(bytearray(small))))
+    fourth = RequestResponse(response=response(small))
+
+    for rr in (first, second, third, fourth):
+        interner.intern_pair(rr)
+
+    assert second.response.body is first.response.body
+    assert interner.shared_bytes == len(large)
+    # Small bodies are left alone
+    assert third.response.body is not fourth.response.body
+
+
+def test_released_bodies_are_dropped():
+    interner = BodyInterner()
+    large = b"x" * MIN_BLOB_SIZE
+    first = RequestResponse(response=response(large))
+    second = RequestResponse(response=response(bytes(bytearray(large))))
+    interner.intern_pair(first)
+    interner.intern_pair(second)
+    # Interning an exchange again, e.g. once its response arrived, does not hold its body twice
+    interner.intern_pair(first)
+
+    interner.release(first.guid)
+    assert len(interner.bodies) == 1
+    interner.release(second.guid)
+    assert interner.bodies == {}
+    assert interner.held == {}
@@ -0,0 +1,59 @@
+import io
+import os
+
+from proxy.pipe import bulk_load
+from proxy.pipe.bulk_load import load_message_pairs, split_capture
+from proxy.pipe.communication import new_guid
+from proxy.pipe.persistence import parse_message_pairs, serialize_message_pairs
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def write_capture(path, copies):
+    with open(DIR + "/test_persistence.data", "rb") as f:
+        pairs = list(parse_message_pairs(f))
+    with open(path, "wb") as f:
+        for _ in range(copies):
+            for pair in pairs:
+                pair.guid = new_guid()
+            serialize_message_pairs(pairs, f)
+
+
+def test_split_at_pairs(tmp_path):
+    path = str(tmp_path / "capture.http")
+    write_capture(path, 10)
+    data = open(path, "rb").read()
+
+    ranges = split_capture(path, 4)
+
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    assert all(data[start:start + 6] == b"Pair: " for start, _ in ranges)
+
+
+def test_parallel_load_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr(bulk_load, "MIN_PARALLEL_SIZE", 0)
+    path = str(tmp_path / "capture.http")
+    write_capture(path, 20)
+
+    pairs = list(load_message_pairs(path, workers=2))
+
+    assert len(pairs) == 60
+    stream = io.BytesIO()
+    serialize_message_pairs(pairs, stream)
+    assert stream.getvalue() == open(path, "rb").read()
+
+
+def test_split_skips_pairs_quoted_in_bodies(tmp_path):
+    quoted = b"x\r\nPair: 00000000-0000-0000-0000-000000000009\r\nNoRequest\r\nNoResponse\r\n" * 200
+    capture = b"".join(b"Pair: 00000000-0000-0000-0000-00000000000%d\r\n"
+                       b"Request: POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s\r\n"
+                       b"NoResponse\r\n" % (i, len(quoted), quoted) for i in range(2))
+    path = tmp_path / "capture.http"
+    path.write_bytes(capture)
+
+    ranges = split_capture(str(path), 8)
+
+    assert ranges == [(0, len(capture) // 2), (len(capture) // 2, len(capture))]
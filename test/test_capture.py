@@ -0,0 +1,71 @@
+import threading
+
+from proxy.pipe.capture import CaptureTap
+from proxy.pipe.communication import MessageListener
+
+
+class BlockingListener(MessageListener):
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def on_request_response(self, request_response):
+        self.entered.set()
+        self.release.wait(5)
+        self.calls.append(request_response)
+
+
+def test_full_queue_drops_and_abandons_connection():
+    listener = BlockingListener()
+    tap = CaptureTap(listener, max_queue_size=2)
+    client, remote = tap.open_connection()
+
+    client.feed(b"GET /1 HTTP/1.1\r\n\r\n")
+    assert listener.entered.wait(5)
+
+    client.feed(b"GET /2 HTTP/1.1\r\n\r\n")
+    client.feed(b"GET /3 HTTP/1.1\r\n\r\n")
+    client.feed(b"GET /4 HTTP/1.1\r\n\r\n")
+    client.feed(b"GET /5 HTTP/1.1\r\n\r\n")
+
+    assert tap.dropped_chunks == 1
+    assert tap.dropped_bytes == len(b"GET /4 HTTP/1.1\r\n\r\n")
+    # The responses could not be paired with the requests any more
+    assert tap.abandoned_streams == 2
+    assert client.abandoned
+    assert remote.abandoned
+    remote.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+    assert tap.dropped_chunks == 1
+
+    listener.release.set()
+    tap.stop()
+    tap.thread.join(5)
+    assert len(listener.calls) == 1
+
+
+class CollectingListener(MessageListener):
+    def __init__(self):
+        self.pairs = {}
+
+    def on_request_response(self, request_response):
+        self.pairs[request_response.guid] = request_response
+
+
+def test_continue_is_not_paired_with_the_request():
+    listener = CollectingListener()
+    tap = CaptureTap(listener)
+    client, remote = tap.open_connection()
+
+    client.feed(b"POST /a HTTP/1.1\r\nExpect: 100-continue\r\nContent-Length: 1\r\n\r\n")
+    remote.feed(b"HTTP/1.1 100 Continue\r\n\r\n")
+    client.feed(b"x")
+    remote.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\na")
+    client.feed(b"GET /b HTTP/1.1\r\n\r\n")
+    remote.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nb")
+    tap.stop()
+    tap.thread.join(5)
+
+    pairs = list(listener.pairs.values())
+    assert [(rr.request.path, rr.response.status, rr.response.body) for rr in pairs] == \
+        [(b"/a", b"200", b"a"), (b"/b", b"200", b"b")]
@@ -1,7 +1,8 @@
+import uuid
 from collections import OrderedDict
 
 import pytest
-from proxy.pipe.communication import MessagePairer, MessageListener, RequestResponse
+from proxy.pipe.communication import MessagePairer, MessageListener, RequestResponse, format_guid, parse_guid
 
 from proxy.parser.http_parser import HttpRequest, HttpResponse
 
@@ -135,3 +136,33 @@ def test_interleaved(pairer: MessagePairer):
     pairer.add_message(response(b"2"))
     listener.assert_calls_and_pairs_number(4, 2)
     listener.assert_request_and_response_match(3)
+
+
+def test_guids_are_sequential_and_keep_the_uuid_format():
+    first, second = RequestResponse(), RequestResponse()
+    assert second.guid == first.guid + 1
+    assert len(format_guid(first.guid)) == 32
+    assert parse_guid(format_guid(first.guid)) == first.guid
+
+    old = uuid.uuid4()
+    assert parse_guid(old.hex) == parse_guid(str(old)) == old.int
+
+
+def test_interim_responses_are_not_paired(pairer: MessagePairer):
+    listener = pairer.listener
+
+    pairer.add_request(request(b"1"))
+    interim = response(None)
+    interim.status = b"100"
+    assert pairer.add_message(interim) is None
+    final = response(b"1")
+    final.status = b"200"
+    pairer.add_response(final)
+    pairer.add_request(request(b"2"))
+    second = response(b"2")
+    second.status = b"200"
+    pairer.add_response(second)
+
+    listener.assert_calls_and_pairs_number(4, 2)
+    listener.assert_request_and_response_match(1)
+    listener.assert_request_and_response_match(3)
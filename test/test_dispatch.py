@@ -0,0 +1,86 @@
+import threading
+
+from proxy.pipe.communication import MessageListener, RequestResponse
+from proxy.pipe.dispatch import DispatchingListener, OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST
+
+
+class BatchListener(MessageListener):
+    def __init__(self, release=None):
+        self.batches = []
+        self.release = release
+
+    def on_request_responses(self, request_responses):
+        if self.release:
+            self.release.wait(5)
+        self.batches.append(request_responses)
+
+
+def test_delivers_in_batches_on_separate_thread():
+    listener = BatchListener()
+    dispatcher = DispatchingListener(listener, batch_size=3, batch_interval=60)
+    exchanges = [RequestResponse() for _ in range(7)]
+    for rr in exchanges:
+        dispatcher.on_request_response(rr)
+    dispatcher.stop(5)
+
+    assert [len(batch) for batch in listener.batches] == [3, 3, 1]
+    assert [rr for batch in listener.batches for rr in batch] == exchanges
+    assert dispatcher.delivered == 7
+
+
+def test_exchange_reported_twice_is_delivered_once_per_batch():
+    listener = BatchListener()
+    dispatcher = DispatchingListener(listener, batch_size=10, batch_interval=60)
+    rr = RequestResponse()
+    dispatcher.on_request_response(rr)
+    dispatcher.on_request_response(rr)
+    dispatcher.stop(5)
+
+    assert listener.batches == [[rr]]
+
+
+def fill_blocked(overflow):
+    release = threading.Event()
+    listener = BatchListener(release)
+    dispatcher = DispatchingListener(listener, max_queue_size=2, overflow=overflow, batch_size=1, batch_interval=0)
+    first = RequestResponse()
+    dispatcher.on_request_response(first)
+    # Wait until the consumer holds the first exchange, blocked in the listener
+    while dispatcher.qsize():
+        pass
+    exchanges = [RequestResponse() for _ in range(4)]
+    for rr in exchanges:
+        dispatcher.on_request_response(rr)
+    release.set()
+    dispatcher.stop(5)
+    return dispatcher, [rr for batch in listener.batches for rr in batch], first, exchanges
+
+
+def test_drop_newest_keeps_queued_exchanges():
+    dispatcher, delivered, first, exchanges = fill_blocked(OVERFLOW_DROP_NEWEST)
+    assert delivered == [first] + exchanges[:2]
+    assert dispatcher.dropped == 2
+
+
+def test_drop_oldest_keeps_latest_exchanges():
+    dispatcher, delivered, first, exchanges = fill_blocked(OVERFLOW_DROP_OLDEST)
+    assert delivered == [first] + exchanges[2:]
+    assert dispatcher.dropped == 2
+
+
+def test_block_waits_for_room():
+    release = threading.Event()
+    listener = BatchListener(release)
+    dispatcher = DispatchingListener(listener, max_queue_size=1, overflow=OVERFLOW_BLOCK, batch_size=1,
+                                     batch_interval=0)
+    exchanges = [RequestResponse() for _ in range(3)]
+    producer = threading.Thread(target=lambda: [dispatcher.on_request_response(rr) for rr in exchanges])
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive()
+
+    release.set()
+    producer.join(5)
+    dispatcher.stop(5)
+    assert [rr for batch in listener.batches for rr in batch] == exchanges
+    assert dispatcher.dropped == 0
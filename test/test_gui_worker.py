@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5")
+
+from PyQt5.QtWidgets import QApplication
+
+from proxy.gui.worker import Worker
+from proxy.parser.http_parser import parse_head
+from proxy.pipe.apipe import ProxyParameters
+from proxy.pipe.communication import RequestResponse
+from proxy.pipe.event_loop import LOOP_ASYNCIO, LOOP_AUTO
+
+
+@pytest.fixture(scope="module")
+def application():
+    return QApplication.instance() or QApplication([])
+
+
+def test_exchanges_are_merged_and_counted_once(application):
+    worker = Worker()
+    batches = []
+    worker.received_batch.connect(batches.append)
+    first = RequestResponse(parse_head(b"GET /1 HTTP/1.1\r\n\r\n"))
+    second = RequestResponse(parse_head(b"GET /2 HTTP/1.1\r\n\r\n"))
+    worker.on_request_responses([first, second])
+    first.response = parse_head(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+    worker.on_request_response(first)
+
+    assert worker.pending() == 2
+    worker.flush()
+
+    assert batches == [[first, second]]
+    assert worker.completed == 1
+    worker.thread.loop.close()
+
+
+def test_restart_uses_the_chosen_event_loop(application):
+    worker = Worker(event_loop=LOOP_AUTO)
+    worker.setParameters(ProxyParameters("127.0.0.1", 0, "127.0.0.1", 9))
+    worker.start()
+    first = worker.thread
+    assert worker.status()
+
+    worker.setEventLoop(LOOP_ASYNCIO)
+    worker.stop()
+    worker.start()
+
+    assert worker.status()
+    assert worker.thread is not first and worker.thread.event_loop == LOOP_ASYNCIO
+    assert not first.is_alive() and first.loop.is_closed()
+    worker.thread.shutdown()
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+
+from proxy.headless import CaptureWriter, CompleteExchangeFilter
+from proxy.parser.http_parser import HttpRequest, HttpResponse
+from proxy.pipe.communication import MessageListener, RequestResponse
+from proxy.pipe.persistence import parse_message_pairs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def exchange(body):
+    request = HttpRequest()
+    request.method, request.path, request.version = b"POST", b"/", b"HTTP/1.1"
+    request.headers[b"Content-Length"] = str(len(body)).encode()
+    request.body = body
+    response = HttpResponse()
+    response.version, response.status, response.status_message = b"HTTP/1.1", b"200", b"OK"
+    response.headers[b"Content-Length"] = b"0"
+    response.body = b""
+    return RequestResponse(request, response)
+
+
+def load(path):
+    with open(path, "rb") as f:
+        return list(parse_message_pairs(f))
+
+
+def test_writer_rotates_files(tmp_path):
+    path = str(tmp_path / "capture.dat")
+    writer = CaptureWriter(path, max_bytes=300, backup_count=2)
+    exchanges = [exchange(b"x" * 100) for _ in range(8)]
+    for i in range(0, 8, 2):
+        writer.on_request_responses(exchanges[i:i + 2])
+    writer.on_request_response(exchanges[0])
+    writer.close()
+
+    assert sorted(os.listdir(str(tmp_path))) == ["capture.dat", "capture.dat.1", "capture.dat.2"]
+    assert [rr.guid for rr in load(path + ".2")] == [rr.guid for rr in exchanges[4:6]]
+    assert [rr.guid for rr in load(path + ".1")] == [rr.guid for rr in exchanges[6:8]]
+    assert [rr.guid for rr in load(path)] == [exchanges[0].guid]
+    assert load(path)[0].request.body == b"x" * 100
+
+
+def test_filter_passes_complete_exchanges_only():
+    class Collecting(MessageListener):
+        def __init__(self):
+            self.received = []
+
+        def on_request_response(self, request_response):
+            self.received.append(request_response)
+
+    collecting = Collecting()
+    complete = exchange(b"")
+    CompleteExchangeFilter(collecting).on_request_response(RequestResponse(complete.request))
+    CompleteExchangeFilter(collecting).on_request_response(complete)
+    assert collecting.received == [complete]
+
+
+def test_does_not_import_gui():
+    code = "import sys, proxy.headless; " \
+           "sys.exit(any(m.startswith(('proxy.gui', 'PyQt5')) for m in sys.modules))"
+    assert subprocess.run([sys.executable, "-c", code], cwd=ROOT).returncode == 0
@@ -0,0 +1,132 @@
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5")
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QApplication
+
+from proxy.gui.widgets.http_messages_tree_view import HttpMessagesModel, HttpMessagesTreeView, ROLE_HTTP_MESSAGE
+from proxy.parser.http_parser import parse_head
+from proxy.pipe.communication import RequestResponse
+
+
+class Registry:
+    """Cells are the path of the request and the status of the response, the calls are counted"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_cell_content(self, request_response, column_id):
+        self.calls += 1
+        if column_id == "path":
+            return request_response.request.path.decode()
+        return request_response.response.status.decode() if request_response.response else None
+
+    def get_columns(self):
+        return [("path", "Path"), ("status", "Status")]
+
+    def filter_accepts_row(self, request_response):
+        return True
+
+
+@pytest.fixture(scope="module")
+def application():
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def model(application):
+    model = HttpMessagesModel(Registry(), [("path", "Path"), ("status", "Status")])
+    model.signals = []
+    model.rowsInserted.connect(lambda parent, first, last: model.signals.append(("inserted", first, last)))
+    model.rowsRemoved.connect(lambda parent, first, last: model.signals.append(("removed", first, last)))
+    model.dataChanged.connect(lambda top, bottom: model.signals.append(("changed", top.row(), bottom.row())))
+    return model
+
+
+def exchange(path):
+    return RequestResponse(parse_head(b"GET %s HTTP/1.1\r\n\r\n" % path))
+
+
+def respond(request_response):
+    update = RequestResponse(request_response.request, parse_head(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"))
+    update.guid = request_response.guid
+    return update
+
+
+def cells(model):
+    return [[model.data(model.index(row, column)) for column in range(model.columnCount())]
+            for row in range(model.rowCount())]
+
+
+def test_batch_is_inserted_at_once_and_cells_are_cached(model):
+    model.addRequestResponses([exchange(b"/a"), exchange(b"/b")])
+
+    assert model.signals == [("inserted", 0, 1)]
+    assert model.headerData(1, Qt.Horizontal) == "Status"
+    assert cells(model) == [["/a", ""], ["/b", ""]]
+    calls = model.plugin_registry.calls
+    assert cells(model) == [["/a", ""], ["/b", ""]]
+    assert model.plugin_registry.calls == calls
+
+
+def test_update_replaces_the_row(model):
+    first, second = exchange(b"/a"), exchange(b"/b")
+    model.addRequestResponses([first, second])
+    cells(model)
+
+    model.addRequestResponses([respond(second)])
+
+    assert model.signals[1:] == [("changed", 1, 1)]
+    assert cells(model) == [["/a", ""], ["/b", "200"]]
+    assert model.data(model.index(1, 0), ROLE_HTTP_MESSAGE).response is not None
+
+
+def test_updates_in_the_same_batch_are_merged(model):
+    first = exchange(b"/a")
+    model.addRequestResponses([first, exchange(b"/b"), respond(first)])
+
+    assert model.signals == [("inserted", 0, 1)]
+    assert cells(model) == [["/a", "200"], ["/b", ""]]
+
+
+def test_evicted_rows_are_removed_at_once(model):
+    exchanges = [exchange(b"/%d" % i) for i in range(5)]
+    model.addRequestResponses(exchanges)
+    model.removeRequestResponses({rr.guid for rr in exchanges[:2]})
+
+    assert model.signals[1:] == [("removed", 0, 1)]
+    assert [row[0] for row in cells(model)] == ["/2", "/3", "/4"]
+
+    # Positions stay right after the removal
+    model.addRequestResponses([respond(exchanges[3]), exchange(b"/5")])
+    assert cells(model) == [["/2", ""], ["/3", "200"], ["/4", ""], ["/5", ""]]
+
+    # An exchange that is not one of the first rows
+    model.removeRequestResponses({exchanges[3].guid})
+    model.addRequestResponses([respond(exchanges[4])])
+    assert cells(model) == [["/2", ""], ["/4", "200"], ["/5", ""]]
+
+
+def test_paused_view_keeps_the_limits_of_the_ring(application):
+    view = HttpMessagesTreeView(Registry())
+    view.setCaptureLimits(max_count=2)
+    shown, last = exchange(b"/1"), exchange(b"/4")
+    view.onRequestResponses([shown])
+
+    view.pause()
+    view.onRequestResponses([exchange(b"/2"), exchange(b"/3"), last])
+    # The row of the evicted exchange is removed, the new ones wait
+    assert view.model.request_responses == []
+    assert list(view.held) == list(view.ring.pairs)
+    answered = respond(last)
+    view.onRequestResponses([answered])
+    assert len(view.held) == 2
+
+    view.resume()
+    assert [rr.request.path for rr in view.model.request_responses] == [b"/3", b"/4"]
+    assert view.model.request_responses[-1] is answered
+    assert view.held == {}
@@ -1,5 +1,8 @@
+import collections
+import functools
+
 from proxy.parser.parser_utils import parse, intialize_parser
-from proxy.parser.http_parser import get_http_request
+from proxy.parser.http_parser import get_http_request, get_http_stream, MessageHead, MessageBody, MessageEnd
 
 
 def chunks(l, n):
@@ -225,3 +228,161 @@ def test_two_responses_chunked_in_parts():
     for parsed_message in parsed_messages:
         assert parsed_message.headers[b'Content-Type'] == b"text/plain; charset=utf-8"
         assert parsed_message.body == b"Wikipedia in\r\n\r\nchunks."
+
+
+def stream_events(msg, piece_size):
+    parser = intialize_parser(get_http_stream)
+    events = []
+    for data in chunks(msg, piece_size):
+        events += parse(parser, data)
+    return events
+
+
+def test_stream_emits_head_before_body():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Content-Length: 40\r\n" + \
+          b"\r\n" + \
+          b"x" * 40
+
+    events = stream_events(msg * 2, 15)
+
+    assert [e.__class__ for e in events].count(MessageHead) == 2
+    assert [e.__class__ for e in events].count(MessageEnd) == 2
+    assert isinstance(events[0], MessageHead)
+    assert events[0].message.headers[b"Content-Length"] == b"40"
+    first_end = [i for i, e in enumerate(events) if isinstance(e, MessageEnd)][0]
+    body = b"".join(e.data for e in events[:first_end] if isinstance(e, MessageBody))
+    assert body == b"x" * 40
+    assert len([e for e in events[:first_end] if isinstance(e, MessageBody)]) > 1
+
+
+def test_stream_until_close():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Content-Type: text/plain; charset=utf-8\r\n" + \
+          b"\r\n" + \
+          b"abcd\r\n"
+
+    parser = intialize_parser(get_http_stream)
+    events = list(parse(parser, msg))
+    assert isinstance(events[0], MessageHead)
+    assert not any(isinstance(e, MessageEnd) for e in events)
+
+    events += parse(parser, None)
+    assert isinstance(events[-1], MessageEnd)
+    assert b"".join(e.data for e in events if isinstance(e, MessageBody)) == b"abcd\r\n"
+
+
+def test_chunked_with_extensions_and_trailers():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Transfer-Encoding: chunked\r\n" + \
+          b"Trailer: Expires\r\n" + \
+          b"\r\n" + \
+          b"4;name=value\r\n" + \
+          b"Wiki\r\n" + \
+          b"0\r\n" + \
+          b"Expires: never\r\n" + \
+          b"\r\n"
+
+    parser = intialize_parser(get_http_request)
+    parsed_messages = []
+    for data in chunks(msg * 2, 7):
+        parsed_messages += parse(parser, data)
+
+    assert len(parsed_messages) == 2
+    for parsed_message in parsed_messages:
+        assert parsed_message.body == b"Wiki"
+        assert parsed_message.trailers[b"Expires"] == b"never"
+        assert b"".join(parsed_message.to_bytes()).endswith(b"4\r\nWiki\r\n0\r\nExpires: never\r\n\r\n")
+
+
+def test_stream_chunked_pieces_and_trailers():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Transfer-Encoding: chunked\r\n" + \
+          b"\r\n" + \
+          b"14\r\n" + \
+          b"abcdefghijklmnopqrst\r\n" + \
+          b"0\r\n" + \
+          b"Expires: never\r\n" + \
+          b"\r\n"
+
+    events = stream_events(msg, 30)
+
+    assert isinstance(events[0], MessageHead)
+    assert isinstance(events[-1], MessageEnd)
+    pieces = [e.data for e in events if isinstance(e, MessageBody)]
+    assert len(pieces) > 1
+    assert b"".join(pieces) == b"abcdefghijklmnopqrst"
+    assert events[-1].message.trailers[b"Expires"] == b"never"
+
+
+def test_headers_are_case_insensitive_and_lazy():
+    msg = b"GET /path HTTP/1.1\r\n" + \
+          b"Host: www.example.com\r\n" + \
+          b"X-Folded: first\r\n" + \
+          b"  second\r\n" + \
+          b"Set-Cookie: a=1\r\n" + \
+          b"Set-Cookie: b=2\r\n" + \
+          b"\r\n"
+
+    parser = intialize_parser(get_http_request)
+    message = list(parse(parser, msg))[0]
+
+    assert message.head == msg
+    assert message.headers[b"host"] == b"www.example.com"
+    assert message.headers.get(b"HOST") == b"www.example.com"
+    assert b"content-length" not in message.headers
+    assert message.headers[b"X-Folded"] == b"first\r\n  second"
+    assert [value for name, value in message.headers.items() if name == b"Set-Cookie"] == [b"a=1", b"b=2"]
+    assert list(message.to_bytes()) == [msg]
+
+
+def test_headers_reserialized_only_when_changed():
+    msg = b"GET /path HTTP/1.1\r\nHost: localhost:8888\r\nAccept: */*\r\n\r\n"
+
+    parser = intialize_parser(get_http_request)
+    message = list(parse(parser, msg))[0]
+
+    message.headers[b"Host"] = b"localhost:8888"
+    assert not message.headers.modified
+    assert list(message.to_bytes()) == [msg]
+
+    message.headers[b"host"] = b"www.example.com"
+    del message.headers[b"ACCEPT"]
+    assert message.headers.modified
+    assert b"".join(message.to_bytes()) == b"GET /path HTTP/1.1\r\nHost: www.example.com\r\n\r\n"
+
+
+def test_request_without_framing_headers_has_no_body():
+    msg = b"POST /form HTTP/1.1\r\nHost: www.example.com\r\n\r\n"
+
+    parser = intialize_parser(get_http_request)
+    parsed_messages = list(parse(parser, msg * 2))
+
+    assert len(parsed_messages) == 2
+    assert parsed_messages[0].body is None
+
+
+def test_responses_without_body():
+    requests = b"HEAD / HTTP/1.1\r\n\r\n" + \
+               b"GET /a HTTP/1.1\r\n\r\n" + \
+               b"GET /b HTTP/1.1\r\n\r\n" + \
+               b"POST /c HTTP/1.1\r\nContent-Length: 2\r\nExpect: 100-continue\r\n\r\nab"
+    responses = b"HTTP/1.1 200 OK\r\nContent-Length: 1234\r\n\r\n" + \
+                b"HTTP/1.1 204 No Content\r\n\r\n" + \
+                b"HTTP/1.1 304 Not Modified\r\nContent-Length: 10\r\n\r\n" + \
+                b"HTTP/1.1 100 Continue\r\n\r\n" + \
+                b"HTTP/1.1 201 Created\r\nContent-Length: 2\r\n\r\nok"
+
+    request_methods = collections.deque()
+    request_parser = intialize_parser(functools.partial(get_http_request, request_methods=request_methods))
+    response_parser = intialize_parser(functools.partial(get_http_request, request_methods=request_methods))
+    parsed_requests = list(parse(request_parser, requests))
+    parsed_responses = []
+    for data in chunks(responses, 15):
+        parsed_responses += parse(response_parser, data)
+
+    assert [r.method for r in parsed_requests] == [b"HEAD", b"GET", b"GET", b"POST"]
+    assert [r.status for r in parsed_responses] == [b"200", b"204", b"304", b"100", b"201"]
+    assert [r.body for r in parsed_responses] == [None, None, None, None, b"ok"]
+    assert [r.request_method for r in parsed_responses] == [b"HEAD", b"GET", b"GET", b"POST", b"POST"]
+    assert not request_methods
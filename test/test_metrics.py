@@ -0,0 +1,69 @@
+import asyncio
+
+from proxy.pipe.apipe import ProxyParameters, prepare_server
+from proxy.pipe.channel import ChannelRegistry
+from proxy.pipe.communication import MessageListener
+from proxy.pipe.metrics import Histogram, MetricsListener, ProxyMetrics, start_metrics_server
+
+REQUEST = b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"
+RESPONSE = b"HTTP/1.1 404 Not Found\r\nContent-Length: 2\r\n\r\nno"
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+
+    assert list(histogram.samples("latency", 'status_class="2xx"')) == [
+        'latency_bucket{status_class="2xx",le="0.1"} 2',
+        'latency_bucket{status_class="2xx",le="1"} 3',
+        'latency_bucket{status_class="2xx",le="+Inf"} 4',
+        'latency_sum{status_class="2xx"} 3.65',
+        'latency_count{status_class="2xx"} 4',
+    ]
+
+
+def test_metrics_are_served():
+    async def upstream(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(RESPONSE)
+        await writer.drain()
+        writer.close()
+
+    async def scenario():
+        upstream_server = await asyncio.start_server(upstream, host="127.0.0.1", port=0)
+        upstream_port = upstream_server.sockets[0].getsockname()[1]
+        parameters = ProxyParameters("127.0.0.1", 0, "127.0.0.1", upstream_port)
+        metrics = ProxyMetrics(ChannelRegistry())
+        proxy_server = await prepare_server(parameters, MetricsListener(MessageListener(), metrics),
+                                            channels=metrics.channels, metrics=metrics)
+        proxy_port = proxy_server.sockets[0].getsockname()[1]
+        metrics_server = await start_metrics_server(metrics, "127.0.0.1", 0)
+        metrics_port = metrics_server.sockets[0].getsockname()[1]
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        writer.write(REQUEST)
+        await reader.read()
+        writer.close()
+        await asyncio.sleep(0.1)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", metrics_port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+
+        for server in (metrics_server, proxy_server, upstream_server):
+            server.close()
+        return response
+
+    response = asyncio.run(asyncio.wait_for(scenario(), 5))
+    head, body = response.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 200 OK")
+    lines = body.decode().splitlines()
+    assert "pyproxy_connections_total 1" in lines
+    assert "pyproxy_connections_active 0" in lines
+    assert "pyproxy_messages_parsed_total 2" in lines
+    assert "pyproxy_received_bytes_total {}".format(len(REQUEST) + len(RESPONSE)) in lines
+    assert "pyproxy_upstream_connect_seconds_count 1" in lines
+    assert 'pyproxy_request_duration_seconds_count{status_class="4xx"} 1' in lines
+    assert 'pyproxy_request_duration_seconds_count{status_class="2xx"} 0' in lines
@@ -0,0 +1,57 @@
+from proxy.parser.parser_utils import ReceiveBuffer, intialize_parser, parse, get_until, get_word, get_bytes, \
+    get_rest, COMPACT_THRESHOLD
+
+
+def test_buffer_take_and_extend():
+    buffer = ReceiveBuffer(b"abc")
+    buffer.extend(b"def")
+    assert len(buffer) == 6
+    assert buffer.take(2) == b"ab"
+    assert buffer[0] == ord("c")
+    assert buffer[1:3] == b"de"
+    assert buffer.find(b"ef") == 2
+    assert buffer.take_all() == b"cdef"
+    assert not buffer
+
+
+def test_buffer_compaction_keeps_content():
+    buffer = ReceiveBuffer()
+    piece = bytes(range(256)) * 64
+    expected = b""
+    for i in range(2 * COMPACT_THRESHOLD // len(piece) + 2):
+        buffer.extend(piece)
+        expected += piece
+        expected = expected[1000:]
+        buffer.skip(1000)
+        assert len(buffer) == len(expected)
+    assert buffer.take_all() == expected
+
+
+def test_get_until_across_reads():
+    def parser_func(data):
+        result, data = yield from get_until(data, b"\r\n\r\n")
+        return result, data
+
+    parser = intialize_parser(parser_func)
+    results = []
+    for piece in (b"ab\r", b"\n\r", b"\ncd", b"\r\n", b"\r\nef"):
+        results += parse(parser, piece)
+
+    assert results == [b"ab", b"cd"]
+
+
+def test_words_bytes_and_rest():
+    def parser_func(data):
+        word, data = yield from get_word(data)
+        length, data = yield from get_word(data)
+        body, data = yield from get_bytes(data, int(length))
+        rest, data = yield from get_rest(data)
+        return (word, body, rest), data
+
+    parser = intialize_parser(parser_func)
+    results = []
+    for piece in (b"wo", b"rd 5 ", b"abcdefg", b"hi"):
+        results += parse(parser, piece)
+    results += parse(parser, None)
+
+    assert results == [(b"word", b"abcde", b"fghi")]
@@ -0,0 +1,59 @@
+import collections
+
+from proxy.pipe.apipe import ProxyParameters
+from proxy.pipe.communication import MessageProcessor
+from proxy.pipe.passthrough import RAW, RawRewriter
+
+
+def rewriters():
+    processor = MessageProcessor(ProxyParameters("localhost", 8888, "www.example.com", 80))
+    request_methods = collections.deque()
+    client, remote = RawRewriter(processor, request_methods), RawRewriter(processor, request_methods)
+    client.peer, remote.peer = remote, client
+    return client, remote
+
+
+def forward(rewriter, *pieces):
+    return b"".join(b"".join(bytes(piece) for piece in rewriter.feed(data)) for data in pieces)
+
+
+def test_only_heads_with_an_address_are_rewritten():
+    client, remote = rewriters()
+    body = b"Host: localhost:8888 in a body"
+    requests = (b"POST /a HTTP/1.1\r\nHost: localhost:8888\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body) +
+                b"GET /b HTTP/1.1\r\nHost: proxy.internal\r\n\r\n")
+
+    # Split at every position, the result does not depend on how the data was received
+    for split in range(len(requests)):
+        client, remote = rewriters()
+        assert forward(client, requests[:split], requests[split:]) == requests.replace(
+            b"Host: localhost:8888\r\n", b"Host: www.example.com:80\r\n")
+        assert client.rewritten == 1
+
+
+def test_body_pieces_are_not_copied():
+    client, remote = rewriters()
+    client.feed(b"POST / HTTP/1.1\r\nHost: proxy.internal\r\nContent-Length: 10\r\n\r\n")
+    data = b"0123456789"
+    pieces = client.feed(data)
+    assert len(pieces) == 1 and pieces[0].obj is data
+
+
+def test_chunked_responses_and_head_requests():
+    client, remote = rewriters()
+    forward(client, b"HEAD / HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n")
+    responses = (b"HTTP/1.1 301 Moved\r\nLocation: http://www.example.com/x\r\nContent-Length: 5\r\n\r\n"
+                 b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                 b"5\r\nwww.e\r\n0\r\nX-Trailer: www.example.com\r\n\r\n")
+
+    assert forward(remote, responses) == responses.replace(b"Location: http://www.example.com/x",
+                                                           b"Location: http://localhost/x")
+    assert remote.rewritten == 1
+
+
+def test_switching_protocols_forwards_the_rest_raw():
+    client, remote = rewriters()
+    forward(client, b"GET /ws HTTP/1.1\r\nUpgrade: websocket\r\n\r\n")
+    forward(remote, b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n\r\n")
+    assert client.state == RAW and remote.state == RAW
+    assert forward(client, b"\x81\x05Host:") == b"\x81\x05Host:"
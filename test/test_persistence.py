@@ -3,7 +3,10 @@ import os
 
 import pytest
 
-from proxy.pipe.persistence import parse_message_pairs, serialize_message_pairs
+from proxy.parser.http_parser import HttpHeaders
+from proxy.pipe import persistence
+from proxy.pipe.communication import Timing
+from proxy.pipe.persistence import map_message_pairs, parse_message_pairs, serialize_message_pairs
 
 DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -31,3 +34,111 @@ def test_load_and_save(data):
     stream2.seek(0)
     data2 = stream2.read()
     assert data == data2
+
+
+def test_timing_is_kept(data):
+    message_pairs = list(parse_message_pairs(io.BytesIO(data)))
+    timing = Timing(7, 100.25, 100.5, 100.75)
+    timing.response_end = 101.125
+    timing.response_bytes = 1234
+    message_pairs[0].timing = timing
+
+    stream = io.BytesIO()
+    serialize_message_pairs(message_pairs, stream)
+    stream.seek(0)
+    loaded = list(parse_message_pairs(stream))
+
+    assert len(loaded) == 3
+    assert [getattr(loaded[0].timing, name) for name in Timing.__slots__] == \
+           [getattr(timing, name) for name in Timing.__slots__]
+    assert loaded[1].timing is None
+    assert loaded[0].response.body == message_pairs[0].response.body
+
+
+def test_mapped_capture_matches_parsed(data, tmp_path):
+    message_pairs = list(parse_message_pairs(io.BytesIO(data)))
+    message_pairs[1].timing = Timing(3, 1.5)
+    chunked = message_pairs[2].response
+    chunked.headers[b"Transfer-Encoding"] = b"chunked"
+    del chunked.headers[b"Content-Length"]
+    chunked.trailers = HttpHeaders()
+    chunked.trailers[b"X-Checksum"] = b"1234"
+    path = tmp_path / "capture.http"
+    with open(path, "wb") as f:
+        serialize_message_pairs(message_pairs, f)
+
+    mapped = list(map_message_pairs(str(path)))
+
+    assert len(mapped) == 3
+    for parsed, loaded in zip(message_pairs, mapped):
+        assert loaded.guid == parsed.guid
+        for name in ("request", "response"):
+            message = getattr(loaded, name)
+            assert message.body_loader is not None or not message.has_body()
+            assert b"".join(message.to_bytes()) == b"".join(getattr(parsed, name).to_bytes())
+    assert mapped[1].timing.connection_id == 3
+    assert mapped[2].response.trailers[b"X-Checksum"] == b"1234"
+
+    stream = io.BytesIO()
+    serialize_message_pairs(mapped, stream)
+    assert stream.getvalue() == path.read_bytes()
+
+
+def test_pair_without_response_at_the_end(data, tmp_path):
+    message_pairs = list(parse_message_pairs(io.BytesIO(data)))
+    message_pairs[2].response = None
+    stream = io.BytesIO()
+    serialize_message_pairs(message_pairs, stream)
+    path = tmp_path / "capture.http"
+    path.write_bytes(stream.getvalue())
+
+    for loaded in (list(parse_message_pairs(io.BytesIO(stream.getvalue()))), list(map_message_pairs(str(path)))):
+        assert len(loaded) == 3
+        assert loaded[2].response is None
+
+
+def test_bodies_until_close_are_saved_with_their_length():
+    capture = (b"Pair: 00000000-0000-0000-0000-000000000001\r\n"
+               b"Request: POST /a HTTP/1.1\r\nContent-Length: 1\r\n\r\nx\r\n"
+               b"Response: HTTP/1.1 500 Internal Server Error\r\n\r\nfailed\r\n")
+    message_pairs = list(parse_message_pairs(io.BytesIO(capture)))
+    assert [rr.response.body for rr in message_pairs] == [b"failed"]
+    message_pairs.append(message_pairs[0])
+
+    stream = io.BytesIO()
+    serialize_message_pairs(message_pairs, stream)
+    loaded = list(parse_message_pairs(io.BytesIO(stream.getvalue())))
+    assert [(rr.response.status, rr.response.body) for rr in loaded] == [(b"500", b"failed")] * 2
+
+
+@pytest.mark.parametrize("read_size", [3, 7, 64 * 1024])
+def test_bodies_until_close_end_before_the_next_pair(tmp_path, monkeypatch, read_size):
+    # Written before bodies delimited by the connection close were saved with their length
+    capture = (b"Pair: 00000000-0000-0000-0000-000000000001\r\n"
+               b"Request: GET /a HTTP/1.1\r\n\r\n\r\n"
+               b"Response: HTTP/1.0 200 OK\r\n\r\nfirst\r\nPair:x\r\n"
+               b"Pair: 00000000-0000-0000-0000-000000000002\r\n"
+               b"Request: GET /b HTTP/1.1\r\n\r\n\r\n"
+               b"Response: HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nsecond\r\n")
+    path = tmp_path / "capture.http"
+    path.write_bytes(capture)
+    monkeypatch.setattr(persistence, "READ_SIZE", read_size)
+
+    for loaded in (list(parse_message_pairs(io.BytesIO(capture))), list(map_message_pairs(str(path)))):
+        assert [(rr.request.path, rr.response.body) for rr in loaded] == \
+            [(b"/a", b"first\r\nPair:x"), (b"/b", b"second")]
+
+
+def test_mapped_capture_ending_with_body_until_close(tmp_path):
+    # Written before bodies delimited by the connection close were saved with their length
+    capture = (b"Pair: 00000000-0000-0000-0000-000000000001\r\n"
+               b"Request: POST /a HTTP/1.1\r\nContent-Length: 1\r\n\r\nx\r\n"
+               b"Response: HTTP/1.1 500 Internal Server Error\r\n\r\nfailed\r\n"
+               b"Pair: 00000000-0000-0000-0000-000000000002\r\n"
+               b"Request: GET /b HTTP/1.1\r\n\r\n\r\n"
+               b"Response: HTTP/1.0 200 OK\r\n\r\nbody\r\n")
+    path = tmp_path / "capture.http"
+    path.write_bytes(capture)
+
+    loaded = list(map_message_pairs(str(path)))
+    assert [(rr.request.path, rr.response.body) for rr in loaded] == [(b"/a", b"failed"), (b"/b", b"body")]
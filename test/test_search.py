@@ -0,0 +1,109 @@
+import gzip
+import threading
+import time
+
+import pytest
+
+from proxy.parser.http_parser import LazyHttpResponse, parse_head
+from proxy.pipe.communication import RequestResponse
+from proxy.pipe.search import SearchIndex
+
+
+def exchange(path, body, gzipped=False):
+    request = parse_head(b"GET " + path + b" HTTP/1.1\r\nHost: example.com\r\n\r\n")
+    encoding = b"Content-Encoding: gzip\r\n" if gzipped else b""
+    data = gzip.compress(body) if gzipped else body
+    response = parse_head(b"HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\n" + encoding +
+                          b"Content-Length: %d\r\n\r\n" % len(data), response_class=LazyHttpResponse)
+    response.body = data
+    return RequestResponse(request, response)
+
+
+def test_search_headers_and_bodies():
+    index = SearchIndex(index_bodies=True)
+    first = exchange(b"/customers", b"<customer><id>C-12345</id></customer>")
+    second = exchange(b"/orders", b"<order customer='X-99'>12345</order>", gzipped=True)
+    third = exchange(b"/orders", b"\xff\xfe binary 12345")
+    for rr in (first, second, third):
+        index.add(rr)
+    index.join()
+
+    assert index.search("c-12345") == {first.guid}
+    assert index.search("12345") == {first.guid, second.guid}
+    assert index.search("/orders") == {second.guid, third.guid}
+    assert index.search("example.com customer") == {first.guid, second.guid}
+    assert index.search("missing") == set()
+    assert index.search(" -- ") is None
+
+    index.remove(first)
+    index.join()
+    assert index.search("12345") == {second.guid}
+    assert "customers" not in index.postings
+    assert "c" not in index.postings
+
+    index.clear()
+    assert index.search("12345") == set()
+
+
+def test_bodies_are_opt_in_and_only_resident_ones_are_indexed():
+    rr = exchange(b"/plain", b"<plain>haystack</plain>")
+    lazy = exchange(b"/lazy", b"")
+    lazy.response.body_loader = lambda: pytest.fail("the body is read")
+    index = SearchIndex()
+    index.add(rr)
+    index.join()
+    assert index.search("haystack") == set()
+    assert index.search("plain") == {rr.guid}
+
+    index = SearchIndex(index_bodies=True)
+    index.add(lazy)
+    index.join()
+    assert index.search("lazy") == {lazy.guid}
+    assert lazy.response.body_loader is not None
+
+
+def test_only_the_start_of_bodies_is_indexed():
+    index = SearchIndex(index_bodies=True, max_body=1000)
+    body = b"first " + "\u00e9".encode() * 497 + b" last"
+    rr = exchange(b"/long", body, gzipped=True)
+    index.add(rr)
+    index.join()
+
+    assert index.search("first") == {rr.guid}
+    assert index.search("last") == set()
+
+
+class SlowExchange:
+    """Indexed once the blocker is set"""
+
+    def __init__(self, request_response, blocker):
+        self.guid = request_response.guid
+        self.response = None
+        self.__request = request_response.request
+        self.__blocker = blocker
+
+    @property
+    def request(self):
+        self.__blocker.wait()
+        return self.__request
+
+
+def test_pending_exchanges_are_bounded():
+    index = SearchIndex(max_pending=2)
+    blocker = threading.Event()
+    slow = SlowExchange(exchange(b"/slow", b""), blocker)
+    index.add(slow)
+    while index.pending():
+        time.sleep(0.001)
+    evicted, kept, dropped = exchange(b"/evicted", b""), exchange(b"/kept", b""), exchange(b"/dropped", b"")
+    index.add(evicted)
+    index.add(kept)
+    index.add(dropped)
+    index.remove(evicted)
+    assert index.pending() == 1
+    blocker.set()
+    index.join()
+
+    assert index.dropped == 1
+    assert index.search("get") == {slow.guid, kept.guid}
+    assert index.indexed == {slow.guid, kept.guid}
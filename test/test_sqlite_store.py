@@ -0,0 +1,110 @@
+import os
+import time
+
+import pytest
+
+from proxy.parser.http_parser import parse_head
+from proxy.pipe.communication import RequestResponse, Timing
+from proxy.pipe.sqlite_store import CaptureDatabase
+
+SOAP_BODY = (b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+             b'<soapenv:Body><ns:getCustomer xmlns:ns="urn:customers"><id>42</id></ns:getCustomer></soapenv:Body>'
+             b'</soapenv:Envelope>')
+
+
+def message(head, body):
+    message = parse_head(head % len(body))
+    message.body = body
+    return message
+
+
+def exchange(path, status, body=b"", soap=False):
+    content_type = b"text/xml" if soap else b"text/plain"
+    request = message(b"POST " + path + b" HTTP/1.1\r\nHost: example.com\r\nContent-Type: " + content_type +
+                      b"\r\nContent-Length: %d\r\n\r\n", SOAP_BODY if soap else b"request")
+    response = message(b"HTTP/1.1 " + status + b" Status\r\nContent-Length: %d\r\n\r\n", body)
+    response.request_method = b"POST"
+    return RequestResponse(request, response)
+
+
+def test_store_and_page(tmp_path):
+    database = CaptureDatabase(str(tmp_path / "capture.db"))
+    exchanges = [exchange(b"/a", b"200"), exchange(b"/b", b"500", b"error"), exchange(b"/a", b"500"),
+                 exchange(b"/soap", b"200", soap=True)]
+    # The request alone first, then the whole exchange, which updates the row
+    pending = RequestResponse(exchanges[0].request)
+    pending.guid = exchanges[0].guid
+    database.on_request_response(pending)
+    database.on_request_responses(exchanges)
+
+    assert database.count() == 4
+    assert database.count(status=500) == 2
+    assert [rr.guid for _, rr in database.page(status=500)] == [exchanges[1].guid, exchanges[2].guid]
+    assert [rr.guid for _, rr in database.page(path="/a", status=500)] == [exchanges[2].guid]
+    assert [rr.guid for _, rr in database.page(soap_method="getCustomer")] == [exchanges[3].guid]
+
+    first_page = database.page(limit=3)
+    assert [rr.guid for _, rr in first_page] == [rr.guid for rr in exchanges[:3]]
+    second_page = database.page(after=first_page[-1][0], limit=3)
+    assert [rr.guid for _, rr in second_page] == [exchanges[3].guid]
+
+    rr = first_page[1][1]
+    assert rr.response.body_loader is not None
+    assert rr.response.body == b"error"
+    assert rr.request.body == b"request"
+    assert rr.response.request_method == b"POST"
+    database.close()
+
+
+def test_large_bodies_in_files(tmp_path):
+    body_dir = str(tmp_path / "bodies")
+    database = CaptureDatabase(str(tmp_path / "capture.db"), body_dir, external_body_size=100)
+    large = b"x" * 1000
+    database.on_request_responses([exchange(b"/a", b"200", large), exchange(b"/b", b"200", large),
+                                   exchange(b"/c", b"200", b"small")])
+
+    assert len(os.listdir(body_dir)) == 1
+    assert [rr.response.body for _, rr in database.page()] == [large, large, b"small"]
+    database.close()
+
+    # A reader finds the files without being told where they are
+    database = CaptureDatabase(str(tmp_path / "capture.db"))
+    assert database.page()[0][1].response.body == large
+    database.close()
+
+
+def test_read_only_rejects_other_files(tmp_path):
+    path = str(tmp_path / "capture.db")
+    database = CaptureDatabase(path)
+    database.on_request_responses([exchange(b"/a", b"200", b"ok")])
+    database.close()
+
+    reader = CaptureDatabase(path, read_only=True)
+    [(_, rr)] = reader.page()
+    assert rr.response.body == b"ok"
+    reader.close()
+
+    other = tmp_path / "notes.txt"
+    other.write_bytes(b"not a database")
+    empty = str(tmp_path / "empty.db")
+    for path in (str(other), empty):
+        with pytest.raises(ValueError):
+            CaptureDatabase(path, read_only=True)
+    assert other.read_bytes() == b"not a database"
+    assert not os.path.exists(empty)
+
+
+def test_time_is_the_wall_clock_time_of_the_request(tmp_path):
+    database = CaptureDatabase(str(tmp_path / "capture.db"))
+    old, recent, untimed = exchange(b"/old", b"200"), exchange(b"/recent", b"200"), exchange(b"/untimed", b"200")
+    old.timing, recent.timing = Timing(), Timing()
+    old.timing.request_time = 1000.0
+    recent.timing.request_time = 2000.0
+    before = time.time()
+    database.on_request_responses([recent, old, untimed])
+
+    assert [rr.guid for _, rr in database.page(until=1500)] == [old.guid]
+    assert [rr.guid for _, rr in database.page(since=1500, until=before)] == [recent.guid]
+    # Stored without timing, the time it was stored
+    assert [rr.guid for _, rr in database.page(since=before)] == [untimed.guid]
+    database.close()
@@ -0,0 +1,79 @@
+from proxy.parser.http_parser import parse_head
+from proxy.pipe.archive import ArchiveReader
+from proxy.pipe.communication import RequestResponse
+from proxy.pipe.store import CaptureRing
+
+
+def exchange(size):
+    response = parse_head(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % size)
+    response.body = b"x" * size
+    return RequestResponse(parse_head(b"GET / HTTP/1.1\r\n\r\n"), response)
+
+
+def test_count_limit():
+    ring = CaptureRing(max_count=3)
+    exchanges = [exchange(10) for _ in range(5)]
+    evicted = [ring.add(rr) for rr in exchanges]
+
+    assert evicted[:3] == [[], [], []]
+    assert evicted[3:] == [[exchanges[0]], [exchanges[1]]]
+    assert list(ring.request_responses()) == exchanges[2:]
+    assert ring.body_bytes == 30
+    assert ring.evicted == 2
+
+
+def test_byte_limit_and_updates():
+    ring = CaptureRing(max_bytes=250)
+    first, second = exchange(100), exchange(100)
+    ring.add(first)
+    ring.add(second)
+    # An update replaces the size of the exchange and keeps its place
+    update = exchange(120)
+    update.guid = first.guid
+    assert ring.add(update) == []
+    assert ring.body_bytes == 220
+
+    third = exchange(300)
+    assert ring.add(third) == [update, second]
+    # The exchange just added is kept even over the limit
+    assert list(ring.request_responses()) == [third]
+
+
+def test_offload_to_archive(tmp_path):
+    path = str(tmp_path / "offload.pyarc")
+    ring = CaptureRing(max_count=2, offload_path=path)
+    exchanges = [exchange(10) for _ in range(5)]
+    for rr in exchanges:
+        ring.add(rr)
+    ring.close()
+
+    assert [entry.guid for entry in ArchiveReader(path).entries] == [rr.guid for rr in exchanges[:3]]
+
+    # A new ring offloading to the same path keeps the archive written before
+    ring = CaptureRing(max_count=1, offload_path=path)
+    ring.add(exchange(10))
+    ring.add(exchange(10))
+    ring.close()
+
+    assert ring.offload_files == [str(tmp_path / "offload-1.pyarc")]
+    assert len(ArchiveReader(path).entries) == 3
+    assert len(ArchiveReader(ring.offload_files[0]).entries) == 1
+
+
+def test_offload_archives_are_rotated_and_readable_while_written(tmp_path):
+    path = str(tmp_path / "offload.pyarc")
+    ring = CaptureRing(max_count=1, offload_path=path, offload_entries=2)
+    exchanges = [exchange(2000) for _ in range(4)]
+    for rr in exchanges:
+        ring.add(rr)
+
+    assert ring.offload_files == [path, str(tmp_path / "offload-1.pyarc")]
+    assert not ArchiveReader(path).recovered
+    # The second archive is not closed yet
+    reader = ArchiveReader(ring.offload_files[1])
+    assert reader.recovered
+    assert [entry.guid for entry in reader.entries] == [exchanges[2].guid]
+    assert reader.read(reader.entries[0]).response.body == b"x" * 2000
+
+    ring.close()
+    assert [entry.guid for entry in ArchiveReader(ring.offload_files[1]).entries] == [exchanges[2].guid]
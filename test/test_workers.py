@@ -0,0 +1,71 @@
+import socket
+import socketserver
+import threading
+import time
+
+from proxy.pipe.apipe import ProxyParameters
+from proxy.pipe.communication import MessageListener
+from proxy.pipe.workers import ProxyWorkers
+
+
+class UpstreamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while self.rfile.readline() not in (b"\r\n", b""):
+            pass
+        self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok")
+
+
+class CollectingListener(MessageListener):
+    def __init__(self):
+        self.responses = []
+
+    def on_request_response(self, request_response):
+        if request_response.response is not None:
+            self.responses.append(request_response)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def request(port):
+    deadline = time.monotonic() + 20
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=5) as s:
+                s.sendall(b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n")
+                data = b""
+                while True:
+                    piece = s.recv(1024)
+                    if not piece:
+                        return data
+                    data += piece
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def test_workers_share_port_and_report_to_collector():
+    upstream = socketserver.ThreadingTCPServer(("127.0.0.1", 0), UpstreamHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+
+    listener = CollectingListener()
+    port = free_port()
+    parameters = ProxyParameters("127.0.0.1", port, "127.0.0.1", upstream.server_address[1])
+    workers = ProxyWorkers(parameters, listener, 2)
+    workers.start()
+    try:
+        responses = [request(port) for _ in range(4)]
+        deadline = time.monotonic() + 5
+        while len(listener.responses) < 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        workers.stop()
+        upstream.shutdown()
+
+    assert all(response.endswith(b"\r\n\r\nok") for response in responses)
+    assert len(listener.responses) == 4
+    assert all(rr.response.body == b"ok" for rr in listener.responses)